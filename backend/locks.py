@@ -0,0 +1,131 @@
+"""Redis locks that stop periodic celery tasks from overlapping."""
+
+import logging
+import threading
+from functools import wraps
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger("general")
+
+_client = None
+
+
+def get_client() -> redis.Redis:
+    """Redis client shared by all task locks in this process."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.TASK_LOCK_REDIS_URL)
+    return _client
+
+
+def lock_key(name: str) -> str:
+    """Redis key of a task's lock."""
+    return f"task-lock:{name}"
+
+
+def contention_key(name: str) -> str:
+    """Redis key counting how often a task's lock was already held."""
+    return f"task-lock:{name}:contention"
+
+
+def pending_key(name: str) -> str:
+    """Redis key flagging that a skipped run should be coalesced."""
+    return f"task-lock:{name}:pending"
+
+
+def get_contention_count(name: str) -> int:
+    """Number of times a task was skipped because its previous run was busy."""
+    return int(get_client().get(contention_key(name)) or 0)
+
+
+class Heartbeat(threading.Thread):
+    """Keep extending a lock's TTL while the task holding it is running.
+
+    The TTLs of keys (if they exist) are extended along with it.
+    """
+
+    def __init__(self, lock: redis.lock.Lock, interval: float, keys: list[str] | None = None):
+        super().__init__(daemon=True)
+        self.lock = lock
+        self.interval = interval
+        self.keys = keys or []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.lock.reacquire()
+                for key in self.keys:
+                    self.lock.redis.pexpire(key, int(self.lock.timeout * 1000))
+            except redis.exceptions.LockError:
+                logger.warning("Lost task lock %s", self.lock.name)
+                return
+            except redis.exceptions.RedisError:
+                logger.exception("Couldn't extend task lock %s", self.lock.name)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def singleton_task(name: str | None = None, ttl: int | None = None, coalesce: bool = False):
+    """Only allow a single run of the decorated task at a time.
+
+    Runs that start while another run holds the lock are skipped, and counted
+    in redis. With coalesce, skipped runs are instead merged into a single
+    extra run, started once the current run has finished.
+
+    The lock expires after ttl seconds (settings.TASK_LOCK_TTL by default),
+    so a crashed worker can't hold it forever. While the task is running, a
+    heartbeat extends it every third of the TTL, along with the flag of
+    coalesced runs.
+    """
+
+    def outer(func):
+        lock_name = name or f"{func.__module__}.{func.__name__}"
+
+        @wraps(func)
+        def inner(*args, **kwargs):
+            client = get_client()
+            timeout = ttl or settings.TASK_LOCK_TTL
+            lock = client.lock(lock_key(lock_name), timeout=timeout, blocking=False, thread_local=False)
+            if not lock.acquire():
+                count = client.incr(contention_key(lock_name))
+                if coalesce:
+                    client.set(pending_key(lock_name), 1, ex=timeout)
+                logger.warning(
+                    "Skipping %s, a previous run is still busy (contention count %s)",
+                    lock_name,
+                    count,
+                )
+                return None
+            keys = [pending_key(lock_name)] if coalesce else []
+            result = None
+            rerun = False
+            while True:
+                heartbeat = Heartbeat(lock, timeout / 3, keys)
+                heartbeat.start()
+                try:
+                    if not rerun:
+                        result = func(*args, **kwargs)
+                    # Runs skipped in the meantime are merged into a single rerun
+                    while coalesce and client.delete(pending_key(lock_name)):
+                        logger.info("Rerunning %s for runs skipped while it was busy", lock_name)
+                        result = func(*args, **kwargs)
+                finally:
+                    heartbeat.stop()
+                    try:
+                        lock.release()
+                    except redis.exceptions.LockError:
+                        logger.warning("Task lock %s expired before it was released", lock_name)
+                # A run may have been skipped between the last check and the
+                # release, if so take the lock again to rerun it
+                if not (coalesce and client.exists(pending_key(lock_name)) and lock.acquire()):
+                    return result
+                rerun = True
+
+        return inner
+
+    return outer
@@ -81,12 +81,84 @@ RD_DB_USER = "rd"
 RD_DB_PASSWORD = "rd"
 RD_DB_HOST = "localhost"
 RD_DB_PORT = "3306"
+# Connections kept open per worker process, at least SYNC_MAX_WORKERS
+RD_DB_POOL_SIZE = 5
+# Sum radiusdesk station metrics per node in buckets of this size (e.g.
+# timedelta(minutes=5)) instead of syncing every raw station row
+RD_METRICS_BUCKET = None
+# Radiusdesk resource samples are only stored when memory or cpu changed by
+# more than this many percentage points, otherwise the node's last sample
+# is extended to be valid until the sync
+RD_RESOURCES_TOLERANCE = 1.0
+# Spacing of the points that the resources API expands samples into,
+# matching the radiusdesk sync schedule
+RESOURCES_METRIC_INTERVAL = timedelta(minutes=15)
 # UNIFI config
 UNIFI_DB_NAME = "ace"
 UNIFI_DB_USER = ""
 UNIFI_DB_PASSWORD = ""
 UNIFI_DB_HOST = "localhost"
 UNIFI_DB_PORT = "27117"
+UNIFI_DB_MAX_POOL_SIZE = 10
+# Sync config
+# Number of rows buffered and upserted per query during a sync
+SYNC_BATCH_SIZE = 1000
+# Metric syncs resume from the last synced time, minus this overlap to pick
+# up rows that were updated or arrived late (e.g. unifi's current hour)
+SYNC_WATERMARK_OVERLAP = timedelta(hours=1)
+# Number of sync stages that can run concurrently
+SYNC_MAX_WORKERS = 4
+# Metric sync stages are split by MAC address into this many shards, each
+# synced in its own process. 1 syncs them in the stage's thread instead
+SYNC_METRIC_SHARDS = 1
+# Source connections are retried this many times, waiting
+# SYNC_CONNECT_BACKOFF seconds before the first retry and doubling after
+SYNC_CONNECT_RETRIES = 3
+SYNC_CONNECT_BACKOFF = 1
+# Ping config
+# Prober used by the ping task, either metrics.ping.FpingProber or
+# metrics.ping.ICMPProber (needs net.ipv4.ping_group_range to include the
+# worker's group)
+PING_PROBER = "metrics.ping.FpingProber"
+# Maximum number of nodes that ICMPProber pings at once, and echo requests
+# it sends per second
+PING_CONCURRENCY = 256
+PING_SEND_RATE = 1000
+# Number of ping results inserted per query
+PING_BATCH_SIZE = 1000
+# Ping sweeps are split into a subtask per mesh, and meshes with more
+# nodes than this into several subtasks. Gateways are pinged first, and nodes
+# only reachable through down nodes are then skipped (and not alerted on).
+# No sync sets Node.is_gateway or Node.neighbours, they must be configured
+# in the admin, until then no nodes are skipped.
+PING_CHUNK_SIZE = 250
+# A sweep isn't started while the previous sweep is still running, unless
+# that sweep started longer than this ago (e.g. because a subtask crashed)
+PING_SWEEP_TIMEOUT = timedelta(minutes=15)
+# Nodes are pinged again after PING_INTERVAL_RATIO times how long their
+# reachability has been unchanged, within these bounds
+PING_MIN_INTERVAL = timedelta(minutes=1)
+PING_MAX_INTERVAL = timedelta(minutes=30)
+PING_INTERVAL_RATIO = 0.1
+# Metric rollup config, see metrics.rollups
+ROLLUP_INTERVAL = timedelta(minutes=5)
+# Rollups are rebuilt from this long before the last rolled up bucket, to
+# include metrics that were synced late (e.g. by the 15 minute syncs, which
+# themselves re-read SYNC_WATERMARK_OVERLAP)
+ROLLUP_OVERLAP = timedelta(hours=2)
+# Number of metrics read, and rollups inserted, per query
+ROLLUP_BATCH_SIZE = 1000
+# Service probe config, see monitoring.probes
+SERVICE_PROBE_INTERVAL = timedelta(minutes=1)
+# Maximum number of services probed at once, overall and per host
+SERVICE_PROBE_CONCURRENCY = 100
+SERVICE_PROBE_HOST_CONCURRENCY = 4
+# Timeouts (in seconds) of the phases of a probe
+SERVICE_PROBE_CONNECT_TIMEOUT = 3.0
+SERVICE_PROBE_TLS_TIMEOUT = 3.0
+SERVICE_PROBE_FIRST_BYTE_TIMEOUT = 5.0
+# Number of probe results inserted per query
+SERVICE_PROBE_BATCH_SIZE = 1000
 
 DEVICE_CHECKS = [
     {
@@ -258,30 +330,37 @@ CELERY_RESULT_BACKEND = f"redis://{REDIS_HOST}:6379/0"
 # In order to schedule run_iperf3_checks on the correct time intervals
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = False
+# Locks that stop periodic tasks from overlapping with their next run
+TASK_LOCK_REDIS_URL = f"redis://{REDIS_HOST}:6379/1"
+# Seconds before a lock expires if its worker stops extending it
+TASK_LOCK_TTL = 60
 
 CELERY_BEAT_SCHEDULE = {
     "ping_schedule": {
         "task": "metrics.tasks.run_pings",
-        # Executes ping every 5 min
-        "schedule": timedelta(minutes=5),
+        # Pings the nodes that are due, see metrics.scheduling
+        "schedule": PING_MIN_INTERVAL,
     },
-    "syncrd_schedule": {
-        "task": "monitoring.tasks.run_syncrd",
-        # Executes db sync every 15 min
+    "sync_schedule": {
+        "task": "monitoring.tasks.run_syncall",
+        # Executes db sync with radiusdesk and unifi every 15 min, their
+        # stages run concurrently. Overlapping runs are coalesced by the
+        # task's lock
         "schedule": timedelta(minutes=15),
     },
-    "syncunifi_schedule": {
-        "task": "monitoring.tasks.run_syncunifi",
-        # Executes db sync every 15 min. Slightly
-        # offset from syncrd_schedule to prevent
-        # database concurrency issues
-        "schedule": timedelta(minutes=14),
-    },
     "alerts_schedule": {
         "task": "monitoring.tasks.generate_alerts",
         # Executes alert monitoring every 2 min
         "schedule": timedelta(minutes=2)
-    }
+    },
+    "rollup_schedule": {
+        "task": "metrics.tasks.run_rollups",
+        "schedule": ROLLUP_INTERVAL,
+    },
+    "service_probe_schedule": {
+        "task": "monitoring.tasks.probe_services",
+        "schedule": SERVICE_PROBE_INTERVAL,
+    },
 }
 
 LOGGING = {
@@ -0,0 +1,191 @@
+import threading
+import time
+import uuid
+from unittest import mock
+
+import redis
+from django.test import SimpleTestCase, override_settings
+
+from . import locks
+
+
+class FakeLock:
+    """Non-blocking lock of a FakeRedis, like redis.lock.Lock."""
+
+    def __init__(self, client: "FakeRedis", name: str, timeout: float, **kwargs):
+        self.redis = client
+        self.name = name
+        self.timeout = timeout
+        self.token = None
+
+    def acquire(self) -> bool:
+        token = uuid.uuid4().hex
+        if not self.redis.set(self.name, token, px=int(self.timeout * 1000), nx=True):
+            return False
+        self.token = token
+        return True
+
+    def owned(self) -> bool:
+        return self.token is not None and self.redis.get(self.name) == self.token
+
+    def reacquire(self) -> None:
+        if not self.owned():
+            raise redis.exceptions.LockNotOwnedError("Cannot reacquire a lock that's no longer owned")
+        self.redis.pexpire(self.name, int(self.timeout * 1000))
+
+    def release(self) -> None:
+        if not self.owned():
+            raise redis.exceptions.LockNotOwnedError("Cannot release a lock that's no longer owned")
+        self.redis.delete(self.name)
+        self.token = None
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis commands used by the task locks, with key expiry."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.mutex = threading.Lock()
+
+    def _expire_stale(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.values.pop(key, None)
+            self.expires.pop(key)
+
+    def get(self, key):
+        with self.mutex:
+            self._expire_stale(key)
+            return self.values.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        with self.mutex:
+            self._expire_stale(key)
+            if nx and key in self.values:
+                return None
+            self.values[key] = value
+            self.expires.pop(key, None)
+            if ex is not None or px is not None:
+                self.expires[key] = time.monotonic() + (px / 1000 if px is not None else ex)
+            return True
+
+    def incr(self, key):
+        with self.mutex:
+            self._expire_stale(key)
+            self.values[key] = int(self.values.get(key, 0)) + 1
+            return self.values[key]
+
+    def delete(self, key):
+        with self.mutex:
+            self._expire_stale(key)
+            self.expires.pop(key, None)
+            return int(self.values.pop(key, None) is not None)
+
+    def exists(self, key):
+        with self.mutex:
+            self._expire_stale(key)
+            return int(key in self.values)
+
+    def pexpire(self, key, milliseconds):
+        with self.mutex:
+            self._expire_stale(key)
+            if key not in self.values:
+                return False
+            self.expires[key] = time.monotonic() + milliseconds / 1000
+            return True
+
+    def lock(self, name, timeout, **kwargs):
+        return FakeLock(self, name, timeout, **kwargs)
+
+
+@override_settings(TASK_LOCK_TTL=1)
+class SingletonTaskTest(SimpleTestCase):
+    """Tests for the redis locks of periodic tasks, on an in-memory redis."""
+
+    def setUp(self):
+        self.client = FakeRedis()
+        patcher = mock.patch.object(locks, "get_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+    def task(self, coalesce=False, overlaps=0, sleep=0.0):
+        """A singleton task whose first run starts overlapping runs.
+
+        If it sleeps, it then checks that another overlapping run is still
+        skipped.
+        """
+
+        @locks.singleton_task(name="task", coalesce=coalesce)
+        def task():
+            self.calls.append(1)
+            if len(self.calls) == 1:
+                for _ in range(overlaps):
+                    self.assertIsNone(task())
+                if sleep:
+                    time.sleep(sleep)
+                    self.assertIsNone(task())
+            return len(self.calls)
+
+        return task
+
+    def test_skip(self):
+        task = self.task(overlaps=2)
+        self.assertEqual(task(), 1)
+        # The overlapping runs were skipped, and counted
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(locks.get_contention_count("task"), 2)
+        self.assertIsNone(self.client.get(locks.lock_key("task")))
+        # Once released, the task can run again
+        self.assertEqual(task(), 2)
+
+    def test_coalesce(self):
+        task = self.task(coalesce=True, overlaps=3)
+        # The skipped runs are merged into a single rerun
+        self.assertEqual(task(), 2)
+        self.assertEqual(locks.get_contention_count("task"), 3)
+        self.assertFalse(self.client.exists(locks.pending_key("task")))
+        self.assertIsNone(self.client.get(locks.lock_key("task")))
+
+    def test_heartbeat(self):
+        # The run takes longer than the lock's TTL. The heartbeat keeps the
+        # lock, and the flag of the run skipped before sleeping.
+        task = self.task(coalesce=True, overlaps=1, sleep=1.5)
+        self.assertEqual(task(), 2)
+        self.assertEqual(locks.get_contention_count("task"), 2)
+
+    def test_skipped_before_release(self):
+        task = self.task(coalesce=True)
+        delete = self.client.delete
+
+        def skip_before_release(key):
+            deleted = delete(key)
+            if key == locks.pending_key("task") and not deleted and len(self.calls) == 1:
+                # A run is skipped after the last check of the flag
+                self.client.set(key, 1)
+            return deleted
+
+        with mock.patch.object(self.client, "delete", side_effect=skip_before_release):
+            self.assertEqual(task(), 2)
+
+    def test_error(self):
+        @locks.singleton_task(name="task")
+        def task():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            task()
+        self.assertIsNone(self.client.get(locks.lock_key("task")))
+
+    def test_expiry(self):
+        lock = self.client.lock(locks.lock_key("task"), timeout=1)
+        self.assertTrue(lock.acquire())
+        heartbeat = locks.Heartbeat(lock, 0.2)
+        heartbeat.start()
+        time.sleep(1.5)
+        self.assertTrue(lock.owned())
+        # Without the heartbeat (e.g. a crashed worker), the lock expires
+        heartbeat.stop()
+        time.sleep(1.2)
+        self.assertFalse(lock.owned())
+        self.assertTrue(self.client.lock(locks.lock_key("task"), timeout=1).acquire())
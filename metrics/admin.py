@@ -7,3 +7,9 @@ admin.site.register(models.UptimeMetric)
 admin.site.register(models.FailuresMetric)
 admin.site.register(models.DataUsageMetric)
 admin.site.register(models.ResourcesMetric)
+admin.site.register(models.PingSweep)
+admin.site.register(models.PingSchedule)
+admin.site.register(models.ServiceMetric)
+admin.site.register(models.UptimeRollup)
+admin.site.register(models.RTTRollup)
+admin.site.register(models.DataUsageRollup)
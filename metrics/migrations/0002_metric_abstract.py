@@ -0,0 +1,111 @@
+# Metric used to be a concrete (multi-table inheritance) parent model, which
+# stops the syncs from writing metrics with bulk_create. Each metric type now
+# gets its own standalone table; existing rows are copied over.
+
+import macaddress.fields
+from django.db import migrations, models
+
+METRIC_FIELDS = {
+    "DataUsageMetric": ["tx_bytes", "rx_bytes"],
+    "FailuresMetric": [
+        "tx_packets",
+        "rx_packets",
+        "tx_dropped",
+        "rx_dropped",
+        "tx_retries",
+        "tx_errors",
+        "rx_errors",
+    ],
+    "ResourcesMetric": ["memory", "cpu"],
+    "RTTMetric": ["rtt_min", "rtt_avg", "rtt_max"],
+    "UptimeMetric": ["reachable", "loss"],
+}
+BATCH_SIZE = 1000
+
+
+def copy_metrics(apps, schema_editor):
+    """Copy metrics from the old inherited tables to the standalone tables."""
+    db_alias = schema_editor.connection.alias
+    for name, fields in METRIC_FIELDS.items():
+        OldMetric = apps.get_model("metrics", f"Old{name}")
+        NewMetric = apps.get_model("metrics", name)
+        batch = []
+        for old in OldMetric.objects.using(db_alias).order_by("pk").iterator(BATCH_SIZE):
+            values = {f: getattr(old, f) for f in ["created", "mac", *fields]}
+            batch.append(NewMetric(**values))
+            if len(batch) >= BATCH_SIZE:
+                NewMetric.objects.using(db_alias).bulk_create(batch)
+                batch = []
+        NewMetric.objects.using(db_alias).bulk_create(batch)
+
+
+def metric_model(name, fields):
+    """Create a standalone metric table."""
+    return migrations.CreateModel(
+        name=name,
+        fields=[
+            ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+            ("created", models.DateTimeField()),
+            ("mac", macaddress.fields.MACAddressField(integer=True)),
+            *fields,
+        ],
+        options={
+            "ordering": ["created"],
+            "abstract": False,
+        },
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("metrics", "0001_initial"),
+    ]
+
+    operations = [
+        *[migrations.RenameModel(name, f"Old{name}") for name in METRIC_FIELDS],
+        metric_model(
+            "DataUsageMetric",
+            [
+                ("tx_bytes", models.BigIntegerField()),
+                ("rx_bytes", models.BigIntegerField()),
+            ],
+        ),
+        metric_model(
+            "FailuresMetric",
+            [
+                ("tx_packets", models.BigIntegerField()),
+                ("rx_packets", models.BigIntegerField()),
+                ("tx_dropped", models.IntegerField(blank=True, null=True)),
+                ("rx_dropped", models.IntegerField(blank=True, null=True)),
+                ("tx_retries", models.IntegerField(blank=True, null=True)),
+                ("tx_errors", models.IntegerField(blank=True, null=True)),
+                ("rx_errors", models.IntegerField(blank=True, null=True)),
+            ],
+        ),
+        metric_model(
+            "ResourcesMetric",
+            [
+                ("memory", models.FloatField()),
+                ("cpu", models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        metric_model(
+            "RTTMetric",
+            [
+                ("rtt_min", models.FloatField(blank=True, null=True)),
+                ("rtt_avg", models.FloatField(blank=True, null=True)),
+                ("rtt_max", models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        metric_model(
+            "UptimeMetric",
+            [
+                ("reachable", models.BooleanField()),
+                ("loss", models.IntegerField()),
+            ],
+        ),
+        migrations.RunPython(copy_metrics, migrations.RunPython.noop),
+        *[migrations.DeleteModel(f"Old{name}") for name in METRIC_FIELDS],
+        migrations.DeleteModel("Metric"),
+    ]
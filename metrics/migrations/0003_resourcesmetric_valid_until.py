@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0002_metric_abstract'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resourcesmetric',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0003_resourcesmetric_valid_until'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PingSweep',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('chunks', models.IntegerField(default=0)),
+                ('nodes', models.IntegerField(default=0)),
+                ('reachable', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:46
+
+import macaddress.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0004_pingsweep'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PingSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mac', macaddress.fields.MACAddressField(integer=True, unique=True)),
+                ('reachable', models.BooleanField()),
+                ('changed', models.DateTimeField()),
+                ('next_ping', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0005_pingschedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingsweep',
+            name='suppressed',
+            field=models.IntegerField(default=0),
+        ),
+    ]
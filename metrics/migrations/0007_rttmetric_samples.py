@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0006_pingsweep_suppressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rttmetric',
+            name='samples',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
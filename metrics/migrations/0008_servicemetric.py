@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0007_rttmetric_samples'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField()),
+                ('service_id', models.IntegerField(db_index=True)),
+                ('url', models.URLField(max_length=100)),
+                ('up', models.BooleanField()),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('error', models.CharField(blank=True, max_length=200)),
+                ('reused', models.BooleanField(default=False)),
+                ('connect_time', models.FloatField(blank=True, null=True)),
+                ('tls_time', models.FloatField(blank=True, null=True)),
+                ('first_byte_time', models.FloatField(blank=True, null=True)),
+                ('total_time', models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created'],
+            },
+        ),
+    ]
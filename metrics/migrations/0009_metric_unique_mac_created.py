@@ -0,0 +1,50 @@
+# Metrics become unique per (mac, created). The syncs used to look metrics
+# up by created alone, so duplicates are deleted first, keeping the latest
+# row of each (mac, created).
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+METRICS = ["DataUsageMetric", "FailuresMetric", "ResourcesMetric", "RTTMetric", "UptimeMetric"]
+
+
+def delete_duplicates(apps, schema_editor):
+    """Delete all but the latest metric of each type with the same mac and created."""
+    db_alias = schema_editor.connection.alias
+    for name in METRICS:
+        Metric = apps.get_model("metrics", name)
+        qs = Metric.objects.using(db_alias)
+        duplicates = qs.values("mac", "created").annotate(n=Count("pk"), keep=Max("pk")).filter(n__gt=1)
+        for duplicate in duplicates.iterator():
+            qs.filter(mac=duplicate["mac"], created=duplicate["created"]).exclude(pk=duplicate["keep"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0008_servicemetric'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='datausagemetric',
+            constraint=models.UniqueConstraint(fields=('mac', 'created'), name='metrics_datausagemetric_unique_mac_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='failuresmetric',
+            constraint=models.UniqueConstraint(fields=('mac', 'created'), name='metrics_failuresmetric_unique_mac_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='resourcesmetric',
+            constraint=models.UniqueConstraint(fields=('mac', 'created'), name='metrics_resourcesmetric_unique_mac_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='rttmetric',
+            constraint=models.UniqueConstraint(fields=('mac', 'created'), name='metrics_rttmetric_unique_mac_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='uptimemetric',
+            constraint=models.UniqueConstraint(fields=('mac', 'created'), name='metrics_uptimemetric_unique_mac_created'),
+        ),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:56
+
+import macaddress.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0009_metric_unique_mac_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField()),
+                ('mac', macaddress.fields.MACAddressField(integer=True)),
+                ('resolution', models.IntegerField(choices=[(300, '5m'), (3600, '1h'), (86400, '1d')])),
+                ('count', models.IntegerField()),
+                ('tx_bytes', models.BigIntegerField()),
+                ('rx_bytes', models.BigIntegerField()),
+            ],
+            options={
+                'ordering': ['created'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='RTTRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField()),
+                ('mac', macaddress.fields.MACAddressField(integer=True)),
+                ('resolution', models.IntegerField(choices=[(300, '5m'), (3600, '1h'), (86400, '1d')])),
+                ('count', models.IntegerField()),
+                ('rtt_min', models.FloatField(blank=True, null=True)),
+                ('rtt_avg', models.FloatField(blank=True, null=True)),
+                ('rtt_max', models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='UptimeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField()),
+                ('mac', macaddress.fields.MACAddressField(integer=True)),
+                ('resolution', models.IntegerField(choices=[(300, '5m'), (3600, '1h'), (86400, '1d')])),
+                ('count', models.IntegerField()),
+                ('reachable', models.FloatField()),
+                ('loss', models.FloatField()),
+            ],
+            options={
+                'ordering': ['created'],
+                'abstract': False,
+            },
+        ),
+        migrations.AlterField(
+            model_name='datausagemetric',
+            name='created',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='failuresmetric',
+            name='created',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='resourcesmetric',
+            name='created',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='rttmetric',
+            name='created',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='uptimemetric',
+            name='created',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddConstraint(
+            model_name='datausagerollup',
+            constraint=models.UniqueConstraint(fields=('resolution', 'mac', 'created'), name='metrics_datausagerollup_unique_resolution_mac_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='rttrollup',
+            constraint=models.UniqueConstraint(fields=('resolution', 'mac', 'created'), name='metrics_rttrollup_unique_resolution_mac_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='uptimerollup',
+            constraint=models.UniqueConstraint(fields=('resolution', 'mac', 'created'), name='metrics_uptimerollup_unique_resolution_mac_created'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:27
+# Existing RTT rollups averaged pings without replies as if they had an RTT.
+# They are deleted, so that the next rollup run rebuilds them from scratch.
+
+from django.db import migrations, models
+
+
+def delete_rtt_rollups(apps, schema_editor):
+    """Delete the RTT rollups, which were weighted by the wrong counts."""
+    RTTRollup = apps.get_model("metrics", "RTTRollup")
+    RTTRollup.objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0010_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rttrollup',
+            name='rtt_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(delete_rtt_rollups, migrations.RunPython.noop),
+    ]
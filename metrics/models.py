@@ -1,34 +1,79 @@
+from copy import copy
+from datetime import datetime, timedelta
+
 from django.db import models
 from django.utils import timezone
 from macaddress.fields import MACAddressField
 
 
 class Metric(models.Model):
-    """Base class for Metric objects."""
+    """Base class for Metric objects.
+
+    A node has at most one metric of each type at a time. The unique
+    (mac, created) constraint is also the index used to query a node's
+    metrics over time.
+    """
 
     class Meta:
         """Metric metadata."""
 
+        abstract = True
         ordering = ["created"]
+        constraints = [
+            models.UniqueConstraint(fields=["mac", "created"], name="%(app_label)s_%(class)s_unique_mac_created"),
+        ]
 
     def save(self, *args, **kwargs):
         if self.created is None:
             self.created = timezone.now()
         super().save(*args, **kwargs)
 
-    created = models.DateTimeField()
+    created = models.DateTimeField(db_index=True)
     mac = MACAddressField()
 
 
 class ResourcesMetric(Metric):
-    """Metric for system resources (memor, cpu usage)."""
+    """Metric for system resources (memor, cpu usage).
+
+    Synced samples may only be stored when they change, in which case
+    valid_until is the last time that the same values were seen.
+    """
 
     memory = models.FloatField()
     cpu = models.FloatField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return f"Metric: Resources [{self.created}]"
 
+    def is_close(self, memory: float, cpu: float | None, tolerance: float) -> bool:
+        """Check whether memory and cpu are within tolerance of this sample's values."""
+        if (self.cpu is None) != (cpu is None):
+            return False
+        if cpu is not None and abs(self.cpu - cpu) > tolerance:
+            return False
+        return abs(self.memory - memory) <= tolerance
+
+    def expand(self, interval: timedelta, after: datetime | None = None) -> list["ResourcesMetric"]:
+        """Expand this sample into a point every interval until it's no longer valid.
+
+        The points are unsaved copies of this sample. Only points after the
+        given time are returned.
+        """
+        times = [self.created]
+        if self.valid_until is not None:
+            while times[-1] + interval < self.valid_until:
+                times.append(times[-1] + interval)
+            if self.valid_until > self.created:
+                times.append(self.valid_until)
+        points = []
+        for time in times:
+            if after is None or time > after:
+                point = copy(self)
+                point.created = time
+                points.append(point)
+        return points
+
 
 class UptimeMetric(Metric):
     """Metric for uptime, gathered during periodic pings."""
@@ -46,6 +91,8 @@ class RTTMetric(Metric):
     rtt_min = models.FloatField(null=True, blank=True)
     rtt_avg = models.FloatField(null=True, blank=True)
     rtt_max = models.FloatField(null=True, blank=True)
+    # Per-packet round trip times of the ping, packed by metrics.rtt.pack_samples
+    samples = models.BinaryField(null=True, blank=True)
 
     def __str__(self):
         return f"Metric: RTT [{self.created}]"
@@ -74,3 +121,144 @@ class FailuresMetric(Metric):
 
     def __str__(self):
         return f"Metric: Failures [{self.created}]"
+
+
+class Rollup(models.Model):
+    """Base class for aggregates of a node's metrics per time bucket, see metrics.rollups.
+
+    created is the start of the bucket, and resolution its length in
+    seconds. Subclasses aggregate the fields of their metric as given by
+    AGGREGATES, which is one of min, max, avg or sum per field. Averages of
+    nullable fields are weighted by the number of metrics that had a value,
+    which is stored in the field that WEIGHTS maps them to.
+    """
+
+    RESOLUTIONS = [(300, "5m"), (3600, "1h"), (86400, "1d")]
+
+    metric: type[Metric]
+    AGGREGATES: dict[str, str]
+    WEIGHTS: dict[str, str] = {}
+
+    created = models.DateTimeField()
+    mac = MACAddressField()
+    resolution = models.IntegerField(choices=RESOLUTIONS)
+    # Number of metrics in the bucket
+    count = models.IntegerField()
+
+    class Meta:
+        """Rollup metadata."""
+
+        abstract = True
+        ordering = ["created"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["resolution", "mac", "created"],
+                name="%(app_label)s_%(class)s_unique_resolution_mac_created",
+            ),
+        ]
+
+
+class UptimeRollup(Rollup):
+    """Rollup of UptimeMetrics, reachable is the fraction of pings that got a reply."""
+
+    metric = UptimeMetric
+    AGGREGATES = {"reachable": "avg", "loss": "avg"}
+
+    reachable = models.FloatField()
+    loss = models.FloatField()
+
+    def __str__(self):
+        return f"Rollup: Uptime [{self.created}]"
+
+
+class RTTRollup(Rollup):
+    """Rollup of RTTMetrics."""
+
+    metric = RTTMetric
+    AGGREGATES = {"rtt_min": "min", "rtt_avg": "avg", "rtt_max": "max"}
+    WEIGHTS = {"rtt_avg": "rtt_count"}
+
+    rtt_min = models.FloatField(null=True, blank=True)
+    rtt_avg = models.FloatField(null=True, blank=True)
+    rtt_max = models.FloatField(null=True, blank=True)
+    # Number of metrics in the bucket with an RTT, pings without replies have none
+    rtt_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Rollup: RTT [{self.created}]"
+
+
+class DataUsageRollup(Rollup):
+    """Rollup of DataUsageMetrics."""
+
+    metric = DataUsageMetric
+    AGGREGATES = {"tx_bytes": "sum", "rx_bytes": "sum"}
+
+    tx_bytes = models.BigIntegerField()
+    rx_bytes = models.BigIntegerField()
+
+    def __str__(self):
+        return f"Rollup: Bytes [{self.created}]"
+
+
+class PingSweep(models.Model):
+    """A single sweep of pings to all nodes, split into subtasks."""
+
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    chunks = models.IntegerField(default=0)
+    nodes = models.IntegerField(default=0)
+    reachable = models.IntegerField(default=0)
+    # Nodes that weren't pinged because they're behind an unreachable node
+    suppressed = models.IntegerField(default=0)
+
+    class Meta:
+        """PingSweep metadata."""
+
+        ordering = ["-started"]
+
+    def __str__(self):
+        return f"Ping sweep of {self.nodes} nodes [{self.started}]"
+
+
+class PingSchedule(models.Model):
+    """When a node is pinged next, see metrics.scheduling."""
+
+    mac = MACAddressField(unique=True)
+    reachable = models.BooleanField()
+    # When the node's reachability last changed
+    changed = models.DateTimeField()
+    next_ping = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Ping schedule: {self.mac} [{self.next_ping}]"
+
+
+class ServiceMetric(models.Model):
+    """Metric for a service's health, gathered during periodic probes.
+
+    Phase times are in ms, and are null for phases that didn't happen, e.g.
+    connect and tls on a reused connection, or tls for plain HTTP.
+    """
+
+    created = models.DateTimeField()
+    # A monitoring.Service, which lives in the default database
+    service_id = models.IntegerField(db_index=True)
+    url = models.URLField(max_length=100)
+    up = models.BooleanField()
+    status_code = models.IntegerField(null=True, blank=True)
+    error = models.CharField(max_length=200, blank=True)
+    reused = models.BooleanField(default=False)
+    connect_time = models.FloatField(null=True, blank=True)
+    tls_time = models.FloatField(null=True, blank=True)
+    first_byte_time = models.FloatField(null=True, blank=True)
+    total_time = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        """ServiceMetric metadata."""
+
+        ordering = ["created"]
+
+    def __str__(self):
+        return f"Metric: Service {self.url} [{self.created}]"
@@ -1,37 +1,331 @@
+import abc
+import asyncio
+import random
+import re
+import socket
+import struct
 import subprocess
+from typing import Iterable
 
+from django.conf import settings
+from django.utils.module_loading import import_string
 
-def ping(ip: str,
-         count: int = 5,
-         interval: int = 25,
-         nbytes: int = 56,
-         timeout: int = 800) -> dict:
+# Per-target summary that fping -q -c prints on stderr, e.g.
+# "10.0.0.1 : xmt/rcv/%loss = 5/4/20%, min/avg/max = 0.31/0.42/0.58"
+# Unreachable targets have no min/avg/max.
+SUMMARY_RE = re.compile(
+    r"^(?P<target>\S+)\s*:\s*xmt/rcv/%loss = \d+/\d+/(?P<loss>[\d.]+)%"
+    r"(?:, min/avg/max = (?P<min>[\d.]+)/(?P<avg>[\d.]+)/(?P<max>[\d.]+))?\s*$"
+)
+# Per-packet round trip times that fping -q -C prints on stderr, with "-" for
+# lost packets, e.g. "10.0.0.1 : 0.31 0.42 - 0.58 0.40"
+SAMPLES_RE = re.compile(r"^(?P<target>\S+)\s*:\s*(?P<samples>(?:[\d.]+|-)(?:\s+(?:[\d.]+|-))*)\s*$")
+
+
+def parse_summary(line: str) -> tuple[str, dict] | None:
+    """Parse a target's fping summary line, or return None if it isn't one."""
+    match = SUMMARY_RE.match(line.strip())
+    if match is None:
+        return None
+    loss = float(match["loss"])
+    result = {"reachable": int(loss < 100), "loss": loss}
+    if result["reachable"] and match["avg"] is not None:
+        result["rtt"] = {
+            "rtt_min": float(match["min"]),
+            "rtt_avg": float(match["avg"]),
+            "rtt_max": float(match["max"]),
+        }
+    return match["target"], result
+
+
+def parse_samples(line: str) -> tuple[str, dict] | None:
+    """Parse a target's fping per-packet line, or return None if it isn't one."""
+    match = SAMPLES_RE.match(line.strip())
+    if match is None:
+        return None
+    samples = [None if rtt == "-" else float(rtt) for rtt in match["samples"].split()]
+    return match["target"], summarize(samples)
+
+
+def parse_output(output: str) -> dict[str, dict]:
+    """Parse the summaries of all targets in fping's output, by target.
+
+    Both the statistics of fping -c and the per-packet lines of fping -C are
+    understood, only the latter include the samples. Other lines, e.g. ICMP errors or unresolvable targets, are ignored.
+    """
+    results = {}
+    for line in output.splitlines():
+        summary = parse_summary(line) or parse_samples(line)
+        if summary is not None:
+            target, result = summary
+            results[target] = result
+    return results
+
+
+def fping(targets: list[str],
+          count: int,
+          interval: int,
+          nbytes: int,
+          timeout: int,
+          gap: int | None = None) -> str:
+    """Run fping against targets, returning its per-packet output."""
     command = [
         "/bin/fping",
         "-e",  # show elapsed (round-trip) time of packets
-        "-c %s" % count,  # count of pings to send to each target,
+        "-C %s" % count,  # count of pings to send to each target, reporting each one
         "-p %s" % interval,  # interval between sending pings(in ms)
         "-b %s" % nbytes,  # amount of ping data to send
         "-t %s" % timeout,  # individual target initial timeout (in ms)
         "-q",
-        ip,
     ]
-    p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if gap is not None:
+        command.append("-i %s" % gap)  # interval between pings to any target (in ms)
+    p = subprocess.run(command + targets, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     # fpings shows statistics on stderr
-    output = p.stderr.decode("utf-8")
-    try:
-        parts = output.split("=")
-        if len(parts) > 2:
-            min, avg, max = parts[-1].strip().split("/")
-            i = -2
-        else:
-            i = -1
-        loss_str = parts[i].strip().split(",")[0].split("/")[2]
-        loss = float(loss_str.strip("%"))
-    except (IndexError, ValueError) as e:
+    return p.stderr.decode("utf-8")
+
+
+def ping(ip: str,
+         count: int = 5,
+         interval: int = 25,
+         nbytes: int = 56,
+         timeout: int = 800) -> dict:
+    output = fping([ip], count, interval, nbytes, timeout)
+    summary = parse_output(output).get(ip)
+    if summary is None:
         message = "Unrecognized fping output:\n\n{0}".format(output)
-        raise ValueError(message) from e
-    result = {"reachable": int(loss < 100), "loss": loss}
-    if result["reachable"]:
-        result["rtt"] = {"rtt_min": float(min), "rtt_avg": float(avg), "rtt_max": float(max)}
-    return result
+        raise ValueError(message)
+    return summary
+
+
+def ping_many(ips: Iterable[str],
+              count: int = 5,
+              interval: int = 25,
+              nbytes: int = 56,
+              timeout: int = 800,
+              gap: int = 1) -> dict[str, dict]:
+    """Ping all ips with a single fping process, returning the results by ip.
+
+    fping pings the targets in parallel, so this takes about as long as
+    pinging a single target, as long as gap * len(ips) stays below interval.
+    Targets that fping didn't print a summary for (e.g. invalid addresses)
+    are left out.
+    """
+    ips = sorted(set(ips))
+    if not ips:
+        return {}
+    output = fping(ips, count, interval, nbytes, timeout, gap)
+    results = parse_output(output)
+    return {ip: results[ip] for ip in ips if ip in results}
+
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct("!BBHHH")
+
+
+def checksum(data: bytes) -> int:
+    """Internet checksum of an ICMP packet."""
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def echo_packet(icmp_type: int, ident: int, seq: int, payload: bytes) -> bytes:
+    """Build an ICMP echo request or reply packet."""
+    header = ICMP_HEADER.pack(icmp_type, 0, 0, ident, seq)
+    return ICMP_HEADER.pack(icmp_type, 0, checksum(header + payload), ident, seq) + payload
+
+
+def parse_echo(packet: bytes) -> tuple[int, int] | None:
+    """Get the (type, sequence number) of an ICMP echo packet, or None if it isn't one."""
+    if len(packet) < ICMP_HEADER.size:
+        return None
+    icmp_type, code, _, _, seq = ICMP_HEADER.unpack_from(packet)
+    if icmp_type not in (ICMP_ECHO_REQUEST, ICMP_ECHO_REPLY) or code != 0:
+        return None
+    return icmp_type, seq
+
+
+def summarize(samples: list[float | None]) -> dict:
+    """Summarize the per-packet round trip times (in ms) of a ping, None for lost packets, like fping does.
+
+    Unlike fping's summary, pings that got no replies have an rtt too, whose
+    min/avg/max are None, so that their lost samples are kept.
+    """
+    rtts = [rtt for rtt in samples if rtt is not None]
+    loss = 100 * (len(samples) - len(rtts)) / len(samples)
+    return {
+        "reachable": int(loss < 100),
+        "loss": loss,
+        "rtt": {
+            "rtt_min": min(rtts, default=None),
+            "rtt_avg": sum(rtts) / len(rtts) if rtts else None,
+            "rtt_max": max(rtts, default=None),
+            "samples": samples,
+        },
+    }
+
+
+class Prober(abc.ABC):
+    """Pings a set of targets, returning fping-like results by IP."""
+
+    @abc.abstractmethod
+    def probe(self,
+              ips: Iterable[str],
+              count: int = 5,
+              interval: int = 25,
+              nbytes: int = 56,
+              timeout: int = 800) -> dict[str, dict]:
+        ...
+
+
+class FpingProber(Prober):
+    """Prober that runs a single fping process for all targets."""
+
+    def probe(self, ips, count=5, interval=25, nbytes=56, timeout=800):
+        return ping_many(ips, count, interval, nbytes, timeout)
+
+
+class ICMPEndpoint(asyncio.DatagramProtocol):
+    """Unprivileged ICMP datagram socket.
+
+    Linux only allows these for groups in the net.ipv4.ping_group_range
+    sysctl. The kernel sets the echo identifier, and only delivers the
+    replies to this socket's requests to it.
+    """
+
+    def __init__(self):
+        self.transport: asyncio.DatagramTransport | None = None
+        self.replies: asyncio.Queue[tuple[bytes, str]] = asyncio.Queue()
+
+    @classmethod
+    async def open(cls) -> "ICMPEndpoint":
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except PermissionError as e:
+            raise PermissionError("Unprivileged ICMP sockets aren't allowed, see net.ipv4.ping_group_range") from e
+        _, endpoint = await asyncio.get_running_loop().create_datagram_endpoint(cls, sock=sock)
+        return endpoint
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.replies.put_nowait((data, addr[0]))
+
+    async def send(self, ip: str, packet: bytes) -> None:
+        self.transport.sendto(packet, (ip, 0))
+
+    async def receive(self) -> tuple[bytes, str]:
+        return await self.replies.get()
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class ICMPNetwork:
+    """Network that pings through unprivileged ICMP datagram sockets."""
+
+    async def open(self) -> ICMPEndpoint:
+        return await ICMPEndpoint.open()
+
+
+class Pacer:
+    """Space sends to all targets at rate per second, jittered so they don't synchronize."""
+
+    def __init__(self, rate: float, jitter: float = 0.5):
+        self.period = 1 / rate
+        self.jitter = jitter
+        self.next_time = 0.0
+
+    async def wait(self) -> None:
+        """Wait for the next send slot."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        send_time = max(now, self.next_time)
+        self.next_time = send_time + self.period * random.uniform(1 - self.jitter, 1 + self.jitter)
+        if send_time > now:
+            await asyncio.sleep(send_time - now)
+
+
+class ICMPProber(Prober):
+    """Prober that pings all targets from a single asyncio event loop.
+
+    At most concurrency targets are pinged at a time, and echo requests to
+    all targets are paced to rate per second. Each target gets count
+    requests, interval ms apart, and a reply counts if it arrives within
+    timeout ms of its request.
+    """
+
+    def __init__(self, network=None, concurrency: int | None = None, rate: float | None = None):
+        self.network = network or ICMPNetwork()
+        self.concurrency = concurrency or settings.PING_CONCURRENCY
+        self.rate = rate or settings.PING_SEND_RATE
+
+    def probe(self, ips, count=5, interval=25, nbytes=56, timeout=800):
+        return asyncio.run(self.aprobe(ips, count, interval, nbytes, timeout))
+
+    async def aprobe(self, ips, count=5, interval=25, nbytes=56, timeout=800) -> dict[str, dict]:
+        """Ping all ips concurrently, returning the results by ip."""
+        ips = sorted(set(ips))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pacer = Pacer(self.rate)
+
+        async def probe_ip(ip):
+            async with semaphore:
+                return await self.probe_target(ip, pacer, count, interval, nbytes, timeout)
+
+        results = await asyncio.gather(*(probe_ip(ip) for ip in ips))
+        return dict(zip(ips, results))
+
+    async def probe_target(self, ip: str, pacer: Pacer, count: int, interval: int, nbytes: int, timeout: int) -> dict:
+        """Ping a single target."""
+        loop = asyncio.get_running_loop()
+        endpoint = await self.network.open()
+        sent: dict[int, float] = {}
+        rtts: dict[int, float] = {}
+        answered = asyncio.Event()
+
+        async def receive():
+            while True:
+                packet, source = await endpoint.receive()
+                echo = parse_echo(packet)
+                if source != ip or echo is None or echo[0] != ICMP_ECHO_REPLY or echo[1] not in sent:
+                    continue
+                rtt = (loop.time() - sent[echo[1]]) * 1000
+                if rtt <= timeout:
+                    rtts.setdefault(echo[1], rtt)
+                if len(rtts) == count:
+                    answered.set()
+
+        receiver = loop.create_task(receive())
+        try:
+            ident = random.getrandbits(16)
+            payload = bytes(nbytes)
+            for seq in range(count):
+                if seq:
+                    await asyncio.sleep(interval / 1000)
+                await pacer.wait()
+                sent[seq] = loop.time()
+                try:
+                    await endpoint.send(ip, echo_packet(ICMP_ECHO_REQUEST, ident, seq, payload))
+                except OSError:
+                    # e.g. no route to the host, the request is lost
+                    pass
+            try:
+                await asyncio.wait_for(answered.wait(), timeout / 1000)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            receiver.cancel()
+            endpoint.close()
+        return summarize([rtts.get(seq) for seq in range(count)])
+
+
+def get_prober() -> Prober:
+    """Get the prober configured by settings.PING_PROBER."""
+    return import_string(settings.PING_PROBER)()
@@ -0,0 +1,135 @@
+"""Build rollups of metrics at multiple resolutions.
+
+Each resolution is built from the next finer one, 5 minute rollups from the
+metrics themselves. Runs resume from the last rolled up bucket, minus
+ROLLUP_OVERLAP to pick up metrics that were synced late.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Max, Min, QuerySet, Value
+
+from .models import DataUsageRollup, Rollup, RTTRollup, UptimeRollup
+
+ROLLUP_MODELS: list[type[Rollup]] = [UptimeRollup, RTTRollup, DataUsageRollup]
+# Resolutions in seconds, from fine to coarse
+RESOLUTIONS = [seconds for seconds, _ in Rollup.RESOLUTIONS]
+# Metrics are read and rolled up a day at a time
+WINDOW = timedelta(days=1)
+
+
+def bucket_start(time: datetime, resolution: int) -> datetime:
+    """Start of the bucket that time falls in, buckets are aligned to the (UTC) epoch."""
+    return datetime.fromtimestamp(time.timestamp() // resolution * resolution, timezone.utc)
+
+
+class Bucket:
+    """Running aggregates of the rows that fall in a bucket."""
+
+    def __init__(self, aggregates: dict[str, str]):
+        self.aggregates = aggregates
+        self.count = 0
+        self.values: dict[str, float | None] = dict.fromkeys(aggregates)
+        # Weighted totals and their weights, for averages
+        self.totals: dict[str, float] = dict.fromkeys(aggregates, 0)
+        self.weights: dict[str, int] = dict.fromkeys(aggregates, 0)
+
+    def add(self, count: int, values: dict, weights: dict[str, int] | None = None) -> None:
+        """Add a metric (count 1) or the rollup of count metrics.
+
+        Averages are weighted by count, unless weights gives the number of
+        metrics that had a value (see Rollup.WEIGHTS).
+        """
+        self.count += count
+        for name, aggregate in self.aggregates.items():
+            value = values[name]
+            if value is None:
+                continue
+            current = self.values[name]
+            if aggregate == "min":
+                self.values[name] = value if current is None else min(current, value)
+            elif aggregate == "max":
+                self.values[name] = value if current is None else max(current, value)
+            elif aggregate == "sum":
+                self.values[name] = value if current is None else current + value
+            else:
+                weight = (weights or {}).get(name, count)
+                self.totals[name] += value * weight
+                self.weights[name] += weight
+                if self.weights[name]:
+                    self.values[name] = self.totals[name] / self.weights[name]
+
+
+def get_source(model: type[Rollup], resolution: int) -> QuerySet:
+    """The metrics or finer rollups that a resolution is built from."""
+    if resolution == RESOLUTIONS[0]:
+        return model.metric.objects.all()
+    return model.objects.filter(resolution=RESOLUTIONS[RESOLUTIONS.index(resolution) - 1])
+
+
+def roll_up_window(model: type[Rollup], resolution: int, start: datetime, end: datetime) -> int:
+    """Replace the rollups of buckets in [start, end), returning how many were stored."""
+    fields = list(model.AGGREGATES)
+    source = get_source(model, resolution).filter(created__gte=start, created__lt=end).order_by()
+    if source.model is model:
+        rows = source.values_list("mac", "created", "count", *fields, *model.WEIGHTS.values())
+    else:
+        # Each metric has a weight of 1 (or 0 without a value), its count
+        rows = source.annotate(count=Value(1)).values_list("mac", "created", "count", *fields)
+    buckets: dict[tuple, Bucket] = {}
+    for mac, created, count, *values in rows.iterator(settings.ROLLUP_BATCH_SIZE):
+        key = (mac, bucket_start(created, resolution))
+        if key not in buckets:
+            buckets[key] = Bucket(model.AGGREGATES)
+        # Only rollups have weights, after their aggregates
+        buckets[key].add(count, dict(zip(fields, values)), dict(zip(model.WEIGHTS, values[len(fields):])))
+    rollups = [
+        model(
+            mac=mac,
+            created=created,
+            resolution=resolution,
+            count=bucket.count,
+            **bucket.values,
+            **{field: bucket.weights[name] for name, field in model.WEIGHTS.items()},
+        )
+        for (mac, created), bucket in buckets.items()
+    ]
+    qs = model.objects.filter(resolution=resolution, created__gte=start, created__lt=end)
+    with transaction.atomic(using=router.db_for_write(model)):
+        qs.delete()
+        model.objects.bulk_create(rollups, settings.ROLLUP_BATCH_SIZE)
+    return len(rollups)
+
+
+def roll_up(model: type[Rollup], resolution: int, full: bool = False) -> int:
+    """Roll up a resolution from the last rolled up bucket, or from scratch if full.
+
+    Returns the number of rollups that were stored.
+    """
+    last = None
+    if not full:
+        last = model.objects.filter(resolution=resolution).aggregate(last=Max("created"))["last"]
+    start = None if last is None else bucket_start(last - settings.ROLLUP_OVERLAP, resolution)
+    source = get_source(model, resolution)
+    stored = 0
+    while True:
+        # Skip ahead to the bucket of the next source row, there may be gaps
+        remaining = source if start is None else source.filter(created__gte=start)
+        next_created = remaining.aggregate(next=Min("created"))["next"]
+        if next_created is None:
+            return stored
+        start = bucket_start(next_created, resolution)
+        # WINDOW is a multiple of every resolution, so windows don't split buckets
+        stored += roll_up_window(model, resolution, start, start + WINDOW)
+        start += WINDOW
+
+
+def roll_up_all(full: bool = False) -> dict[str, int]:
+    """Roll up all metrics at all resolutions, returning the number of rollups stored by model and resolution."""
+    counts = {}
+    for model in ROLLUP_MODELS:
+        for resolution in RESOLUTIONS:
+            counts[f"{model.__name__}.{resolution}"] = roll_up(model, resolution, full)
+    return counts
@@ -0,0 +1,62 @@
+"""Packed per-packet round trip times, and statistics over them."""
+
+import numpy as np
+
+# Samples are packed as little-endian float32 round trip times in ms, with
+# NaN for lost packets, so a 5 packet ping takes 20 bytes
+SAMPLE_DTYPE = np.dtype("<f4")
+
+
+def pack_samples(samples: list[float | None]) -> bytes:
+    """Pack a ping's per-packet round trip times, None for lost packets."""
+    return np.array([np.nan if rtt is None else rtt for rtt in samples], dtype=SAMPLE_DTYPE).tobytes()
+
+
+def unpack_samples(blob: bytes | None) -> np.ndarray:
+    """Unpack the round trip times packed by pack_samples."""
+    return np.frombuffer(blob or b"", dtype=SAMPLE_DTYPE)
+
+
+def get_stats(blobs: list[bytes | None]) -> dict:
+    """Compute statistics over the packed samples of a series of pings, in time order.
+
+    Jitter is the mean difference between consecutive replies of the same
+    ping. Loss bursts are runs of consecutive lost packets, which may span
+    pings, including pings that got no replies at all. Pings without samples
+    (e.g. from before they were stored, or by fping's summary output) are
+    skipped.
+    """
+    blobs = [blob or b"" for blob in blobs]
+    samples = unpack_samples(b"".join(blobs))
+    lost = np.isnan(samples)
+    rtts = samples[~lost].astype(np.float64)
+
+    # Differences between consecutive samples, NaN if either was lost. The
+    # differences between the last and first sample of two pings don't count.
+    diffs = np.abs(np.diff(samples.astype(np.float64)))
+    starts = np.cumsum([len(blob) // SAMPLE_DTYPE.itemsize for blob in blobs])[:-1]
+    same_ping = np.ones(len(diffs), dtype=bool)
+    same_ping[starts[(starts > 0) & (starts < len(samples))] - 1] = False
+    diffs = diffs[same_ping & ~np.isnan(diffs)]
+
+    # Bursts start where a lost packet follows a received one, and end where
+    # a received packet follows a lost one
+    edges = np.diff(np.concatenate(([0], lost.astype(np.int8), [0])))
+    bursts = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+    stats = {
+        "pings": sum(1 for blob in blobs if blob),
+        "packets": len(samples),
+        "lost": int(lost.sum()),
+        "loss": 100 * float(lost.mean()) if len(samples) else None,
+        "jitter": float(diffs.mean()) if len(diffs) else None,
+        "rtt_p50": None,
+        "rtt_p95": None,
+        "rtt_p99": None,
+        "loss_bursts": len(bursts),
+        "max_loss_burst": int(bursts.max()) if len(bursts) else 0,
+        "mean_loss_burst": float(bursts.mean()) if len(bursts) else None,
+    }
+    if len(rtts):
+        stats["rtt_p50"], stats["rtt_p95"], stats["rtt_p99"] = (float(p) for p in np.percentile(rtts, [50, 95, 99]))
+    return stats
@@ -0,0 +1,82 @@
+"""Adaptive ping scheduling.
+
+Each node is pinged again after an interval proportional to how long its
+reachability has been unchanged, within PING_MIN_INTERVAL and
+PING_MAX_INTERVAL. Flapping or recently changed nodes are pinged often,
+nodes that have been up (or down) for a long time rarely.
+"""
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import F, Q, Window
+from django.db.models.functions import Lag
+from django.utils.timezone import now
+
+from .models import PingSchedule, UptimeMetric
+
+
+def get_interval(changed: datetime, time: datetime) -> timedelta:
+    """Time until a node should be pinged again, given when its reachability last changed."""
+    interval = (time - changed) * settings.PING_INTERVAL_RATIO
+    return min(max(interval, settings.PING_MIN_INTERVAL), settings.PING_MAX_INTERVAL)
+
+
+def get_not_due_macs(time: datetime | None = None) -> set:
+    """MAC addresses of the nodes that aren't due to be pinged yet."""
+    time = time or now()
+    return set(PingSchedule.objects.filter(next_ping__gt=time).values_list("mac", flat=True))
+
+
+def get_down_macs() -> set:
+    """MAC addresses of the nodes that were unreachable when they were last pinged."""
+    return set(PingSchedule.objects.filter(reachable=False).values_list("mac", flat=True))
+
+
+def get_last_changes(reachable_by_mac: dict, time: datetime) -> dict:
+    """When each node's reachability last changed, according to its uptime history.
+
+    A single query reads the history of all the nodes, keeping only the
+    metrics whose reachability differs from the node's previous metric.
+    """
+    changes = (
+        UptimeMetric.objects.filter(mac__in=list(reachable_by_mac), created__lt=time)
+        .annotate(previous=Window(Lag("reachable"), partition_by=F("mac"), order_by=F("created").asc()))
+        .filter(Q(previous__isnull=True) | ~Q(previous=F("reachable")))
+        .order_by("created")
+        .values_list("mac", "reachable", "created")
+    )
+    # Later changes replace earlier ones
+    last_changes = {mac: (reachable, created) for mac, reachable, created in changes}
+    to_mac = UptimeMetric._meta.get_field("mac").to_python
+    result = {}
+    for mac, reachable in reachable_by_mac.items():
+        last_reachable, changed = last_changes.get(to_mac(mac), (None, time))
+        # If it was different before this ping, it changed just now
+        result[mac] = changed if last_reachable == bool(reachable) else time
+    return result
+
+
+def update_schedules(reachable_by_mac: dict, time: datetime) -> None:
+    """Schedule the next ping of each pinged node, given whether it was reachable."""
+    to_mac = PingSchedule._meta.get_field("mac").to_python
+    schedules = {s.mac: s for s in PingSchedule.objects.filter(mac__in=list(reachable_by_mac))}
+    # Nodes pinged for the first time are scheduled from their uptime history
+    new = {mac: reachable for mac, reachable in reachable_by_mac.items() if to_mac(mac) not in schedules}
+    last_changes = get_last_changes(new, time) if new else {}
+    to_create = []
+    to_update = []
+    for mac, reachable in reachable_by_mac.items():
+        reachable = bool(reachable)
+        schedule = schedules.get(to_mac(mac))
+        if schedule is None:
+            schedule = PingSchedule(mac=mac, reachable=reachable, changed=last_changes[mac])
+            to_create.append(schedule)
+        else:
+            if schedule.reachable != reachable:
+                schedule.reachable = reachable
+                schedule.changed = time
+            to_update.append(schedule)
+        schedule.next_ping = time + get_interval(schedule.changed, time)
+    PingSchedule.objects.bulk_create(to_create, settings.PING_BATCH_SIZE)
+    PingSchedule.objects.bulk_update(to_update, ["reachable", "changed", "next_ping"], settings.PING_BATCH_SIZE)
@@ -1,6 +1,7 @@
-from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField
+from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField, SerializerMethodField
 
 from . import models
+from .rtt import unpack_samples
 
 
 class UptimeMetricSerializer(ModelSerializer):
@@ -38,12 +39,30 @@ class ResourcesMetricSerializer(ModelSerializer):
 class RTTMetricSerializer(ModelSerializer):
     """Serializes RTTMetric objects from django model to JSON."""
 
+    samples = SerializerMethodField()
+
     class Meta:
         """RTTMetricSerializer metadata."""
 
         model = models.RTTMetric
         fields = "__all__"
 
+    def get_samples(self, obj) -> list[float | None] | None:
+        """Unpack the per-packet round trip times, None for lost packets."""
+        if obj.samples is None:
+            return None
+        return [None if rtt != rtt else float(rtt) for rtt in unpack_samples(bytes(obj.samples))]
+
+
+class ServiceMetricSerializer(ModelSerializer):
+    """Serializes ServiceMetric objects from django model to JSON."""
+
+    class Meta:
+        """ServiceMetricSerializer metadata."""
+
+        model = models.ServiceMetric
+        fields = "__all__"
+
 
 class DataUsageMetricSerializer(ModelSerializer):
     """Serializes DataUsageMetric objects from django model to JSON."""
@@ -53,3 +72,33 @@ class DataUsageMetricSerializer(ModelSerializer):
 
         model = models.DataUsageMetric
         fields = "__all__"
+
+
+class UptimeRollupSerializer(ModelSerializer):
+    """Serializes UptimeRollup objects from django model to JSON."""
+
+    class Meta:
+        """UptimeRollupSerializer metadata."""
+
+        model = models.UptimeRollup
+        fields = "__all__"
+
+
+class RTTRollupSerializer(ModelSerializer):
+    """Serializes RTTRollup objects from django model to JSON."""
+
+    class Meta:
+        """RTTRollupSerializer metadata."""
+
+        model = models.RTTRollup
+        fields = "__all__"
+
+
+class DataUsageRollupSerializer(ModelSerializer):
+    """Serializes DataUsageRollup objects from django model to JSON."""
+
+    class Meta:
+        """DataUsageRollupSerializer metadata."""
+
+        model = models.DataUsageRollup
+        fields = "__all__"
@@ -1,19 +1,150 @@
-from celery import shared_task
+from collections import defaultdict
+from datetime import datetime
+
+from celery import chord, shared_task
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import router, transaction
+from django.utils.timezone import now
 
+from backend.locks import singleton_task
 from monitoring.models import Node
-from .models import UptimeMetric, RTTMetric
-from .ping import ping
+from monitoring.topology import get_unreachable_upstream
+from .models import PingSweep, UptimeMetric, RTTMetric
+from .ping import get_prober
+from .rollups import roll_up_all
+from .rtt import pack_samples
+from .scheduling import get_down_macs, get_not_due_macs, update_schedules
 
 logger = get_task_logger(__name__)
 
 
+def save_ping_results(macs_by_ip: dict[str, list], results: dict[str, dict], created) -> tuple[int, int]:
+    """Store the results of a ping sweep, all with the same created time.
+
+    The metrics are written in batches, in a single transaction. Returns the
+    number of nodes that were pinged, and how many of them were reachable.
+    """
+    uptime_metrics = []
+    rtt_metrics = []
+    reachable = 0
+    for ip, macs in macs_by_ip.items():
+        ping_data = results.get(ip)
+        if ping_data is None:
+            logger.warning(f"No ping results for {ip}")
+            continue
+        rtt_data = ping_data.pop("rtt", None)
+        if rtt_data and rtt_data.get("samples"):
+            rtt_data["samples"] = pack_samples(rtt_data["samples"])
+        for mac in macs:
+            uptime_metrics.append(UptimeMetric(mac=mac, created=created, **ping_data))
+            reachable += bool(ping_data["reachable"])
+            # Pings that got no replies may still have (lost) samples
+            if rtt_data:
+                rtt_metrics.append(RTTMetric(mac=mac, created=created, **rtt_data))
+    with transaction.atomic(using=router.db_for_write(UptimeMetric)):
+        UptimeMetric.objects.bulk_create(uptime_metrics, settings.PING_BATCH_SIZE)
+        RTTMetric.objects.bulk_create(rtt_metrics, settings.PING_BATCH_SIZE)
+    logger.info(f"PING {len(uptime_metrics)} nodes, {reachable} reachable")
+    return len(uptime_metrics), reachable
+
+
+def chunk_nodes(nodes_by_mesh: dict[str, list]) -> list[list]:
+    """Split each mesh's nodes into chunks of at most PING_CHUNK_SIZE."""
+    size = settings.PING_CHUNK_SIZE
+    return [nodes[i:i + size] for nodes in nodes_by_mesh.values() for i in range(0, len(nodes), size)]
+
+
+def get_sweep_chunks() -> tuple[list[list[tuple[str, str]]], list[list[tuple[str, str]]]]:
+    """Split the (mac, ip) of the gateways and other nodes that are due to be pinged into chunks per mesh."""
+    gateways_by_mesh = defaultdict(list)
+    nodes_by_mesh = defaultdict(list)
+    not_due = get_not_due_macs()
+    qs = Node.objects.filter(ip__isnull=False).exclude(ip="").order_by("mac")
+    for mesh, mac, ip, is_gateway in qs.values_list("mesh", "mac", "ip", "is_gateway"):
+        if mac not in not_due:
+            (gateways_by_mesh if is_gateway else nodes_by_mesh)[mesh].append((str(mac), ip))
+    return chunk_nodes(gateways_by_mesh), chunk_nodes(nodes_by_mesh)
+
+
+@shared_task
+def ping_nodes(nodes: list[tuple[str, str]], created: str) -> tuple[int, int]:
+    """Celery task to ping a chunk of a sweep's (mac, ip) nodes."""
+    macs_by_ip = defaultdict(list)
+    for mac, ip in nodes:
+        macs_by_ip[ip].append(mac)
+    # All nodes in the chunk are pinged at once
+    results = get_prober().probe(macs_by_ip)
+    reachable_by_mac = {
+        mac: results[ip]["reachable"] for ip, macs in macs_by_ip.items() if ip in results for mac in macs
+    }
+    counts = save_ping_results(macs_by_ip, results, datetime.fromisoformat(created))
+    update_schedules(reachable_by_mac, now())
+    return counts
+
+
 @shared_task
+def ping_downstream(results: list[tuple[int, int]], sweep_id: int, chunks: list[list[tuple[str, str]]]) -> None:
+    """Celery task to ping the rest of a sweep's nodes, once its gateways have been pinged.
+
+    Nodes that are only connected to the gateways through unreachable nodes
+    aren't pinged, and are marked as unreachable upstream instead.
+    """
+    sweep = PingSweep.objects.get(pk=sweep_id)
+    suppressed = get_unreachable_upstream(get_down_macs())
+    Node.objects.filter(mac__in=suppressed).update(unreachable_upstream=True)
+    Node.objects.filter(unreachable_upstream=True).exclude(mac__in=suppressed).update(unreachable_upstream=False)
+    sweep.suppressed = len(suppressed)
+    sweep.save(update_fields=["suppressed"])
+    to_mac = Node._meta.get_field("mac").to_python
+    chunks = [[(mac, ip) for mac, ip in chunk if to_mac(mac) not in suppressed] for chunk in chunks]
+    chunks = [chunk for chunk in chunks if chunk]
+    if not chunks:
+        finish_ping_sweep([], sweep_id, results)
+        return
+    # All results of the sweep share the time it started
+    header = [ping_nodes.s(chunk, sweep.started.isoformat()) for chunk in chunks]
+    chord(header)(finish_ping_sweep.s(sweep_id, results))
+
+
+@shared_task
+def finish_ping_sweep(results: list[tuple[int, int]], sweep_id: int, previous: list[tuple[int, int]] = ()) -> None:
+    """Celery task to record that all of a sweep's chunks have been pinged."""
+    results = [*previous, *results]
+    sweep = PingSweep.objects.get(pk=sweep_id)
+    sweep.finished = now()
+    sweep.duration = (sweep.finished - sweep.started).total_seconds()
+    sweep.chunks = len(results)
+    sweep.nodes = sum(nodes for nodes, _ in results)
+    sweep.reachable = sum(reachable for _, reachable in results)
+    sweep.save()
+    logger.info(f"Finished ping sweep of {sweep.nodes} nodes in {sweep.duration:.2f}s")
+
+
+@shared_task
+@singleton_task()
 def run_pings():
-    for device in Node.objects.filter(ip__isnull=False):
-        ping_data = ping(device.ip)
-        rtt_data = ping_data.pop("rtt", None)
-        UptimeMetric.objects.create(mac=device.mac, **ping_data)
-        if rtt_data:
-            RTTMetric.objects.create(mac=device.mac, **rtt_data)
-        logger.info(f"PING {device.ip}")
+    """Celery task to start a ping sweep of the nodes that are due, pinging each mesh in a separate subtask.
+
+    Gateways are pinged first, so that the nodes behind unreachable nodes
+    can be skipped.
+    """
+    unfinished = PingSweep.objects.filter(finished__isnull=True, started__gt=now() - settings.PING_SWEEP_TIMEOUT)
+    if unfinished.exists():
+        logger.warning("Skipping ping sweep, the previous sweep is still running")
+        return
+    sweep = PingSweep.objects.create()
+    gateway_chunks, chunks = get_sweep_chunks()
+    if not gateway_chunks:
+        ping_downstream([], sweep.pk, chunks)
+        return
+    header = [ping_nodes.s(chunk, sweep.started.isoformat()) for chunk in gateway_chunks]
+    chord(header)(ping_downstream.s(sweep.pk, chunks))
+
+
+@shared_task
+@singleton_task(coalesce=True)
+def run_rollups(full: bool = False) -> None:
+    """Celery task to roll up new metrics, or all metrics if full."""
+    counts = roll_up_all(full)
+    logger.info(f"Stored {sum(counts.values())} rollups")
@@ -1,3 +1,655 @@
-from django.test import TestCase
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from subprocess import CompletedProcess
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+from rest_framework.test import APIRequestFactory
+
+from backend import locks
+from backend.celery import app as celery_app
+from monitoring import signals
+from monitoring.models import Mesh, Node
+
+from . import tasks
+from .models import (
+    DataUsageMetric, DataUsageRollup, FailuresMetric, PingSchedule, PingSweep, ResourcesMetric, RTTMetric, RTTRollup, UptimeMetric,
+)
+from .ping import (
+    ICMP_ECHO_REPLY, ICMP_HEADER, ICMPProber, Prober, echo_packet, parse_echo, parse_output, ping, ping_many, summarize,
+)
+from .rollups import roll_up_all
+from .rtt import get_stats, pack_samples, unpack_samples
+from .scheduling import get_down_macs, get_interval, get_last_changes, get_not_due_macs, update_schedules
+from .views import ResourcesViewSet, RTTViewSet
+
+# fping -q -c 5 statistics output, as printed on stderr
+REACHABLE_OUTPUT = """\
+10.0.0.1 : xmt/rcv/%loss = 5/5/0%, min/avg/max = 0.31/0.42/0.58
+"""
+LOSSY_OUTPUT = """\
+10.0.0.2 : xmt/rcv/%loss = 5/3/40%, min/avg/max = 1.10/2.33/4.01
+"""
+UNREACHABLE_OUTPUT = """\
+10.0.0.3 : xmt/rcv/%loss = 5/0/100%
+"""
+# Multiple targets are padded to align, and may be interleaved with errors
+MULTI_TARGET_OUTPUT = """\
+ICMP Host Unreachable from 10.0.0.254 for ICMP Echo sent to 10.0.0.3
+ICMP Host Unreachable from 10.0.0.254 for ICMP Echo sent to 10.0.0.3
+10.0.0.1   : xmt/rcv/%loss = 5/5/0%, min/avg/max = 0.31/0.42/0.58
+10.0.0.2   : xmt/rcv/%loss = 5/3/40%, min/avg/max = 1.10/2.33/4.01
+10.0.0.3   : xmt/rcv/%loss = 5/0/100%
+10.0.0.100 : xmt/rcv/%loss = 5/1/80%, min/avg/max = 12.5/12.5/12.5
+"""
+UNRESOLVABLE_OUTPUT = """\
+not-a-host: Name or service not known
+"""
+# fping -q -C 5 per-packet output
+SAMPLES_OUTPUT = """\
+ICMP Host Unreachable from 10.0.0.254 for ICMP Echo sent to 10.0.0.3
+10.0.0.1 : 0.31 0.42 0.58 0.40 0.39
+10.0.0.2 : 1.10 - 2.33 - 4.01
+10.0.0.3 : - - - - -
+"""
+
+
+def fping_result(output: str) -> CompletedProcess:
+    return CompletedProcess([], 0, stdout=b"", stderr=output.encode())
+
+
+class ParseOutputTest(SimpleTestCase):
+    """Tests for parsing fping's statistics output."""
+
+    def test_reachable(self):
+        self.assertEqual(
+            parse_output(REACHABLE_OUTPUT),
+            {
+                "10.0.0.1": {
+                    "reachable": 1,
+                    "loss": 0.0,
+                    "rtt": {"rtt_min": 0.31, "rtt_avg": 0.42, "rtt_max": 0.58},
+                },
+            },
+        )
+
+    def test_lossy(self):
+        self.assertEqual(
+            parse_output(LOSSY_OUTPUT),
+            {
+                "10.0.0.2": {
+                    "reachable": 1,
+                    "loss": 40.0,
+                    "rtt": {"rtt_min": 1.10, "rtt_avg": 2.33, "rtt_max": 4.01},
+                },
+            },
+        )
+
+    def test_unreachable(self):
+        self.assertEqual(parse_output(UNREACHABLE_OUTPUT), {"10.0.0.3": {"reachable": 0, "loss": 100.0}})
+
+    def test_multi_target(self):
+        results = parse_output(MULTI_TARGET_OUTPUT)
+        self.assertEqual(list(results), ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.100"])
+        self.assertEqual(results["10.0.0.2"]["loss"], 40.0)
+        self.assertEqual(results["10.0.0.3"], {"reachable": 0, "loss": 100.0})
+        self.assertEqual(results["10.0.0.100"]["rtt"]["rtt_avg"], 12.5)
+
+    def test_unrecognized(self):
+        self.assertEqual(parse_output(UNRESOLVABLE_OUTPUT), {})
+
+    def test_samples(self):
+        results = parse_output(SAMPLES_OUTPUT)
+        self.assertEqual(list(results), ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        self.assertEqual(results["10.0.0.1"]["rtt"]["samples"], [0.31, 0.42, 0.58, 0.40, 0.39])
+        self.assertEqual(results["10.0.0.2"]["loss"], 40.0)
+        self.assertEqual(results["10.0.0.2"]["rtt"]["rtt_max"], 4.01)
+        self.assertEqual(results["10.0.0.2"]["rtt"]["samples"], [1.10, None, 2.33, None, 4.01])
+        # Pings without replies keep their lost samples
+        self.assertEqual(results["10.0.0.3"], {"reachable": 0, "loss": 100.0, "rtt": {"rtt_min": None, "rtt_avg": None, "rtt_max": None, "samples": [None] * 5}})
+
+
+class PingTest(SimpleTestCase):
+    """Tests for running fping."""
+
+    @patch("metrics.ping.subprocess.run", return_value=fping_result(MULTI_TARGET_OUTPUT))
+    def test_ping_many(self, run):
+        results = ping_many(["10.0.0.3", "10.0.0.1", "10.0.0.1", "10.0.0.4"])
+        # A single fping process pings every target once
+        run.assert_called_once()
+        self.assertEqual(run.call_args.args[0][-3:], ["10.0.0.1", "10.0.0.3", "10.0.0.4"])
+        self.assertEqual(sorted(results), ["10.0.0.1", "10.0.0.3"])
+
+    @patch("metrics.ping.subprocess.run", return_value=fping_result(UNRESOLVABLE_OUTPUT))
+    def test_ping_unrecognized(self, run):
+        with self.assertRaises(ValueError):
+            ping("not-a-host")
+
+
+@dataclass
+class FakeHost:
+    """Host on a FakeNetwork, answering after rtt ms unless the request's sequence number is lost."""
+
+    rtt: float
+    lost: frozenset[int] = frozenset()
+
+
+class FakeEndpoint:
+    """Endpoint on a FakeNetwork."""
+
+    def __init__(self, network: "FakeNetwork"):
+        self.network = network
+        self.replies: asyncio.Queue[tuple[bytes, str]] = asyncio.Queue()
+
+    async def send(self, ip: str, packet: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        self.network.sent.append((loop.time(), ip))
+        host = self.network.hosts.get(ip)
+        echo = parse_echo(packet)
+        if host is None or echo is None or echo[1] in host.lost:
+            return
+        reply = echo_packet(ICMP_ECHO_REPLY, *ICMP_HEADER.unpack_from(packet)[3:], packet[ICMP_HEADER.size:])
+        loop.call_later(host.rtt / 1000, self.replies.put_nowait, (reply, ip))
+
+    async def receive(self) -> tuple[bytes, str]:
+        return await self.replies.get()
+
+    def close(self) -> None:
+        self.network.open_endpoints -= 1
+
+
+class FakeNetwork:
+    """In-memory network of FakeHosts by IP. Other IPs don't answer."""
+
+    def __init__(self, hosts: dict[str, FakeHost]):
+        self.hosts = hosts
+        # (loop time, ip) of every request that was sent
+        self.sent: list[tuple[float, str]] = []
+        self.open_endpoints = 0
+        self.max_open_endpoints = 0
+
+    async def open(self) -> FakeEndpoint:
+        self.open_endpoints += 1
+        self.max_open_endpoints = max(self.max_open_endpoints, self.open_endpoints)
+        return FakeEndpoint(self)
+
+
+class ICMPProberTest(SimpleTestCase):
+    """Tests for the asyncio prober, on a fake network."""
+
+    def setUp(self):
+        self.network = FakeNetwork({
+            "10.0.0.1": FakeHost(rtt=5),
+            "10.0.0.2": FakeHost(rtt=20, lost=frozenset({1, 3})),
+            # Answers too late
+            "10.0.0.4": FakeHost(rtt=200),
+        })
+
+    def test_probe(self):
+        prober = ICMPProber(self.network, concurrency=10, rate=1000)
+        results = prober.probe(["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"], count=5, interval=10, timeout=100)
+        self.assertEqual(results["10.0.0.1"]["loss"], 0)
+        self.assertAlmostEqual(results["10.0.0.1"]["rtt"]["rtt_avg"], 5, delta=5)
+        self.assertEqual(results["10.0.0.2"]["reachable"], 1)
+        self.assertEqual(results["10.0.0.2"]["loss"], 40)
+        self.assertGreaterEqual(results["10.0.0.2"]["rtt"]["rtt_min"], 20)
+        for ip in ("10.0.0.3", "10.0.0.4"):
+            self.assertEqual(results[ip]["loss"], 100)
+            self.assertEqual(results[ip]["rtt"]["samples"], [None] * 5)
+            self.assertIsNone(results[ip]["rtt"]["rtt_avg"])
+
+    def test_concurrency_limit(self):
+        prober = ICMPProber(self.network, concurrency=2, rate=10000)
+        ips = [f"10.0.1.{i}" for i in range(10)]
+        results = prober.probe(ips, count=1, timeout=10)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(self.network.max_open_endpoints, 2)
+        self.assertEqual(self.network.open_endpoints, 0)
+
+    def test_send_rate(self):
+        prober = ICMPProber(self.network, concurrency=100, rate=200)
+        prober.probe([f"10.0.1.{i}" for i in range(40)], count=1, timeout=10)
+        times = sorted(time for time, _ in self.network.sent)
+        self.assertEqual(len(times), 40)
+        # 40 requests at 200 per second (with jitter) take about 0.2s
+        self.assertGreater(times[-1] - times[0], 0.1)
+
+
+class RTTStatsTest(SimpleTestCase):
+    """Tests for packed per-packet round trip times and their statistics."""
+
+    def test_pack(self):
+        blob = pack_samples([1.5, None, 3.25])
+        self.assertEqual(len(blob), 12)
+        samples = unpack_samples(blob)
+        self.assertEqual(samples[0], 1.5)
+        self.assertNotEqual(samples[1], samples[1])
+        self.assertEqual(samples[2], 3.25)
+
+    def test_stats(self):
+        stats = get_stats([
+            pack_samples([10, 12, 11, None, None]),
+            pack_samples([None, 20, 10, 10, 30]),
+            None,
+        ])
+        self.assertEqual(stats["pings"], 2)
+        self.assertEqual(stats["packets"], 10)
+        self.assertEqual(stats["lost"], 3)
+        self.assertEqual(stats["loss"], 30)
+        # |12-10|, |11-12|, |10-20|, |10-10|, |30-10|
+        self.assertEqual(stats["jitter"], 33 / 5)
+        self.assertEqual(stats["rtt_p50"], 11)
+        self.assertGreater(stats["rtt_p99"], stats["rtt_p95"])
+        # The lost packets at the end of the first ping and the start of the second are one burst
+        self.assertEqual(stats["loss_bursts"], 1)
+        self.assertEqual(stats["max_loss_burst"], 3)
+
+    def test_outage(self):
+        stats = get_stats([
+            pack_samples([10, 10, None]),
+            pack_samples([None] * 5),
+            pack_samples([None, 10, 10]),
+        ])
+        self.assertEqual(stats["pings"], 3)
+        self.assertEqual(stats["lost"], 7)
+        # The ping without replies joins the losses around it into one burst
+        self.assertEqual(stats["loss_bursts"], 1)
+        self.assertEqual(stats["max_loss_burst"], 7)
+        self.assertEqual(stats["jitter"], 0)
+
+    def test_no_samples(self):
+        stats = get_stats([None])
+        self.assertEqual(stats["packets"], 0)
+        self.assertIsNone(stats["loss"])
+        self.assertIsNone(stats["jitter"])
+        self.assertIsNone(stats["rtt_p50"])
+        self.assertEqual(stats["loss_bursts"], 0)
+
+
+class ResourcesTest(TestCase):
+    """Tests for resource samples that stay valid for a while, and listing them as a series."""
+
+    databases = {"default", "metrics_db"}
+    MAC = "02:00:00:00:00:01"
+
+    def setUp(self):
+        self.start = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+    def test_expand(self):
+        sample = ResourcesMetric(mac=self.MAC, created=self.start, memory=50, valid_until=self.start + timedelta(minutes=40))
+        points = sample.expand(timedelta(minutes=15))
+        self.assertEqual(
+            [point.created - self.start for point in points],
+            [timedelta(minutes=minutes) for minutes in (0, 15, 30, 40)],
+        )
+        self.assertTrue(all(point.memory == 50 and point.pk is None for point in points))
+        self.assertEqual(sample.created, self.start)
+        points = sample.expand(timedelta(minutes=15), after=self.start + timedelta(minutes=15))
+        self.assertEqual([point.created - self.start for point in points], [timedelta(minutes=30), timedelta(minutes=40)])
+
+    def test_expand_unextended(self):
+        for valid_until in (None, self.start):
+            sample = ResourcesMetric(mac=self.MAC, created=self.start, memory=50, valid_until=valid_until)
+            self.assertEqual([point.created for point in sample.expand(timedelta(minutes=15))], [self.start])
+
+    def test_list(self):
+        ResourcesMetric.objects.bulk_create([
+            ResourcesMetric(mac=self.MAC, created=self.start, memory=50, valid_until=self.start + timedelta(minutes=30)),
+            ResourcesMetric(mac=self.MAC, created=self.start + timedelta(minutes=45), memory=60, valid_until=None),
+            ResourcesMetric(mac="02:00:00:00:00:02", created=self.start, memory=70, valid_until=None),
+        ])
+        view = ResourcesViewSet.as_view({"get": "list"})
+        with self.settings(RESOURCES_METRIC_INTERVAL=timedelta(minutes=15)):
+            data = view(APIRequestFactory().get("/metrics/resources/", {"mac": self.MAC})).data
+            self.assertEqual([point["memory"] for point in data], [50, 50, 50, 60])
+            # Samples that were still valid after min_time are listed from then on
+            min_time = int((self.start + timedelta(minutes=20)).timestamp())
+            data = view(APIRequestFactory().get("/metrics/resources/", {"mac": self.MAC, "min_time": min_time})).data
+            self.assertEqual([point["memory"] for point in data], [50, 60])
+
+
+@skipUnless(connections["metrics_db"].vendor == "sqlite", "Checks SQLite query plans")
+class MetricIndexTest(TestCase):
+    """Tests that a node's metrics are queried through the (mac, created) index."""
+
+    databases = {"default", "metrics_db"}
+    MODELS = [DataUsageMetric, FailuresMetric, ResourcesMetric, RTTMetric, UptimeMetric]
+    MAC = "02:00:00:00:00:01"
+
+    def assertIndexRangeScan(self, qs, search: str):
+        plan = qs.explain()
+        self.assertIn(f"USING INDEX sqlite_autoindex_{qs.model._meta.db_table}_1 ({search})", plan)
+        self.assertNotIn("SCAN", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_latest_metric(self):
+        for model in self.MODELS:
+            with self.subTest(model=model.__name__):
+                qs = model.objects.filter(mac=self.MAC).order_by("-created")[:1]
+                self.assertIndexRangeScan(qs, "mac=?")
+
+    def test_time_window(self):
+        min_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for model in self.MODELS:
+            with self.subTest(model=model.__name__):
+                qs = model.objects.filter(mac=self.MAC, created__gt=min_time)
+                self.assertIndexRangeScan(qs, "mac=? AND created>?")
+
+
+class RollupTest(TestCase):
+    """Tests for building rollups and listing them."""
+
+    databases = {"default", "metrics_db"}
+    MAC = "02:00:00:00:00:01"
+
+    def setUp(self):
+        # A ping every minute for two hours, starting at 10:00
+        self.start = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+        RTTMetric.objects.bulk_create([
+            RTTMetric(mac=self.MAC, created=self.start + timedelta(minutes=i), rtt_min=i, rtt_avg=i + 1, rtt_max=i + 2)
+            for i in range(120)
+        ])
+        DataUsageMetric.objects.bulk_create([
+            DataUsageMetric(mac=self.MAC, created=self.start + timedelta(minutes=15 * i), tx_bytes=100, rx_bytes=i)
+            for i in range(8)
+        ])
+
+    def test_roll_up(self):
+        roll_up_all()
+        five_minutes = RTTRollup.objects.filter(resolution=300)
+        self.assertEqual(five_minutes.count(), 24)
+        first = five_minutes.first()
+        self.assertEqual(first.created, self.start)
+        self.assertEqual((first.count, first.rtt_min, first.rtt_avg, first.rtt_max), (5, 0, 3, 6))
+        hours = list(RTTRollup.objects.filter(resolution=3600))
+        self.assertEqual([hour.count for hour in hours], [60, 60])
+        self.assertEqual((hours[1].rtt_min, hours[1].rtt_avg, hours[1].rtt_max), (60, 90.5, 121))
+        day = DataUsageRollup.objects.get(resolution=86400)
+        self.assertEqual((day.count, day.tx_bytes, day.rx_bytes), (8, 800, 28))
+
+    def test_incremental(self):
+        roll_up_all()
+        RTTMetric.objects.create(mac=self.MAC, created=self.start + timedelta(minutes=120), rtt_min=0, rtt_avg=0, rtt_max=0)
+        # Replaces the last buckets, instead of adding to them
+        RTTMetric.objects.filter(created=self.start + timedelta(minutes=119)).update(rtt_max=1000)
+        roll_up_all()
+        self.assertEqual(RTTRollup.objects.filter(resolution=300).count(), 25)
+        hours = list(RTTRollup.objects.filter(resolution=3600))
+        self.assertEqual([hour.count for hour in hours], [60, 60, 1])
+        self.assertEqual(hours[1].rtt_max, 1000)
+        self.assertEqual(RTTRollup.objects.get(resolution=86400).count, 121)
+
+    def test_lost_pings(self):
+        RTTMetric.objects.all().delete()
+        start = self.start + timedelta(days=1)
+        # Only one of the first five minutes' pings got replies
+        RTTMetric.objects.bulk_create([
+            RTTMetric(mac=self.MAC, created=start + timedelta(minutes=i), rtt_avg=10 if i == 0 else None)
+            for i in range(5)
+        ] + [
+            RTTMetric(mac=self.MAC, created=start + timedelta(minutes=5 + i), rtt_avg=20)
+            for i in range(5)
+        ])
+        roll_up_all()
+        first, second = RTTRollup.objects.filter(resolution=300)
+        self.assertEqual((first.count, first.rtt_count, first.rtt_avg), (5, 1, 10))
+        self.assertEqual((second.count, second.rtt_count, second.rtt_avg), (5, 5, 20))
+        # Averaged over the 6 pings with an RTT, not the 10 pings
+        for resolution in (3600, 86400):
+            rollup = RTTRollup.objects.get(resolution=resolution)
+            self.assertEqual((rollup.count, rollup.rtt_count), (10, 6))
+            self.assertAlmostEqual(rollup.rtt_avg, 110 / 6)
+
+    def list(self, **params):
+        view = RTTViewSet.as_view({"get": "list"})
+        return view(APIRequestFactory().get("/metrics/rtt/", {"mac": self.MAC, **params})).data
+
+    def test_resolution(self):
+        roll_up_all()
+        self.assertEqual(len(self.list()), 120)
+        self.assertEqual(len(self.list(resolution="5m")), 24)
+        # The coarsest resolution that is at least as fine as 2 hours
+        self.assertEqual(len(self.list(resolution=7200)), 2)
+        self.assertEqual(len(self.list(resolution=60)), 120)
+
+    def test_points(self):
+        roll_up_all()
+        self.assertEqual(len(self.list(points=500)), 120)
+        self.assertEqual(len(self.list(points=100)), 24)
+        self.assertEqual(len(self.list(points=10)), 2)
+        self.assertEqual(len(self.list(points=1)), 1)
+
+
+@override_settings(
+    PING_MIN_INTERVAL=timedelta(minutes=1), PING_MAX_INTERVAL=timedelta(minutes=30), PING_INTERVAL_RATIO=0.1,
+)
+class SchedulingTest(TestCase):
+    """Tests for pinging nodes less often the longer their reachability is unchanged."""
+
+    databases = {"default", "metrics_db"}
+    MACS = ["02:00:00:00:00:01", "02:00:00:00:00:02", "02:00:00:00:00:03", "02:00:00:00:00:04"]
+
+    def setUp(self):
+        self.start = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+    @staticmethod
+    def mac(value: str):
+        return PingSchedule._meta.get_field("mac").to_python(value)
+
+    def add_history(self, mac: str, *reachable: bool) -> None:
+        """Add an uptime metric per minute from the start."""
+        UptimeMetric.objects.bulk_create([
+            UptimeMetric(mac=mac, created=self.start + timedelta(minutes=i), reachable=r, loss=0 if r else 100)
+            for i, r in enumerate(reachable)
+        ])
+
+    def test_interval(self):
+        self.assertEqual(get_interval(self.start, self.start), timedelta(minutes=1))
+        self.assertEqual(get_interval(self.start, self.start + timedelta(hours=1)), timedelta(minutes=6))
+        self.assertEqual(get_interval(self.start, self.start + timedelta(days=1)), timedelta(minutes=30))
+
+    def test_last_changes(self):
+        self.add_history(self.MACS[0], True, True, False, False)
+        self.add_history(self.MACS[1], True, True)
+        self.add_history(self.MACS[2], False, True, True)
+        time = self.start + timedelta(minutes=10)
+        # Metrics from the time of the pings themselves are ignored
+        UptimeMetric.objects.create(mac=self.MACS[2], created=time, reachable=False, loss=100)
+        with self.assertNumQueries(1, using="metrics_db"):
+            changes = get_last_changes({self.MACS[0]: False, self.MACS[1]: False, self.MACS[2]: True, self.MACS[3]: True}, time)
+        self.assertEqual(changes, {
+            self.MACS[0]: self.start + timedelta(minutes=2),
+            # Its reachability changed with this ping
+            self.MACS[1]: time,
+            self.MACS[2]: self.start + timedelta(minutes=1),
+            # Never pinged before
+            self.MACS[3]: time,
+        })
+
+    def test_update_schedules(self):
+        self.add_history(self.MACS[0], *[True] * 60)
+        time = self.start + timedelta(hours=1)
+        update_schedules({self.MACS[0]: True, self.MACS[1]: False}, time)
+        up = PingSchedule.objects.get(mac=self.MACS[0])
+        down = PingSchedule.objects.get(mac=self.MACS[1])
+        # Up for an hour, so pinged again in 6 minutes
+        self.assertEqual((up.reachable, up.changed, up.next_ping), (True, self.start, time + timedelta(minutes=6)))
+        self.assertEqual((down.reachable, down.changed, down.next_ping), (False, time, time + timedelta(minutes=1)))
+        self.assertEqual(get_down_macs(), {self.mac(self.MACS[1])})
+        self.assertEqual(get_not_due_macs(time + timedelta(minutes=1)), {self.mac(self.MACS[0])})
+        self.assertEqual(get_not_due_macs(time + timedelta(minutes=6)), set())
+
+        # The intervals grow while the reachability doesn't change, for down nodes too
+        time += timedelta(hours=1)
+        update_schedules({self.MACS[0]: True, self.MACS[1]: False}, time)
+        up.refresh_from_db()
+        down.refresh_from_db()
+        self.assertEqual((up.changed, up.next_ping), (self.start, time + timedelta(minutes=12)))
+        self.assertEqual((down.changed, down.next_ping), (time - timedelta(hours=1), time + timedelta(minutes=6)))
+
+        # A change of reachability resets them
+        time += timedelta(minutes=12)
+        update_schedules({self.MACS[0]: False, self.MACS[1]: True}, time)
+        up.refresh_from_db()
+        down.refresh_from_db()
+        self.assertEqual((up.reachable, up.changed, up.next_ping), (False, time, time + timedelta(minutes=1)))
+        self.assertEqual((down.reachable, down.changed, down.next_ping), (True, time, time + timedelta(minutes=1)))
+        self.assertEqual(get_down_macs(), {self.mac(self.MACS[0])})
+
+
+class SavePingResultsTest(TestCase):
+    """Tests for storing the results of a sweep's pings."""
+
+    databases = {"default", "metrics_db"}
+
+    def setUp(self):
+        self.created = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+    def test_save(self):
+        macs_by_ip = {f"10.0.0.{i}": [f"02:00:00:00:00:{i:02x}"] for i in range(1, 51)}
+        # Two nodes behind the same IP, and an IP without results
+        macs_by_ip["10.0.0.1"].append("02:00:00:00:01:01")
+        macs_by_ip["10.0.1.1"] = ["02:00:00:00:02:01"]
+        results = {ip: summarize([1.0, 2.0, None, 3.0, 4.0]) for ip in macs_by_ip if ip != "10.0.1.1"}
+        # Both inserts are a single query each, in a transaction
+        with self.assertNumQueries(4, using="metrics_db"):
+            counts = tasks.save_ping_results(macs_by_ip, results, self.created)
+        self.assertEqual(counts, (51, 51))
+        self.assertEqual(UptimeMetric.objects.count(), 51)
+        self.assertEqual(RTTMetric.objects.count(), 51)
+        self.assertEqual(
+            set(UptimeMetric.objects.filter(mac="02:00:00:00:01:01").values_list("created", "reachable", "loss")),
+            {(self.created, True, 20)},
+        )
+        metric = RTTMetric.objects.get(mac="02:00:00:00:01:01")
+        self.assertEqual((metric.rtt_min, metric.rtt_avg, metric.rtt_max), (1, 2.5, 4))
+        self.assertEqual(bytes(metric.samples), pack_samples([1.0, 2.0, None, 3.0, 4.0]))
+
+    def test_unreachable(self):
+        results = {"10.0.0.1": summarize([None] * 5)}
+        counts = tasks.save_ping_results({"10.0.0.1": ["02:00:00:00:00:01"]}, results, self.created)
+        self.assertEqual(counts, (1, 0))
+        uptime = UptimeMetric.objects.get()
+        self.assertEqual((uptime.reachable, uptime.loss), (False, 100))
+        # The lost samples are kept, with null RTTs
+        rtt = RTTMetric.objects.get()
+        self.assertEqual((rtt.rtt_min, rtt.rtt_avg, rtt.rtt_max), (None, None, None))
+        self.assertEqual(bytes(rtt.samples), pack_samples([None] * 5))
+
+
+class StubProber(Prober):
+    """Prober whose targets all answer in 1ms, except the IPs in down, recording the IPs of each probe."""
+
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.probed: list[list[str]] = []
+
+    def probe(self, ips, count=5, interval=25, nbytes=56, timeout=800):
+        ips = sorted(ips)
+        self.probed.append(ips)
+        return {ip: summarize([None if ip in self.down else 1.0] * count) for ip in ips}
+
+
+@override_settings(PING_CHUNK_SIZE=2)
+class PingSweepTest(TestCase):
+    """Tests for ping sweeps, with their subtasks run eagerly."""
+
+    databases = {"default", "metrics_db"}
+
+    def setUp(self):
+        for target, value in (
+            (signals, "_sync_prometheus_data_to_yml"),
+            # run_pings only runs one sweep at a time
+            (locks, "get_client"),
+        ):
+            patcher = patch.object(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        eager = {"task_always_eager": True, "task_eager_propagates": True}
+        self.addCleanup(celery_app.conf.update, {name: celery_app.conf[name] for name in eager})
+        celery_app.conf.update(eager)
+        self.prober = StubProber()
+        patcher = patch.object(tasks, "get_prober", return_value=self.prober)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Mesh a has a gateway, with n1 and then n2 behind it. Mesh b has no gateway.
+        for name in ("a", "b"):
+            Mesh.objects.create(name=name)
+        self.ips = {}
+        for i, (name, mesh) in enumerate([("gateway", "a"), ("n1", "a"), ("n2", "a"), ("b1", "b"), ("b2", "b"), ("b3", "b")], 1):
+            self.ips[name] = f"10.0.0.{i}"
+            Node.objects.create(mac=f"02:00:00:00:00:{i:02x}", name=name, mesh_id=mesh, ip=self.ips[name], is_gateway=name == "gateway")
+        Node.objects.create(mac="02:00:00:00:00:ff", name="no ip", mesh_id="b")
+        self.nodes = {node.name: node for node in Node.objects.all()}
+        self.nodes["gateway"].neighbours.add(self.nodes["n1"])
+        self.nodes["n1"].neighbours.add(self.nodes["n2"])
+
+    def names(self, chunks) -> list[list[str]]:
+        names = {ip: name for name, ip in self.ips.items()}
+        return [[names[ip] for ip in ips] for ips in chunks]
+
+    def test_sweep_chunks(self):
+        gateway_chunks, chunks = tasks.get_sweep_chunks()
+        self.assertEqual(self.names([[ip for _, ip in chunk] for chunk in gateway_chunks]), [["gateway"]])
+        # Split per mesh, and into PING_CHUNK_SIZE nodes
+        self.assertEqual(self.names([[ip for _, ip in chunk] for chunk in chunks]), [["n1", "n2"], ["b1", "b2"], ["b3"]])
+        # Nodes that aren't due are left out
+        PingSchedule.objects.create(mac=self.nodes["b2"].mac, reachable=True, changed=now(), next_ping=now() + timedelta(minutes=1))
+        _, chunks = tasks.get_sweep_chunks()
+        self.assertEqual(self.names([[ip for _, ip in chunk] for chunk in chunks]), [["n1", "n2"], ["b1", "b3"]])
+
+    def test_sweep(self):
+        tasks.run_pings()
+        # The gateways were pinged before the other nodes
+        self.assertEqual(self.names(self.prober.probed), [["gateway"], ["n1", "n2"], ["b1", "b2"], ["b3"]])
+        sweep = PingSweep.objects.get()
+        self.assertIsNotNone(sweep.finished)
+        self.assertEqual((sweep.chunks, sweep.nodes, sweep.reachable, sweep.suppressed), (4, 6, 6, 0))
+        self.assertEqual(set(UptimeMetric.objects.values_list("created", flat=True)), {sweep.started})
+        self.assertEqual(PingSchedule.objects.filter(reachable=True).count(), 6)
+        # Nothing is due yet
+        tasks.run_pings()
+        self.assertEqual(len(self.prober.probed), 4)
+        self.assertEqual(PingSweep.objects.latest("started").nodes, 0)
+
+    def test_suppressed(self):
+        # n1 was down in the previous sweep, and is due again
+        PingSchedule.objects.create(mac=self.nodes["n1"].mac, reachable=False, changed=now(), next_ping=now())
+        self.prober.down.add(self.ips["n1"])
+        tasks.run_pings()
+        self.assertEqual(self.names(self.prober.probed), [["gateway"], ["n1"], ["b1", "b2"], ["b3"]])
+        sweep = PingSweep.objects.get()
+        self.assertEqual((sweep.chunks, sweep.nodes, sweep.reachable, sweep.suppressed), (4, 5, 4, 1))
+        self.assertEqual(list(Node.objects.filter(unreachable_upstream=True).values_list("name", flat=True)), ["n2"])
+        # n1 is back, so n2 is pinged again from the sweep after the one that found out
+        self.prober.down.clear()
+        for probed in ([["gateway"], ["n1"], ["b1", "b2"], ["b3"]], [["gateway"], ["n1", "n2"], ["b1", "b2"], ["b3"]]):
+            del self.prober.probed[:]
+            PingSchedule.objects.update(next_ping=now())
+            tasks.run_pings()
+            self.assertEqual(self.names(self.prober.probed), probed)
+        self.assertFalse(Node.objects.filter(unreachable_upstream=True).exists())
+
+    def test_unfinished(self):
+        unfinished = PingSweep.objects.create()
+        tasks.run_pings()
+        self.assertEqual(self.prober.probed, [])
+        self.assertEqual(PingSweep.objects.count(), 1)
+        # Unless it was started longer than PING_SWEEP_TIMEOUT ago
+        PingSweep.objects.filter(pk=unfinished.pk).update(started=now() - timedelta(hours=1))
+        tasks.run_pings()
+        self.assertEqual(len(self.prober.probed), 4)
+        self.assertEqual(PingSweep.objects.filter(finished__isnull=False).count(), 1)
+
+    def test_finish_ping_sweep(self):
+        sweep = PingSweep.objects.create()
+        # The gateway chunks' results are passed on to the downstream chunks' chord
+        tasks.finish_ping_sweep([(2, 1), (3, 3)], sweep.pk, [(1, 1)])
+        sweep.refresh_from_db()
+        self.assertEqual((sweep.chunks, sweep.nodes, sweep.reachable), (3, 6, 5))
+        self.assertGreaterEqual(sweep.duration, 0)
@@ -9,5 +9,6 @@ router.register("rtt", views.RTTViewSet)
 router.register("resources", views.ResourcesViewSet)
 router.register("data_usage", views.DataUsageViewSet)
 router.register("failures", views.FailuresViewSet)
+router.register("services", views.ServiceViewSet)
 
 urlpatterns = [path("", include(router.urls))]
@@ -1,8 +1,16 @@
 from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.timezone import make_aware
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
 from . import models
 from . import serializers
+from .rtt import get_stats
 
 
 class FilterByDeviceMacMixin:
@@ -24,24 +32,88 @@ class FilterByMinTimeMixin:
 
     MIN_TIME_FIELD = "min_time"
 
-    def filter_queryset(self, qs):
-        """Filter against a 'min_time' parameter in the request query."""
-        qs = super().filter_queryset(qs)
+    def get_min_time(self) -> datetime | None:
+        """Parse the 'min_time' parameter in the request query."""
         min_time = self.request.query_params.get(self.MIN_TIME_FIELD)
         if not min_time:
-            return qs
+            return None
         try:
             min_time_int = int(min_time)
         except ValueError:
-            return qs
-        return qs.filter(created__gt=datetime.fromtimestamp(min_time_int))
+            return None
+        return make_aware(datetime.fromtimestamp(min_time_int))
 
+    def filter_min_time(self, qs, min_time: datetime):
+        """Filter out items from before min_time."""
+        return qs.filter(created__gt=min_time)
 
-class UptimeViewSet(FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
+    def filter_queryset(self, qs):
+        """Filter against a 'min_time' parameter in the request query."""
+        qs = super().filter_queryset(qs)
+        min_time = self.get_min_time()
+        if min_time is None:
+            return qs
+        return self.filter_min_time(qs, min_time)
+
+
+class RollupMixin:
+    """Allow listing a view's metrics rolled up, at a 'resolution' or within a 'points' budget.
+
+    The resolution is either a rollup resolution (e.g. '1h') or a number of
+    seconds, and picks the coarsest rollup resolution that is at least as
+    fine. With a points budget, the finest resolution whose (filtered) rows
+    fit the budget is picked, which may be the metrics themselves.
+    """
+
+    RESOLUTION_FIELD = "resolution"
+    POINTS_FIELD = "points"
+    rollup_model: type[models.Rollup]
+    rollup_serializer_class: type
+
+    def get_resolution(self) -> int | None:
+        """Get the rollup resolution to list, or None for the metrics themselves."""
+        resolutions = [seconds for seconds, _ in models.Rollup.RESOLUTIONS]
+        resolution = self.request.query_params.get(self.RESOLUTION_FIELD)
+        if resolution:
+            labels = {label: seconds for seconds, label in models.Rollup.RESOLUTIONS}
+            try:
+                seconds = labels.get(resolution) or int(resolution)
+            except ValueError:
+                return None
+            return max((r for r in resolutions if r <= seconds), default=None)
+        try:
+            points = int(self.request.query_params.get(self.POINTS_FIELD, ""))
+        except ValueError:
+            return None
+        if points <= 0:
+            return None
+        # Only read up to one row more than the budget, so that this doesn't
+        # depend on the number of metrics
+        candidates = [(None, self.filter_queryset(self.get_queryset()))]
+        for seconds in resolutions:
+            candidates.append((seconds, self.filter_queryset(self.rollup_model.objects.filter(resolution=seconds))))
+        for seconds, qs in candidates:
+            if qs.order_by().values("pk")[:points + 1].count() <= points:
+                return seconds
+        return resolutions[-1]
+
+    def list(self, request, *args, **kwargs):
+        """List the metrics, or their rollups at the requested resolution."""
+        resolution = self.get_resolution()
+        if resolution is None:
+            return super().list(request, *args, **kwargs)
+        qs = self.filter_queryset(self.rollup_model.objects.filter(resolution=resolution))
+        serializer = self.rollup_serializer_class(qs, many=True)
+        return Response(serializer.data)
+
+
+class UptimeViewSet(RollupMixin, FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
     """View/Edit/Add/Delete UptimeMetric items."""
 
     queryset = models.UptimeMetric.objects.all()
     serializer_class = serializers.UptimeMetricSerializer
+    rollup_model = models.UptimeRollup
+    rollup_serializer_class = serializers.UptimeRollupSerializer
 
 
 class FailuresViewSet(FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
@@ -51,22 +123,68 @@ class FailuresViewSet(FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet
     serializer_class = serializers.FailuresMetricSerializer
 
 
-class RTTViewSet(FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
+class RTTViewSet(RollupMixin, FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
     """View/Edit/Add/Delete RTTMetric items."""
 
     queryset = models.RTTMetric.objects.all()
     serializer_class = serializers.RTTMetricSerializer
+    rollup_model = models.RTTRollup
+    rollup_serializer_class = serializers.RTTRollupSerializer
+
+    @action(detail=False)
+    def stats(self, request):
+        """Jitter, latency percentiles and loss bursts of a node's pings since min_time."""
+        if request.query_params.get(self.MAC_FIELD) is None:
+            return Response({"detail": "A mac is required."}, status=status.HTTP_400_BAD_REQUEST)
+        qs = self.filter_queryset(self.get_queryset()).order_by("created")
+        return Response(get_stats([bytes(blob) if blob else None for blob in qs.values_list("samples", flat=True)]))
 
 
 class ResourcesViewSet(FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
-    """View/Edit/Add/Delete ResourcesMetric items."""
+    """View/Edit/Add/Delete ResourcesMetric items.
+
+    Samples that stay valid for a while are listed as a point every
+    RESOURCES_METRIC_INTERVAL, so that clients get a regular series.
+    """
 
     queryset = models.ResourcesMetric.objects.all()
     serializer_class = serializers.ResourcesMetricSerializer
 
+    def filter_min_time(self, qs, min_time: datetime):
+        """Filter out samples that were no longer valid after min_time."""
+        return qs.filter(Q(created__gt=min_time) | Q(valid_until__gt=min_time))
+
+    def list(self, request, *args, **kwargs):
+        """List the samples, expanded into a series."""
+        qs = self.filter_queryset(self.get_queryset())
+        min_time = self.get_min_time()
+        points = []
+        for sample in qs:
+            points.extend(sample.expand(settings.RESOURCES_METRIC_INTERVAL, after=min_time))
+        points.sort(key=lambda point: point.created)
+        serializer = self.get_serializer(points, many=True)
+        return Response(serializer.data)
 
-class DataUsageViewSet(FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
+
+class DataUsageViewSet(RollupMixin, FilterByMinTimeMixin, FilterByDeviceMacMixin, ModelViewSet):
     """View/Edit/Add/Delete DataUsageMetric items."""
 
     queryset = models.DataUsageMetric.objects.all()
     serializer_class = serializers.DataUsageMetricSerializer
+    rollup_model = models.DataUsageRollup
+    rollup_serializer_class = serializers.DataUsageRollupSerializer
+
+
+class ServiceViewSet(FilterByMinTimeMixin, ModelViewSet):
+    """View/Edit/Add/Delete ServiceMetric items."""
+
+    queryset = models.ServiceMetric.objects.all()
+    serializer_class = serializers.ServiceMetricSerializer
+
+    def filter_queryset(self, qs):
+        """Filter against a 'service' (id) parameter in the request query."""
+        qs = super().filter_queryset(qs)
+        service = self.request.query_params.get("service")
+        if service is not None:
+            qs = qs.filter(service_id=service)
+        return qs
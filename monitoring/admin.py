@@ -6,7 +6,11 @@ from . import models
 @admin.register(models.Node)
 class NodeAdmin(admin.ModelAdmin):
 
-    list_display = ('name', 'hardware', 'ip')
+    list_display = ('name', 'hardware', 'ip', 'is_gateway', 'unreachable_upstream')
+    list_filter = ('is_gateway', 'unreachable_upstream')
+    # Gateways and neighbours aren't synced, so they're configured here
+    list_editable = ('is_gateway',)
+    filter_horizontal = ('neighbours',)
 
 
 @admin.register(models.Service)
@@ -18,3 +22,6 @@ class NetworkDeviceAdmin(admin.ModelAdmin):
 admin.site.register(models.Alert)
 admin.site.register(models.Mesh)
 admin.site.register(models.UnknownNode)
+admin.site.register(models.SyncCheckpoint)
+admin.site.register(models.SyncRun)
+admin.site.register(models.SyncStage)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from monitoring.sync import orchestrator, radiusdesk, unifi
+
+
+class Command(BaseCommand):
+
+    help = "Sync with the radiusdesk and unifi databases concurrently"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Ignore sync checkpoints and resync the full history",
+        )
+
+    def handle(self, *args, **options):
+        stages = radiusdesk.stages() + unifi.stages()
+        orchestrator.run(stages, full=options["full"], name="radiusdesk and unifi")
\ No newline at end of file
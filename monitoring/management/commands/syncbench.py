@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models.signals import post_save, post_delete
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from monitoring import signals
+from monitoring.models import Node, SyncRun
+from monitoring.sync import orchestrator, replay
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Benchmark a sync against a recorded or synthetic snapshot. "
+        "The sync writes to throwaway test databases, which are destroyed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", choices=["radiusdesk", "unifi"], help="Source to benchmark")
+        parser.add_argument("--snapshot", help="Snapshot recorded with syncrecord to replay")
+        parser.add_argument(
+            "--nodes",
+            type=int,
+            help="Synthesize a snapshot with this many nodes (values are taken from --snapshot, if given)",
+        )
+        parser.add_argument("--stations", type=int, default=100, help="Station rows per synthesized node")
+        parser.add_argument("--batch-size", type=int, help="Override SYNC_BATCH_SIZE")
+        parser.add_argument("--workers", type=int, help="Override SYNC_MAX_WORKERS")
+        parser.add_argument("--shards", type=int, help="Override SYNC_METRIC_SHARDS")
+        parser.add_argument("--keepdb", action="store_true", help="Keep the test databases afterwards")
+
+    def handle(self, *args, **options):
+        snapshot = replay.load_snapshot(options["snapshot"]) if options["snapshot"] else None
+        if options["nodes"] is not None:
+            synthesize = getattr(replay, f"synthesize_{options['source']}")
+            snapshot = synthesize(options["nodes"], options["stations"], template=snapshot)
+        if snapshot is None:
+            raise CommandError("Either --snapshot or --nodes is required")
+        if snapshot["source"] != options["source"]:
+            raise CommandError(f"The snapshot was recorded from {snapshot['source']}")
+
+        sqlite = any(connection.vendor == "sqlite" for connection in connections.all())
+        if sqlite and options["shards"] and options["shards"] > 1:
+            raise CommandError("Shard processes can't access sqlite's in-memory test databases")
+        overrides = {}
+        if options["shards"]:
+            overrides["SYNC_METRIC_SHARDS"] = options["shards"]
+        elif sqlite:
+            overrides["SYNC_METRIC_SHARDS"] = 1
+        if options["batch_size"]:
+            overrides["SYNC_BATCH_SIZE"] = options["batch_size"]
+        if options["workers"]:
+            overrides["SYNC_MAX_WORKERS"] = options["workers"]
+        elif sqlite:
+            # In-memory sqlite test databases lock whole tables, so concurrent stages would fail
+            overrides["SYNC_MAX_WORKERS"] = 1
+
+        old_config = setup_databases(options["verbosity"], interactive=False, keepdb=options["keepdb"])
+        # Don't rewrite the real prometheus targets with the benchmark's nodes
+        post_save.disconnect(signals.update_prometheus_targets, sender=Node)
+        post_delete.disconnect(signals.remove_prometheus_targets, sender=Node)
+        try:
+            with override_settings(**overrides):
+                orchestrator.run(replay.replay_stages(snapshot), full=True, name=f"{options['source']} benchmark")
+            self.report()
+        finally:
+            post_save.connect(signals.update_prometheus_targets, sender=Node)
+            post_delete.connect(signals.remove_prometheus_targets, sender=Node)
+            teardown_databases(old_config, options["verbosity"], keepdb=options["keepdb"])
+
+    def report(self):
+        self.stdout.write(f"{'stage':<28}{'status':<10}{'rows':>10}{'seconds':>10}{'rows/s':>12}")
+        sync_run = SyncRun.objects.latest("started")
+        for stage in sync_run.stages.order_by("started"):
+            rows = max(stage.rows_read, stage.rows_written)
+            rate = rows / stage.duration if stage.duration else 0
+            self.stdout.write(
+                f"{stage.name:<28}{stage.status:<10}{rows:>10}{stage.duration:>10.2f}{rate:>12.0f}"
+            )
+        # Stages run concurrently, so memory is only measured for the whole run
+        self.stdout.write(f"Peak RSS: {sync_run.worker_peak_rss:.1f}MB")
\ No newline at end of file
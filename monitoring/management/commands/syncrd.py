@@ -6,5 +6,12 @@ class Command(BaseCommand):
 
     help = "Sync with the radiusdesk database"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Ignore sync checkpoints and resync the full history",
+        )
+
     def handle(self, *args, **options):
-        sync_radiusdesk()
\ No newline at end of file
+        sync_radiusdesk(full=options["full"])
\ No newline at end of file
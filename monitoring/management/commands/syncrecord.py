@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from monitoring.sync import replay
+
+
+class Command(BaseCommand):
+
+    help = "Record the data read by a sync to a snapshot file, for replaying with syncbench"
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", choices=["radiusdesk", "unifi"], help="Source to record")
+        parser.add_argument("output", help="Snapshot file to write")
+
+    def handle(self, *args, **options):
+        if options["source"] == "radiusdesk":
+            snapshot = replay.record_radiusdesk()
+        else:
+            snapshot = replay.record_unifi()
+        replay.save_snapshot(snapshot, options["output"])
+        self.stdout.write(f"Recorded {options['source']} to {options['output']}")
\ No newline at end of file
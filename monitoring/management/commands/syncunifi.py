@@ -6,5 +6,12 @@ class Command(BaseCommand):
 
     help = "Sync with the unifi database"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Ignore sync checkpoints and resync the full history",
+        )
+
     def handle(self, *args, **options):
-        sync_unifi()
\ No newline at end of file
+        sync_unifi(full=options["full"])
\ No newline at end of file
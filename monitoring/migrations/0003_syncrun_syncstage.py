@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0002_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sources', models.CharField(max_length=64)),
+                ('full', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='running', max_length=10)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncStage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('source', models.CharField(max_length=32)),
+                ('status', models.CharField(choices=[('succeeded', 'Succeeded'), ('failed', 'Failed'), ('skipped', 'Skipped')], max_length=10)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField(default=0)),
+                ('rows_read', models.IntegerField(default=0)),
+                ('created', models.IntegerField(default=0)),
+                ('updated', models.IntegerField(default=0)),
+                ('unchanged', models.IntegerField(default=0)),
+                ('deleted', models.IntegerField(default=0)),
+                ('query_time', models.FloatField(default=0)),
+                ('write_time', models.FloatField(default=0)),
+                ('peak_rss', models.FloatField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='monitoring.syncrun')),
+            ],
+            options={
+                'ordering': ['started'],
+            },
+        ),
+    ]
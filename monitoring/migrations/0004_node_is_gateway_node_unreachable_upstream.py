@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0003_syncrun_syncstage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='is_gateway',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='unreachable_upstream',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0004_node_is_gateway_node_unreachable_upstream'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='syncstage',
+            name='peak_rss',
+        ),
+        migrations.AddField(
+            model_name='syncrun',
+            name='worker_peak_rss',
+            field=models.FloatField(default=0),
+        ),
+    ]
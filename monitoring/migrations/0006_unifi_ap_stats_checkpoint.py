@@ -0,0 +1,43 @@
+# The unifi AP metrics used to be synced by a stage per model, each with its
+# own checkpoint, and are now synced in a single pass with the "ap_stats"
+# checkpoint. It resumes from the oldest of the old checkpoints, rather than
+# resyncing the full history on the first run.
+
+from django.db import migrations
+
+OLD_STREAMS = ["data_usage", "failures", "resources"]
+
+
+def merge_checkpoints(apps, schema_editor):
+    """Replace the per-model unifi checkpoints with a single ap_stats checkpoint."""
+    SyncCheckpoint = apps.get_model("monitoring", "SyncCheckpoint")
+    qs = SyncCheckpoint.objects.using(schema_editor.connection.alias)
+    old = qs.filter(source="unifi", stream__in=OLD_STREAMS)
+    watermarks = list(old.values_list("watermark", flat=True))
+    # A model that was never synced needs the full history
+    if len(watermarks) == len(OLD_STREAMS):
+        qs.get_or_create(source="unifi", stream="ap_stats", defaults={"watermark": min(watermarks)})
+    old.delete()
+
+
+def split_checkpoint(apps, schema_editor):
+    """Restore the per-model unifi checkpoints from the ap_stats checkpoint."""
+    SyncCheckpoint = apps.get_model("monitoring", "SyncCheckpoint")
+    qs = SyncCheckpoint.objects.using(schema_editor.connection.alias)
+    checkpoint = qs.filter(source="unifi", stream="ap_stats").first()
+    if checkpoint is None:
+        return
+    for stream in OLD_STREAMS:
+        qs.get_or_create(source="unifi", stream=stream, defaults={"watermark": checkpoint.watermark})
+    checkpoint.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring', '0005_syncrun_worker_peak_rss'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_checkpoints, split_checkpoint),
+    ]
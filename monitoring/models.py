@@ -30,6 +30,13 @@ class Node(models.Model):
     lat = models.FloatField(blank=True, null=True)
     lon = models.FloatField(blank=True, null=True)
     created = models.DateTimeField(auto_now_add=True)
+    # Gateways have their own uplink, other nodes are reached through their
+    # neighbours. Neither is synced from radiusdesk or unifi, they're set in
+    # the admin, and kept by the syncs.
+    is_gateway = models.BooleanField(default=False)
+    # Not pinged because every path from a gateway to it runs through an
+    # unreachable node, see monitoring.topology
+    unreachable_upstream = models.BooleanField(default=False)
 
     @cached_property
     def last_uptime_metric(self) -> UptimeMetric | None:
@@ -106,6 +113,91 @@ class Service(models.Model):
     api_location = models.CharField(max_length=10, choices=API_LOCATIONS)
 
 
+class SyncCheckpoint(models.Model):
+    """Latest timestamp synced from a source's stream of metrics."""
+
+    source = models.CharField(max_length=32)
+    stream = models.CharField(max_length=64)
+    watermark = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        """SyncCheckpoint metadata."""
+
+        unique_together = ("source", "stream")
+
+    def __str__(self):
+        return f"Checkpoint {self.source}.{self.stream} [{self.watermark}]"
+
+
+class SyncRun(models.Model):
+    """A single run of the sync with one or more sources."""
+
+    STATUSES = (
+        ("running", "Running"),
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+    )
+
+    sources = models.CharField(max_length=64)
+    full = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUSES, default="running")
+    started = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField(null=True, blank=True)
+    # Memory high-water mark of the process that ran the sync, when it
+    # finished, in MB. It covers the process' lifetime (e.g. a celery
+    # worker's earlier tasks) and not the shard processes, and can't be
+    # split up by stage, since stages run concurrently in the same process.
+    worker_peak_rss = models.FloatField(default=0)
+
+    class Meta:
+        """SyncRun metadata."""
+
+        ordering = ["-started"]
+
+    def __str__(self):
+        return f"Sync with {self.sources} ({self.status}) [{self.started}]"
+
+
+class SyncStage(models.Model):
+    """Timings and row counts of a single stage of a sync run."""
+
+    STATUSES = (
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+        ("skipped", "Skipped"),
+    )
+
+    run = models.ForeignKey(SyncRun, on_delete=models.CASCADE, related_name="stages")
+    name = models.CharField(max_length=64)
+    source = models.CharField(max_length=32)
+    status = models.CharField(max_length=10, choices=STATUSES)
+    started = models.DateTimeField()
+    duration = models.FloatField(default=0)
+    rows_read = models.IntegerField(default=0)
+    created = models.IntegerField(default=0)
+    updated = models.IntegerField(default=0)
+    unchanged = models.IntegerField(default=0)
+    deleted = models.IntegerField(default=0)
+    # Seconds spent reading from the source vs. writing to the database
+    query_time = models.FloatField(default=0)
+    write_time = models.FloatField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        """SyncStage metadata."""
+
+        ordering = ["started"]
+
+    @property
+    def rows_written(self) -> int:
+        """Number of rows inserted, updated or deleted."""
+        return self.created + self.updated + self.deleted
+
+    def __str__(self):
+        return f"Sync stage {self.name} ({self.status}) [{self.started}]"
+
+
 class Alert(models.Model):
     """Alert sent to network managers."""
 
@@ -0,0 +1,285 @@
+"""Probe the health of services over HTTP(S) or TCP, see ServiceProber."""
+
+import asyncio
+import socket
+import ssl
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Awaitable, Iterable
+from urllib.parse import SplitResult, urlsplit
+
+from django.conf import settings
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Larger response bodies aren't read, and their connection isn't reused
+MAX_BODY_SIZE = 1 << 20
+USER_AGENT = "monitoring-probe/1.0"
+
+
+class ProbeFailed(Exception):
+    """A phase of a probe failed, the message says which one."""
+
+
+@dataclass
+class ProbeResult:
+    """Result of probing a service, with the time each phase took in ms.
+
+    Phases that didn't happen are None, e.g. connect and tls on a reused
+    connection, or tls for plain HTTP.
+    """
+
+    up: bool = False
+    status_code: int | None = None
+    error: str = ""
+    reused: bool = False
+    connect_time: float | None = None
+    tls_time: float | None = None
+    first_byte_time: float | None = None
+    total_time: float | None = None
+
+
+@dataclass
+class Connection:
+    """An open connection to a service's host."""
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    def is_open(self) -> bool:
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Idle keep-alive connections by (scheme, host, port)."""
+
+    def __init__(self):
+        self.idle: dict[tuple, list[Connection]] = defaultdict(list)
+
+    def get(self, key: tuple) -> Connection | None:
+        """Take an idle connection that's still open, if there is one."""
+        while self.idle[key]:
+            connection = self.idle[key].pop()
+            if connection.is_open():
+                return connection
+            connection.close()
+        return None
+
+    def put(self, key: tuple, connection: Connection) -> None:
+        self.idle[key].append(connection)
+
+    def close(self) -> None:
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle.clear()
+
+
+class ServiceProber:
+    """Probes services from a single asyncio event loop.
+
+    http(s) URLs get a GET request, whose response must have a status below
+    400, and tcp://host:port URLs only need to accept a connection. At most
+    concurrency services are probed at a time, and at most host_concurrency
+    per host. Requests to the same host reuse keep-alive connections. Each
+    phase (connect, TLS handshake and waiting for the response's first byte)
+    has its own timeout, in seconds.
+    """
+
+    def __init__(self,
+                 concurrency: int | None = None,
+                 host_concurrency: int | None = None,
+                 connect_timeout: float | None = None,
+                 tls_timeout: float | None = None,
+                 first_byte_timeout: float | None = None,
+                 ssl_context: ssl.SSLContext | None = None):
+        self.concurrency = concurrency or settings.SERVICE_PROBE_CONCURRENCY
+        self.host_concurrency = host_concurrency or settings.SERVICE_PROBE_HOST_CONCURRENCY
+        self.connect_timeout = connect_timeout or settings.SERVICE_PROBE_CONNECT_TIMEOUT
+        self.tls_timeout = tls_timeout or settings.SERVICE_PROBE_TLS_TIMEOUT
+        self.first_byte_timeout = first_byte_timeout or settings.SERVICE_PROBE_FIRST_BYTE_TIMEOUT
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+    def probe(self, urls: Iterable[str]) -> dict[str, ProbeResult]:
+        return asyncio.run(self.aprobe(urls))
+
+    async def aprobe(self, urls: Iterable[str]) -> dict[str, ProbeResult]:
+        """Probe all urls concurrently, returning the results by url."""
+        urls = sorted(set(urls))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        host_semaphores = defaultdict(lambda: asyncio.Semaphore(self.host_concurrency))
+        pool = ConnectionPool()
+
+        async def probe_url(url):
+            parts = urlsplit(url)
+            scheme = parts.scheme.lower()
+            try:
+                key = (scheme, parts.hostname, parts.port or DEFAULT_PORTS.get(scheme))
+            except ValueError:
+                # e.g. a port that isn't a number
+                key = (scheme, None, None)
+            if scheme not in ("http", "https", "tcp") or None in key:
+                return ProbeResult(error="Unsupported URL")
+            # Wait for the host before taking up one of the overall slots
+            async with host_semaphores[key], semaphore:
+                return await self.probe_target(parts, key, pool)
+
+        try:
+            results = await asyncio.gather(*(probe_url(url) for url in urls))
+        finally:
+            pool.close()
+        return dict(zip(urls, results))
+
+    async def probe_target(self, parts: SplitResult, key: tuple, pool: ConnectionPool) -> ProbeResult:
+        """Probe a single service."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        result = ProbeResult()
+        connection = pool.get(key)
+        try:
+            try:
+                if connection is None:
+                    connection = await self.connect(key, result)
+                else:
+                    result.reused = True
+                if key[0] == "tcp":
+                    result.up = True
+                    connection.close()
+                else:
+                    await self.request(connection, parts, key, pool, result)
+            except ProbeFailed:
+                if not result.reused or result.status_code is not None:
+                    raise
+                # The host closed the idle connection, retry on a new one
+                connection.close()
+                result = ProbeResult()
+                connection = await self.connect(key, result)
+                await self.request(connection, parts, key, pool, result)
+        except ProbeFailed as e:
+            if connection is not None:
+                connection.close()
+            result.up = False
+            result.error = str(e)[:200]
+        result.total_time = (loop.time() - start) * 1000
+        return result
+
+    async def timed(self, result: ProbeResult | None, phase: str, awaitable: Awaitable, timeout: float):
+        """Await a phase of a probe within its timeout, recording how long it took."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            value = await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError as e:
+            raise ProbeFailed(f"{phase} timed out after {timeout}s") from e
+        except (OSError, EOFError, asyncio.LimitOverrunError, ValueError) as e:
+            # OSError includes ssl.SSLError
+            raise ProbeFailed(f"{phase} failed: {e!r}") from e
+        if result is not None:
+            setattr(result, f"{phase}_time", (loop.time() - start) * 1000)
+        return value
+
+    async def connect(self, key: tuple, result: ProbeResult) -> Connection:
+        """Open a connection to a service's host, with a TLS handshake for https."""
+        scheme, host, port = key
+        loop = asyncio.get_running_loop()
+
+        async def open_socket():
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            family, type_, proto, _, address = infos[0]
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        sock = await self.timed(result, "connect", open_socket(), self.connect_timeout)
+        try:
+            if scheme == "https":
+                handshake = asyncio.open_connection(sock=sock, ssl=self.ssl_context, server_hostname=host)
+                reader, writer = await self.timed(result, "tls", handshake, self.tls_timeout)
+            else:
+                reader, writer = await asyncio.open_connection(sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+        return Connection(reader, writer)
+
+    async def request(self,
+                      connection: Connection,
+                      parts: SplitResult,
+                      key: tuple,
+                      pool: ConnectionPool,
+                      result: ProbeResult) -> None:
+        """GET a service's URL, putting the connection back in the pool if it can be reused."""
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        host = parts.netloc.rpartition("@")[2]
+        connection.writer.write(
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            "Accept: */*\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n".encode("latin-1")
+        )
+
+        async def first_byte():
+            await connection.writer.drain()
+            return await connection.reader.readuntil(b"\r\n")
+
+        status_line = await self.timed(result, "first_byte", first_byte(), self.first_byte_timeout)
+        version, _, rest = status_line.decode("latin-1").partition(" ")
+        status = rest[:3]
+        if not version.startswith("HTTP/") or not status.isdigit():
+            raise ProbeFailed(f"first_byte failed: invalid status line {status_line[:50]!r}")
+        result.status_code = int(status)
+        # The rest of the response is read within another first byte timeout
+        reusable = await self.timed(None, "read", self.read_response(connection, version, result.status_code), self.first_byte_timeout)
+        result.up = result.status_code < 400
+        if reusable:
+            pool.put(key, connection)
+        else:
+            connection.close()
+
+    async def read_response(self, connection: Connection, version: str, status: int) -> bool:
+        """Read a response's headers and body, returning whether its connection can be reused."""
+        reader = connection.reader
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+        reusable = version == "HTTP/1.1" and headers.get("connection") != "close"
+        if status < 200 or status in (204, 304):
+            return reusable
+        if "chunked" in headers.get("transfer-encoding", ""):
+            size = 0
+            while True:
+                chunk_size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                size += chunk_size
+                if chunk_size == 0 or size > MAX_BODY_SIZE:
+                    break
+                await reader.readexactly(chunk_size + 2)
+            if chunk_size:
+                return False
+            # Trailers
+            while (await reader.readuntil(b"\r\n")).strip():
+                pass
+            return reusable
+        if "content-length" in headers:
+            length = int(headers["content-length"])
+            if length > MAX_BODY_SIZE:
+                return False
+            await reader.readexactly(length)
+            return reusable
+        # The body (if any) ends when the connection is closed
+        await reader.read(MAX_BODY_SIZE)
+        return False
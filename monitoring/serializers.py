@@ -1,5 +1,10 @@
 from datetime import datetime
-from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField, SerializerMethodField
+from rest_framework.serializers import (
+    IntegerField,
+    ModelSerializer,
+    PrimaryKeyRelatedField,
+    SerializerMethodField,
+)
 from dynamic_fields.serializers import DynamicFieldsModelSerializer
 
 from . import models
@@ -32,6 +37,28 @@ class ServiceSerializer(ModelSerializer):
         fields = "__all__"
 
 
+class SyncStageSerializer(ModelSerializer):
+    """Serializes SyncStage objects from django model to JSON."""
+
+    rows_written = IntegerField(read_only=True)
+
+    class Meta:
+        """SyncStageSerializer metadata."""
+        model = models.SyncStage
+        fields = "__all__"
+
+
+class SyncRunSerializer(ModelSerializer):
+    """Serializes SyncRun objects, with their stages, from django model to JSON."""
+
+    stages = SyncStageSerializer(many=True, read_only=True)
+
+    class Meta:
+        """SyncRunSerializer metadata."""
+        model = models.SyncRun
+        fields = "__all__"
+
+
 class AlertSerializer(ModelSerializer):
     """Serializes Alert objects from django model to JSON."""
 
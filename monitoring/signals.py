@@ -1,3 +1,6 @@
+import threading
+from contextlib import contextmanager
+
 import yaml
 
 from django.db.models.signals import post_save, post_delete
@@ -6,9 +9,20 @@ from django.conf import settings
 
 from .models import Node, UnknownNode
 
+# Serializes writes of prometheus.yml, e.g. by sync stages running in threads
+_prometheus_lock = threading.RLock()
+# Blocks that defer the writes, and whether a write was deferred
+_prometheus_deferred = 0
+_prometheus_dirty = False
+
 
 def sync_prometheus_data_to_yml():
     """Sync the IP addresses currently in the database to YAML config."""
+    with _prometheus_lock:
+        _sync_prometheus_data_to_yml()
+
+
+def _sync_prometheus_data_to_yml():
     ip_addresses = Node.objects.values_list("ip", flat=True)
     prometheus_path = settings.BASE_DIR / "prometheus.yml"
 
@@ -27,10 +41,36 @@ def sync_prometheus_data_to_yml():
         yaml.dump(prometheus_data, file, sort_keys=False)
 
 
+def request_prometheus_sync():
+    """Sync the prometheus targets now, or at the end of a deferred_prometheus_sync block."""
+    global _prometheus_dirty
+    with _prometheus_lock:
+        if _prometheus_deferred:
+            _prometheus_dirty = True
+        else:
+            _sync_prometheus_data_to_yml()
+
+
+@contextmanager
+def deferred_prometheus_sync():
+    """Sync the prometheus targets once after the block, instead of on every node change in it."""
+    global _prometheus_deferred, _prometheus_dirty
+    with _prometheus_lock:
+        _prometheus_deferred += 1
+    try:
+        yield
+    finally:
+        with _prometheus_lock:
+            _prometheus_deferred -= 1
+            if not _prometheus_deferred and _prometheus_dirty:
+                _prometheus_dirty = False
+                _sync_prometheus_data_to_yml()
+
+
 @receiver(post_save, sender=Node)
 def update_prometheus_targets(sender, **kwargs):
     """Update prometheus targets when network devices are added or modified."""
-    sync_prometheus_data_to_yml()
+    request_prometheus_sync()
 
 
 @receiver(post_save, sender=Node)
@@ -43,4 +83,4 @@ def delete_unknown_nodes(sender, created=False, instance=None, **kwargs):
 @receiver(post_delete, sender=Node)
 def remove_prometheus_targets(**kwargs):
     """Update prometheus targets when network devices are deleted."""
-    sync_prometheus_data_to_yml()
+    request_prometheus_sync()
@@ -0,0 +1,123 @@
+"""Long-lived connections to the radiusdesk and unifi databases.
+
+Each worker process keeps a pool of radiusdesk MySQL connections and a single
+unifi MongoClient (which pools its own sockets), instead of opening new ones
+for every sync. Connections are health-checked before they are handed out,
+and reconnected with exponential backoff if that fails.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, TypeVar
+
+import mysql.connector
+from django.conf import settings
+from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger("general")
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+# Keyed by process ID, so forked celery workers don't share their parent's sockets
+_mysql_pools: dict[int, MySQLConnectionPool] = {}
+_mongo_clients: dict[int, MongoClient] = {}
+
+
+def with_backoff(connect: Callable[[], T], name: str, errors: tuple[type[Exception], ...]) -> T:
+    """Call connect, retrying with exponential backoff if it raises one of errors."""
+    retries = settings.SYNC_CONNECT_RETRIES
+    for attempt in range(retries + 1):
+        try:
+            return connect()
+        except errors as e:
+            if attempt == retries:
+                raise
+            delay = settings.SYNC_CONNECT_BACKOFF * 2**attempt
+            logger.warning("Couldn't connect to %s (%s), retrying in %.1fs", name, e, delay)
+            time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def get_mysql_pool() -> MySQLConnectionPool:
+    """Get this process' radiusdesk connection pool, creating it if necessary."""
+    pid = os.getpid()
+    with _lock:
+        if pid not in _mysql_pools:
+            _mysql_pools[pid] = MySQLConnectionPool(
+                pool_name=f"radiusdesk-{pid}",
+                pool_size=settings.RD_DB_POOL_SIZE,
+                host=settings.RD_DB_HOST,
+                user=settings.RD_DB_USER,
+                password=settings.RD_DB_PASSWORD,
+                database=settings.RD_DB_NAME,
+                port=settings.RD_DB_PORT,
+            )
+        return _mysql_pools[pid]
+
+
+def get_mysql_connection() -> PooledMySQLConnection:
+    """Get a healthy connection from the pool. Close it to return it to the pool."""
+
+    def connect():
+        connection = get_mysql_pool().get_connection()
+        try:
+            # Reconnects if the server closed the connection while it was idle
+            connection.ping(reconnect=True)
+        except mysql.connector.Error:
+            connection.close()
+            raise
+        return connection
+
+    return with_backoff(connect, "radiusdesk", (mysql.connector.Error,))
+
+
+def get_mongo_client() -> MongoClient:
+    """Get this process' healthy unifi client, creating it if necessary."""
+    pid = os.getpid()
+
+    def connect():
+        with _lock:
+            client = _mongo_clients.get(pid)
+            if client is None:
+                client = _mongo_clients[pid] = MongoClient(
+                    host=settings.UNIFI_DB_HOST,
+                    port=int(settings.UNIFI_DB_PORT),
+                    username=settings.UNIFI_DB_USER,
+                    password=settings.UNIFI_DB_PASSWORD,
+                    maxPoolSize=settings.UNIFI_DB_MAX_POOL_SIZE,
+                )
+        try:
+            client.admin.command("ping")
+        except PyMongoError:
+            with _lock:
+                if _mongo_clients.get(pid) is client:
+                    del _mongo_clients[pid]
+            client.close()
+            raise
+        return client
+
+    return with_backoff(connect, "unifi", (PyMongoError,))
+
+
+@contextmanager
+def radiusdesk_cursor():
+    """Borrow a pooled radiusdesk connection and open an unbuffered cursor on it."""
+    connection = get_mysql_connection()
+    try:
+        # Unbuffered, so rows are read from the server as they're fetched
+        with connection.cursor(buffered=False) as cursor:
+            yield cursor
+    finally:
+        connection.close()
+
+
+@contextmanager
+def unifi_client():
+    """Use the shared unifi client. It is kept open after the sync."""
+    yield get_mongo_client()
@@ -0,0 +1,218 @@
+"""Run sync stages concurrently, following their dependencies."""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import billiard
+from django.conf import settings
+from django.db import connections
+from django.utils.timezone import now
+
+from monitoring.models import SyncRun, SyncStage
+from monitoring.signals import deferred_prometheus_sync
+from .shards import init_shard_process
+from .utils import SyncContext, SyncStats, peak_rss, set_watermark
+
+logger = logging.getLogger("general")
+
+
+@dataclass
+class Stage:
+    """A sync stage, e.g. a bulk_sync function, and the stages it depends on."""
+
+    name: str
+    # Called with a source connection and the run's SyncContext
+    func: Callable[[Any, SyncContext], Any]
+    # Opens a new source connection, used by this stage only
+    connect: Callable[[], AbstractContextManager]
+    depends_on: tuple[str, ...] = ()
+    # Split into SYNC_METRIC_SHARDS processes by MAC address
+    sharded: bool = False
+
+    @property
+    def source(self) -> str:
+        """Name of the stage's source, the prefix of stage names like 'unifi.nodes'."""
+        return self.name.partition(".")[0]
+
+
+def stage_stats(result: Any) -> SyncStats:
+    """Get the stats of a stage from a bulk_sync or bulk_sync_many result."""
+    if isinstance(result, SyncStats):
+        return result
+    if isinstance(result, dict):
+        return SyncStats.merge([s for s in result.values() if isinstance(s, SyncStats)])
+    return SyncStats()
+
+
+def merge_results(results: list[Any]) -> Any:
+    """Merge the bulk_sync or bulk_sync_many results of a stage's shards."""
+    if all(isinstance(result, SyncStats) for result in results):
+        return SyncStats.merge(results)
+    return {key: SyncStats.merge([result[key] for result in results]) for key in results[0]}
+
+
+def run_shard(stage: Stage, full: bool, shard: int, shards: int) -> Any:
+    """Run a single shard of a stage, in a shard process."""
+    try:
+        with stage.connect() as source:
+            return stage.func(source, SyncContext(full=full, shard=shard, shards=shards))
+    finally:
+        connections.close_all()
+
+
+def run_sharded(stage: Stage, ctx: SyncContext) -> Any:
+    """Run a stage's shards in parallel processes and merge their results.
+
+    The stage's checkpoint is only advanced once all shards have succeeded.
+    """
+    shards = settings.SYNC_METRIC_SHARDS
+    # Shard processes read settings from scratch, so pass on any that were
+    # changed at runtime (e.g. syncbench's test databases)
+    overrides = {
+        name: getattr(settings, name)
+        for name in dir(settings)
+        if name == "DATABASES" or name.startswith(("SYNC_", "RD_", "UNIFI_"))
+    }
+    # Celery's billiard rather than multiprocessing, whose daemonic processes
+    # (e.g. celery's pool workers) can't start processes. Spawn rather than
+    # fork, forking a process with running threads isn't safe.
+    context = billiard.get_context("spawn")
+    with context.Pool(shards, init_shard_process, (overrides,)) as pool:
+        result = merge_results(pool.starmap(run_shard, [(stage, ctx.full, shard, shards) for shard in range(shards)]))
+    checkpoint = getattr(stage.func, "checkpoint", None)
+    watermark = stage_stats(result).watermark
+    if checkpoint and watermark is not None:
+        set_watermark(*checkpoint, watermark)
+    return result
+
+
+def record_stage(sync_run: SyncRun | None, stage: Stage, status: str, **fields) -> None:
+    """Store a stage's telemetry with its run, if the run is being recorded."""
+    if sync_run is None:
+        return
+    SyncStage.objects.create(run=sync_run, name=stage.name, source=stage.source, status=status, **fields)
+
+
+def run_stage(stage: Stage, ctx: SyncContext, sync_run: SyncRun | None = None) -> Any:
+    """Run a single stage with its own source connection."""
+    started = now()
+    start_time = time.time()
+    try:
+        try:
+            if stage.sharded and settings.SYNC_METRIC_SHARDS > 1:
+                result = run_sharded(stage, ctx)
+            else:
+                with stage.connect() as source:
+                    result = stage.func(source, ctx)
+        except Exception as e:
+            duration = time.time() - start_time
+            record_stage(sync_run, stage, "failed", started=started, duration=duration, error=repr(e))
+            raise
+        duration = time.time() - start_time
+        stats = stage_stats(result)
+        record_stage(
+            sync_run,
+            stage,
+            "succeeded",
+            started=started,
+            duration=duration,
+            rows_read=stats.rows_read,
+            created=stats.created,
+            updated=stats.updated,
+            unchanged=stats.unchanged,
+            deleted=stats.deleted,
+            query_time=stats.query_time,
+            write_time=stats.write_time,
+        )
+    finally:
+        # Django opens a database connection per thread, close this one
+        # so that it isn't left open in the thread pool
+        connections.close_all()
+    print(f"Finished stage {stage.name} in {duration:.2f}s")
+    return result
+
+
+def skip_stages(pending: list[Stage], failed: set[str], sync_run: SyncRun | None = None) -> None:
+    """Remove pending stages that (indirectly) depend on a failed stage."""
+    skipped = True
+    while skipped:
+        skipped = False
+        for stage in list(pending):
+            if failed.intersection(stage.depends_on):
+                logger.warning("Skipping stage %s, a stage it depends on failed", stage.name)
+                record_stage(sync_run, stage, "skipped", started=now())
+                failed.add(stage.name)
+                pending.remove(stage)
+                skipped = True
+
+
+def run_stages(
+    stages: list[Stage],
+    ctx: SyncContext,
+    max_workers: int | None = None,
+    sync_run: SyncRun | None = None,
+) -> dict[str, Any]:
+    """Run stages on a thread pool, each as soon as its dependencies are done.
+
+    Stages that depend on a failed stage are skipped. Once all other stages
+    are done, the first error is raised again. If a run is given, each
+    stage's telemetry is recorded with it. Prometheus targets are synced
+    once all stages are done, rather than by each stage's node saves
+    concurrently.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        unknown = set(stage.depends_on) - names
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages {unknown}")
+    pending = list(stages)
+    running: dict[Future, Stage] = {}
+    results: dict[str, Any] = {}
+    failed: set[str] = set()
+    errors: list[Exception] = []
+    with deferred_prometheus_sync(), ThreadPoolExecutor(max_workers or settings.SYNC_MAX_WORKERS) as executor:
+        while pending or running:
+            skip_stages(pending, failed, sync_run)
+            for stage in list(pending):
+                if all(dep in results for dep in stage.depends_on):
+                    running[executor.submit(run_stage, stage, ctx, sync_run)] = stage
+                    pending.remove(stage)
+            if not running:
+                if pending:
+                    raise ValueError(f"Stages {[s.name for s in pending]} have circular dependencies")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as e:
+                    logger.exception("Sync stage %s failed", stage.name)
+                    failed.add(stage.name)
+                    errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run(stages: list[Stage], full: bool = False, name: str = "sources") -> dict[str, Any]:
+    """Sync a list of stages, optionally ignoring checkpoints, and record the run."""
+    start_time = time.time()
+    sync_run = SyncRun.objects.create(sources=name, full=full)
+    try:
+        results = run_stages(stages, SyncContext(full=full), sync_run=sync_run)
+    except Exception:
+        sync_run.status = "failed"
+        raise
+    else:
+        sync_run.status = "succeeded"
+    finally:
+        sync_run.duration = time.time() - start_time
+        sync_run.worker_peak_rss = peak_rss()
+        sync_run.save(update_fields=["status", "duration", "worker_peak_rss"])
+    print(f"Synced with {name} in {sync_run.duration:.2f}s (peak RSS {sync_run.worker_peak_rss:.1f}MB)")
+    return results
@@ -1,15 +1,18 @@
 """Sync with a radiusdesk database."""
 
 import pytz
-import time
+from datetime import datetime
 
-from mysql.connector import connect
 from django.conf import settings
-from django.utils.timezone import make_aware, now
+from django.db.models import Max
+from django.utils.timezone import now
 
 from monitoring.models import Mesh, Node, UnknownNode
 from metrics.models import FailuresMetric, ResourcesMetric, DataUsageMetric
-from .utils import bulk_sync
+from . import orchestrator
+from .connections import radiusdesk_cursor
+from .orchestrator import Stage
+from .utils import SyncContext, bulk_sync
 
 
 GET_MESHES_QUERY = """
@@ -28,25 +31,71 @@ ON a.ap_profile_id = p.id
 JOIN clouds c
 ON p.cloud_id = c.id;
 """
-GET_NODE_AND_AP_BYTES_QUERY = """
-SELECT n.mac, s.tx_bytes, s.rx_bytes, s.created
+# Only the station rows of the MACs in a shard, see utils.shard_of()
+SHARD = "(%(shards)s = 1 OR MOD(CRC32({}), %(shards)s) = %(shard)s)"
+# Several stations of a node can report at the same time, their rows are
+# summed since metrics are unique per (mac, created)
+GET_NODE_AND_AP_BYTES_QUERY = f"""
+SELECT n.mac, SUM(s.tx_bytes), SUM(s.rx_bytes), s.created
 FROM node_stations s
 JOIN nodes n
-ON s.node_id = n.id;
-SELECT a.mac, s.tx_bytes, s.rx_bytes, s.created
+ON s.node_id = n.id
+WHERE s.created >= %(since)s AND {SHARD.format("n.mac")}
+GROUP BY n.mac, s.created;
+SELECT a.mac, SUM(s.tx_bytes), SUM(s.rx_bytes), s.created
 FROM ap_stations s
 JOIN aps a
-ON s.ap_id = a.id;
+ON s.ap_id = a.id
+WHERE s.created >= %(since)s AND {SHARD.format("a.mac")}
+GROUP BY a.mac, s.created;
 """
-GET_NODE_AND_AP_FAILURES_QUERY = """
-SELECT n.mac, s.tx_packets, s.rx_packets, s.tx_failed, s.tx_retries, s.created
+GET_NODE_AND_AP_FAILURES_QUERY = f"""
+SELECT n.mac, SUM(s.tx_packets), SUM(s.rx_packets), SUM(s.tx_failed), SUM(s.tx_retries), s.created
 FROM node_stations s
 JOIN nodes n
-ON s.node_id = n.id;
-SELECT a.mac, s.tx_packets, s.rx_packets, s.tx_failed, s.tx_retries, s.created
+ON s.node_id = n.id
+WHERE s.created >= %(since)s AND {SHARD.format("n.mac")}
+GROUP BY n.mac, s.created;
+SELECT a.mac, SUM(s.tx_packets), SUM(s.rx_packets), SUM(s.tx_failed), SUM(s.tx_retries), s.created
 FROM ap_stations s
 JOIN aps a
-ON s.ap_id = a.id;
+ON s.ap_id = a.id
+WHERE s.created >= %(since)s AND {SHARD.format("a.mac")}
+GROUP BY a.mac, s.created;
+"""
+# Aggregated versions of the station queries, summing each node's rows per
+# time bucket in MySQL. The bucket that `since` falls in is re-read in full,
+# so that partially synced buckets are overwritten with complete sums.
+BUCKET = "FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP({}) / %(bucket)s) * %(bucket)s)"
+GET_NODE_AND_AP_BYTES_BUCKETED_QUERY = f"""
+SELECT n.mac, SUM(s.tx_bytes), SUM(s.rx_bytes), {BUCKET.format("s.created")} AS bucket
+FROM node_stations s
+JOIN nodes n
+ON s.node_id = n.id
+WHERE s.created >= {BUCKET.format("%(since)s")} AND {SHARD.format("n.mac")}
+GROUP BY n.mac, bucket;
+SELECT a.mac, SUM(s.tx_bytes), SUM(s.rx_bytes), {BUCKET.format("s.created")} AS bucket
+FROM ap_stations s
+JOIN aps a
+ON s.ap_id = a.id
+WHERE s.created >= {BUCKET.format("%(since)s")} AND {SHARD.format("a.mac")}
+GROUP BY a.mac, bucket;
+"""
+GET_NODE_AND_AP_FAILURES_BUCKETED_QUERY = f"""
+SELECT n.mac, SUM(s.tx_packets), SUM(s.rx_packets), SUM(s.tx_failed), SUM(s.tx_retries),
+{BUCKET.format("s.created")} AS bucket
+FROM node_stations s
+JOIN nodes n
+ON s.node_id = n.id
+WHERE s.created >= {BUCKET.format("%(since)s")} AND {SHARD.format("n.mac")}
+GROUP BY n.mac, bucket;
+SELECT a.mac, SUM(s.tx_packets), SUM(s.rx_packets), SUM(s.tx_failed), SUM(s.tx_retries),
+{BUCKET.format("s.created")} AS bucket
+FROM ap_stations s
+JOIN aps a
+ON s.ap_id = a.id
+WHERE s.created >= {BUCKET.format("%(since)s")} AND {SHARD.format("a.mac")}
+GROUP BY a.mac, bucket;
 """
 GET_NODE_AND_AP_RESOURCES_QUERY = """
 SELECT n.mac, l.mem_total, l.mem_free
@@ -64,19 +113,63 @@ FROM unknown_nodes u;
 """
 
 TZ = pytz.timezone("Africa/Johannesburg")
+# Lower bound used for full syncs, when there's no checkpoint yet
+EPOCH = datetime(1970, 1, 1)
+
+
+def fetch_rows(cursor):
+    """Stream rows from an unbuffered cursor in chunks of SYNC_BATCH_SIZE.
+
+    Rows are passed on to bulk_sync as they arrive, so memory use doesn't grow
+    with the size of the radiusdesk tables.
+    """
+    while rows := cursor.fetchmany(settings.SYNC_BATCH_SIZE):
+        yield from rows
+
+
+def localize(value: datetime) -> datetime:
+    """Make a naive local time stored by radiusdesk aware.
+
+    pytz time zones must be attached with localize(), replace() would use the
+    zone's first offset (LMT), which is a few minutes off.
+    """
+    return TZ.localize(value)
+
+
+def since_param(since: datetime | None) -> dict:
+    """Query parameters for the naive local times that radiusdesk stores."""
+    if since is None:
+        return {"since": EPOCH}
+    # The inverse of localize()
+    return {"since": since.astimezone(TZ).replace(tzinfo=None)}
+
+
+def int_or_none(value) -> int | None:
+    """Convert a nullable MySQL number (or sum) to an int."""
+    return None if value is None else int(value)
+
+
+def station_query(query: str, bucketed_query: str, ctx: SyncContext, since: datetime | None) -> tuple[str, dict]:
+    """Pick the raw or aggregated station query, depending on RD_METRICS_BUCKET."""
+    params = since_param(since)
+    params.update(shard=ctx.shard, shards=ctx.shards)
+    if settings.RD_METRICS_BUCKET is None:
+        return query, params
+    params["bucket"] = int(settings.RD_METRICS_BUCKET.total_seconds())
+    return bucketed_query, params
 
 
 @bulk_sync(Mesh)
-def sync_meshes(cursor):
+def sync_meshes(cursor, ctx):
     """Sync Mesh objects from the radiusdesk database."""
     cursor.execute(GET_MESHES_QUERY)
-    for name, created in cursor.fetchall():
+    for name, created in fetch_rows(cursor):
         yield {}, {"name": name}
 
 
 # The nodes that are out of sync mustn't be deleted, they can be potentially added to radiusdesk later
 @bulk_sync(Node, delete=False)
-def sync_nodes(cursor):
+def sync_nodes(cursor, ctx):
     """Sync Node objects from the radiusdesk database."""
     for result in cursor.execute(GET_NODES_AND_APS_QUERY, multi=True):
         for (
@@ -87,9 +180,9 @@ def sync_nodes(cursor):
             hardware,
             ip,
             last_contact_from_ip,
-        ) in result.fetchall():
+        ) in fetch_rows(result):
             data = dict(
-                mesh=Mesh.objects.get(name=mesh_name),
+                mesh=ctx.get_mesh(mesh_name),
                 name=name,
                 description=description,
                 mac=mac,
@@ -100,42 +193,44 @@ def sync_nodes(cursor):
 
 
 @bulk_sync(UnknownNode)
-def sync_unknown_nodes(cursor):
+def sync_unknown_nodes(cursor, ctx):
     """Sync UnknownNode objects from the radiusdesk database."""
     cursor.execute(GET_UNKNOWN_NODES_QUERY)
-    for mac, vendor, from_ip, gateway, last_contact, created, name in cursor.fetchall():
+    for mac, vendor, from_ip, gateway, last_contact, created, name in fetch_rows(cursor):
         # If there already exists a node with the same MAC, don't
         # create a new UnknownNode
-        if Node.objects.filter(mac=mac).exists():
+        if ctx.node_exists(mac):
             continue
         data = dict(
             vendor=vendor,
             from_ip=from_ip,
             gateway=gateway,
-            last_contact=make_aware(last_contact, TZ),
-            created=make_aware(created, TZ),
+            last_contact=localize(last_contact),
+            created=localize(created),
             name=name,
         )
         yield data, {"mac": mac}
 
 
-@bulk_sync(DataUsageMetric)
-def sync_node_bytes_metrics(cursor):
+@bulk_sync(DataUsageMetric, checkpoint=("radiusdesk", "node_bytes"))
+def sync_node_bytes_metrics(cursor, ctx, since):
     """Sync BytesMetric objects from the radiusdesk database."""
-    for result in cursor.execute(GET_NODE_AND_AP_BYTES_QUERY, multi=True):
-        for mac, tx_bytes, rx_bytes, created in result.fetchall():
+    query, params = station_query(GET_NODE_AND_AP_BYTES_QUERY, GET_NODE_AND_AP_BYTES_BUCKETED_QUERY, ctx, since)
+    for result in cursor.execute(query, params, multi=True):
+        for mac, tx_bytes, rx_bytes, created in fetch_rows(result):
+            # MySQL sums are decimals
             data = dict(
-                mac=mac,
-                tx_bytes=tx_bytes,
-                rx_bytes=rx_bytes,
+                tx_bytes=int(tx_bytes),
+                rx_bytes=int(rx_bytes),
             )
-            yield data, {"created": make_aware(created, TZ)}
+            yield data, {"mac": mac, "created": localize(created)}
 
 
-@bulk_sync(FailuresMetric)
-def sync_node_failures_metrics(cursor):
+@bulk_sync(FailuresMetric, checkpoint=("radiusdesk", "node_failures"))
+def sync_node_failures_metrics(cursor, ctx, since):
     """Sync FailuresMetric objects from the radiusdesk database."""
-    for result in cursor.execute(GET_NODE_AND_AP_FAILURES_QUERY, multi=True):
+    query, params = station_query(GET_NODE_AND_AP_FAILURES_QUERY, GET_NODE_AND_AP_FAILURES_BUCKETED_QUERY, ctx, since)
+    for result in cursor.execute(query, params, multi=True):
         for (
             node_mac,
             tx_packets,
@@ -143,45 +238,68 @@ def sync_node_failures_metrics(cursor):
             tx_failed,
             tx_retries,
             created,
-        ) in result.fetchall():
+        ) in fetch_rows(result):
             data = dict(
-                mac=node_mac,
-                tx_packets=tx_packets,
-                rx_packets=rx_packets,
-                tx_dropped=tx_failed,
-                tx_retries=tx_retries,
+                tx_packets=int(tx_packets),
+                rx_packets=int(rx_packets),
+                tx_dropped=int_or_none(tx_failed),
+                tx_retries=int_or_none(tx_retries),
             )
-            yield data, {"created": make_aware(created, TZ)}
+            yield data, {"mac": node_mac, "created": localize(created)}
+
+
+def get_latest_resources(macs) -> dict:
+    """Get the latest ResourcesMetric of each of the given nodes, by MAC address."""
+    latest = dict(
+        ResourcesMetric.objects.filter(mac__in=macs)
+        .values("mac")
+        .annotate(latest=Max("created"))
+        .values_list("mac", "latest")
+    )
+    # Other nodes' samples can share a node's latest time, those are skipped
+    qs = ResourcesMetric.objects.filter(mac__in=latest, created__in=set(latest.values()))
+    return {metric.mac: metric for metric in qs if metric.created == latest[metric.mac]}
 
 
 @bulk_sync(ResourcesMetric)
-def sync_node_resources_metrics(cursor):
-    """Sync NodeLoad objects from the radiusdesk database."""
-    for result in cursor.execute(GET_NODE_AND_AP_RESOURCES_QUERY, multi=True):
-        for node_mac, mem_total, mem_free in result.fetchall():
-            data = dict(
-                mac=node_mac,
-                memory=mem_free/mem_total*100,
-                cpu=-1,  # Radiusdesk doesn't track CPU usage??
-            )
-            yield data, {"created": now()}
-
-
-def run():
-    with connect(
-        host=settings.RD_DB_HOST,
-        user=settings.RD_DB_USER,
-        password=settings.RD_DB_PASSWORD,
-        database=settings.RD_DB_NAME,
-        port=settings.RD_DB_PORT,
-    ) as connection:
-        with connection.cursor() as cursor:
-            start_time = time.time()
-            sync_meshes(cursor)
-            sync_nodes(cursor)
-            sync_unknown_nodes(cursor)
-            sync_node_bytes_metrics(cursor)
-            sync_node_resources_metrics(cursor)
-            sync_node_failures_metrics(cursor)
-            elapsed_time = time.time() - start_time
-            print(f"Synced with radiusdesk in {elapsed_time:.2f}s")
+def sync_node_resources_metrics(cursor, ctx):
+    """Sync NodeLoad objects from the radiusdesk database.
+
+    Radiusdesk only has each node's current load, so a sample is only stored
+    when it differs from the node's latest one. Otherwise, the latest sample
+    is extended to be valid until now.
+    """
+    # There's a single row per node, so they're all read before looking up
+    # the latest samples of their nodes
+    rows = [row for result in cursor.execute(GET_NODE_AND_AP_RESOURCES_QUERY, multi=True) for row in fetch_rows(result)]
+    to_mac = ResourcesMetric._meta.get_field("mac").to_python
+    latest = get_latest_resources({to_mac(node_mac) for node_mac, _, _ in rows})
+    synced = now()
+    for node_mac, mem_total, mem_free in rows:
+        memory = mem_free/mem_total*100
+        cpu = -1  # Radiusdesk doesn't track CPU usage??
+        sample = latest.get(to_mac(node_mac))
+        if sample is not None and sample.is_close(memory, cpu, settings.RD_RESOURCES_TOLERANCE):
+            yield {"valid_until": synced}, {"mac": node_mac, "created": sample.created}
+        else:
+            data = dict(memory=memory, cpu=cpu, valid_until=synced)
+            yield data, {"mac": node_mac, "created": synced}
+
+
+def stages() -> list[Stage]:
+    """Radiusdesk sync stages. Metrics only depend on nodes having been synced.
+
+    The station metric stages can be split into SYNC_METRIC_SHARDS processes.
+    """
+    return [
+        Stage("radiusdesk.meshes", sync_meshes, radiusdesk_cursor),
+        Stage("radiusdesk.nodes", sync_nodes, radiusdesk_cursor, ("radiusdesk.meshes",)),
+        Stage("radiusdesk.unknown_nodes", sync_unknown_nodes, radiusdesk_cursor, ("radiusdesk.nodes",)),
+        Stage("radiusdesk.bytes", sync_node_bytes_metrics, radiusdesk_cursor, ("radiusdesk.nodes",), sharded=True),
+        Stage("radiusdesk.resources", sync_node_resources_metrics, radiusdesk_cursor, ("radiusdesk.nodes",)),
+        Stage("radiusdesk.failures", sync_node_failures_metrics, radiusdesk_cursor, ("radiusdesk.nodes",), sharded=True),
+    ]
+
+
+def run(full: bool = False):
+    orchestrator.run(stages(), full=full, name="radiusdesk")
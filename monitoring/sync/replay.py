@@ -0,0 +1,394 @@
+"""Record, replay and synthesize the source data read by the syncs.
+
+Snapshots are JSON files holding the result sets of the radiusdesk queries or
+the documents of the unifi collections that the syncs read. Replaying them
+lets the syncs run (and be benchmarked) without live radiusdesk or unifi
+databases.
+"""
+
+import itertools
+import json
+import random
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from functools import partial
+
+from . import radiusdesk, unifi
+from .connections import radiusdesk_cursor, unifi_client
+from .orchestrator import Stage
+from .utils import SyncContext, shard_of
+
+# Radiusdesk queries that are recorded, by name
+RADIUSDESK_QUERIES = [
+    "GET_MESHES_QUERY",
+    "GET_NODES_AND_APS_QUERY",
+    "GET_NODE_AND_AP_BYTES_QUERY",
+    "GET_NODE_AND_AP_FAILURES_QUERY",
+    "GET_NODE_AND_AP_RESOURCES_QUERY",
+    "GET_UNKNOWN_NODES_QUERY",
+]
+# Bucketed station queries (see RD_METRICS_BUCKET), by the name of the
+# recorded query whose rows they sum per bucket
+BUCKETED_QUERIES = {
+    "GET_NODE_AND_AP_BYTES_BUCKETED_QUERY": "GET_NODE_AND_AP_BYTES_QUERY",
+    "GET_NODE_AND_AP_FAILURES_BUCKETED_QUERY": "GET_NODE_AND_AP_FAILURES_QUERY",
+}
+# Unifi collections that are recorded, with the filter used to record them
+UNIFI_COLLECTIONS = {
+    "ace.site": {},
+    "ace.device": {},
+    "ace.event": {"key": "EVT_AP_Adopted"},
+    "ace_stat.stat_hourly": {"o": "ap"},
+}
+
+
+def encode(value):
+    """Make a value from a source JSON serializable."""
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    return value
+
+
+def decode(value):
+    """Revert encode()."""
+    if isinstance(value, dict):
+        if "$datetime" in value:
+            return datetime.fromisoformat(value["$datetime"])
+        return {k: decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+
+def save_snapshot(snapshot: dict, path: str) -> None:
+    """Write a snapshot to a JSON file."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(encode(snapshot), f)
+
+
+def load_snapshot(path: str) -> dict:
+    """Read a snapshot from a JSON file."""
+    with open(path, "r", encoding="utf-8") as f:
+        return decode(json.load(f))
+
+
+def record_radiusdesk() -> dict:
+    """Snapshot the full result sets of the radiusdesk sync queries."""
+    queries = {}
+    # The parameters of a full, unsharded sync
+    ctx = SyncContext()
+    params = {**radiusdesk.since_param(None), "shard": ctx.shard, "shards": ctx.shards}
+    with radiusdesk_cursor() as cursor:
+        for name in RADIUSDESK_QUERIES:
+            results = cursor.execute(getattr(radiusdesk, name), params, multi=True)
+            queries[name] = [list(radiusdesk.fetch_rows(result)) for result in results]
+    return {"source": "radiusdesk", "queries": queries}
+
+
+def record_unifi() -> dict:
+    """Snapshot the documents of the unifi collections read by the sync."""
+    collections = {}
+    with unifi_client() as client:
+        for name, query in UNIFI_COLLECTIONS.items():
+            db_name, collection_name = name.split(".")
+            documents = client[db_name][collection_name].find(query, {"_id": 0})
+            collections[name] = list(documents)
+    return {"source": "unifi", "collections": collections}
+
+
+class ReplayResult:
+    """A single recorded result set, read like an unbuffered cursor."""
+
+    def __init__(self, rows: list):
+        self._rows = iter(rows)
+
+    def fetchmany(self, size: int = 1) -> list:
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self) -> list:
+        return list(self._rows)
+
+
+def bucket_rows(rows: list, bucket: int) -> list[list]:
+    """Sum station rows per MAC and bucket of seconds, like the bucketed station queries.
+
+    Rows start with the MAC and end with the time, the values in between are
+    summed.
+    """
+    sums: dict[tuple, list] = {}
+    for mac, *values, created in rows:
+        seconds = created.replace(tzinfo=timezone.utc).timestamp() // bucket * bucket
+        key = (mac, datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None))
+        if key not in sums:
+            sums[key] = values
+        else:
+            # Like SQL's SUM(), NULLs are ignored
+            sums[key] = [a if b is None else b if a is None else a + b for a, b in zip(sums[key], values)]
+    return [[mac, *values, start] for (mac, start), values in sums.items()]
+
+
+class ReplayCursor(ReplayResult):
+    """Cursor that answers the radiusdesk sync queries from a snapshot.
+
+    Sync checkpoints are ignored, the full recorded result sets are always
+    returned. Only rows in the queried shard are returned for sharded queries.
+    Bucketed station queries are answered by summing the recorded station
+    rows, so snapshots replay with any RD_METRICS_BUCKET.
+    """
+
+    def __init__(self, snapshot: dict):
+        super().__init__([])
+        self.queries = {getattr(radiusdesk, name): results for name, results in snapshot["queries"].items()}
+        self.bucketed = {
+            getattr(radiusdesk, name): snapshot["queries"][raw_name]
+            for name, raw_name in BUCKETED_QUERIES.items()
+            if raw_name in snapshot["queries"]
+        }
+
+    def execute(self, query: str, params=None, multi: bool = False):
+        if query in self.bucketed:
+            results = [bucket_rows(rows, params["bucket"]) for rows in self.bucketed[query]]
+        elif query in self.queries:
+            results = self.queries[query]
+        else:
+            names = [name for name in dir(radiusdesk) if getattr(radiusdesk, name) == query]
+            raise ValueError(f"{names[0] if names else 'The query'} wasn't recorded in the snapshot")
+        if params and params.get("shards", 1) > 1:
+            # Sharded queries are all station queries, which start with the MAC
+            results = [
+                [row for row in rows if shard_of(row[0], params["shards"]) == params["shard"]]
+                for rows in results
+            ]
+        if multi:
+            return (ReplayResult(rows) for rows in results)
+        self._rows = iter(results[0])
+        return None
+
+
+def matches(document: dict, query: dict) -> bool:
+    """Check whether a document matches a (simple) mongo query."""
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            if "$gte" in condition and (value is None or value < condition["$gte"]):
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(document: dict, projection: dict | None) -> dict:
+    """Apply an inclusion projection to a document."""
+    if not projection:
+        return dict(document)
+    return {k: v for k, v in document.items() if projection.get(k)}
+
+
+class ReplayCollection:
+    """Collection that answers the unifi sync's reads from a snapshot."""
+
+    def __init__(self, documents: list[dict]):
+        self.documents = documents
+
+    def find(self, query: dict | None = None, projection: dict | None = None):
+        for document in self.documents:
+            if matches(document, query or {}):
+                yield project(document, projection)
+
+    def distinct(self, key: str, query: dict | None = None) -> list:
+        return list(dict.fromkeys(d[key] for d in self.find(query) if key in d))
+
+    def aggregate(self, pipeline: list[dict]):
+        # Each stage is applied in full before the next, lazily applied stages
+        # would all see the last stage's arg
+        documents = self.documents
+        for step in pipeline:
+            (op, arg), = step.items()
+            if op == "$match":
+                documents = [d for d in documents if matches(d, arg)]
+            elif op == "$project":
+                documents = [project(d, arg) for d in documents]
+            elif op == "$sort":
+                documents = sort(documents, arg)
+            elif op == "$group":
+                documents = group(documents, arg)
+            else:
+                raise ValueError(f"Unsupported aggregation stage {op}")
+        return iter(documents)
+
+
+def sort(documents, spec: dict) -> list[dict]:
+    """Apply a $sort stage, documents missing a field sort before the others like in mongo."""
+    documents = list(documents)
+    for key, direction in reversed(spec.items()):
+        documents.sort(key=lambda d: (d.get(key) is not None, d.get(key)), reverse=direction < 0)
+    return documents
+
+
+def group(documents, spec: dict) -> list[dict]:
+    """Apply a $group stage, grouping on a single field with $first accumulators."""
+    groups: dict = {}
+    for document in documents:
+        key = document.get(spec["_id"].lstrip("$"))
+        if key not in groups:
+            groups[key] = {"_id": key}
+            for name, accumulator in spec.items():
+                if name != "_id":
+                    groups[key][name] = document.get(accumulator["$first"].lstrip("$"))
+    return list(groups.values())
+
+
+class ReplayClient:
+    """Mongo client that answers the unifi sync's reads from a snapshot."""
+
+    def __init__(self, snapshot: dict):
+        self.collections = {
+            name: ReplayCollection(documents) for name, documents in snapshot["collections"].items()
+        }
+
+    def __getitem__(self, db_name: str):
+        return ReplayDatabase(self, db_name)
+
+    __getattr__ = __getitem__
+
+
+class ReplayDatabase:
+    """A database of a ReplayClient."""
+
+    def __init__(self, client: ReplayClient, name: str):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, collection_name: str) -> ReplayCollection:
+        return self.client.collections.get(f"{self.name}.{collection_name}", ReplayCollection([]))
+
+    __getattr__ = __getitem__
+
+
+@contextmanager
+def replay_connect(backend, snapshot: dict):
+    """Open a replay cursor or client, like radiusdesk_cursor or unifi_client."""
+    yield backend(snapshot)
+
+
+def replay_stages(snapshot: dict) -> list[Stage]:
+    """The stages of the snapshot's source, reading from the snapshot."""
+    if snapshot["source"] == "radiusdesk":
+        stages, backend = radiusdesk.stages(), ReplayCursor
+    else:
+        stages, backend = unifi.stages(), ReplayClient
+    for stage in stages:
+        # A partial rather than a closure, so sharded stages can be pickled
+        stage.connect = partial(replay_connect, backend, snapshot)
+    return stages
+
+
+def synthesize_macs(n: int) -> list[str]:
+    """Generate n distinct, locally administered MAC addresses."""
+    return [":".join(f"{b:02x}" for b in (0x02, 0, *i.to_bytes(4, "big"))) for i in range(n)]
+
+
+def synthesize_ip(i: int) -> str:
+    """Generate the i-th address in 10.0.0.0/8."""
+    return ".".join(str(b) for b in (10, *i.to_bytes(3, "big")))
+
+
+def synthesize_radiusdesk(nodes: int, stations: int, template: dict | None = None, meshes: int = 10) -> dict:
+    """Generate a radiusdesk snapshot with nodes x stations station rows.
+
+    Station values are taken from a recorded template snapshot if one is
+    given, otherwise they're random.
+    """
+    rng = random.Random(0)
+    queries = (template or {}).get("queries", {})
+    bytes_rows = [row for rows in queries.get("GET_NODE_AND_AP_BYTES_QUERY", []) for row in rows]
+    failure_rows = [row for rows in queries.get("GET_NODE_AND_AP_FAILURES_QUERY", []) for row in rows]
+    mesh_names = [f"mesh-{i}" for i in range(max(1, min(meshes, nodes)))]
+    macs = synthesize_macs(nodes)
+    start = datetime(2024, 1, 1)
+    node_rows, byte_rows, failures, loads = [], [], [], []
+    for i, mac in enumerate(macs):
+        node_rows.append([mesh_names[i % len(mesh_names)], f"node-{i}", "", mac, "synthetic", synthesize_ip(i), None])
+        loads.append([mac, 65536, rng.randint(0, 65536)])
+        for j in range(stations):
+            created = start + timedelta(seconds=i + j * 60 * nodes)
+            if bytes_rows:
+                _, tx_bytes, rx_bytes, _ = bytes_rows[(i * stations + j) % len(bytes_rows)]
+            else:
+                tx_bytes, rx_bytes = rng.randint(0, 10**7), rng.randint(0, 10**7)
+            if failure_rows:
+                _, tx_packets, rx_packets, tx_failed, tx_retries, _ = failure_rows[(i * stations + j) % len(failure_rows)]
+            else:
+                tx_packets, rx_packets = rng.randint(0, 10**4), rng.randint(0, 10**4)
+                tx_failed, tx_retries = rng.randint(0, 100), rng.randint(0, 100)
+            byte_rows.append([mac, tx_bytes, rx_bytes, created])
+            failures.append([mac, tx_packets, rx_packets, tx_failed, tx_retries, created])
+    return {
+        "source": "radiusdesk",
+        "queries": {
+            "GET_MESHES_QUERY": [[[name, start] for name in mesh_names]],
+            "GET_NODES_AND_APS_QUERY": [node_rows, []],
+            "GET_NODE_AND_AP_BYTES_QUERY": [byte_rows, []],
+            "GET_NODE_AND_AP_FAILURES_QUERY": [failures, []],
+            "GET_NODE_AND_AP_RESOURCES_QUERY": [loads, []],
+            "GET_UNKNOWN_NODES_QUERY": [[]],
+        },
+    }
+
+
+def synthesize_unifi(nodes: int, stations: int, template: dict | None = None, meshes: int = 10) -> dict:
+    """Generate a unifi snapshot with nodes devices, each with stations hourly stats.
+
+    Stat values are taken from a recorded template snapshot if one is given,
+    otherwise they're random.
+    """
+    rng = random.Random(0)
+    template_stats = (template or {}).get("collections", {}).get("ace_stat.stat_hourly", [])
+    site_names = [f"site-{i}" for i in range(max(1, min(meshes, nodes)))]
+    macs = synthesize_macs(nodes)
+    start = int(datetime(2024, 1, 1).timestamp() * 1e3)
+    devices, events, stats = [], [], []
+    for i, mac in enumerate(macs):
+        devices.append({
+            "mac": mac,
+            "model": "synthetic",
+            "ip": synthesize_ip(i),
+            "adopted_at": start,
+            "last_connection_network_name": site_names[i % len(site_names)],
+        })
+        events.append({"key": "EVT_AP_Adopted", "ap": mac, "ap_name": f"ap-{i}"})
+        for j in range(stations):
+            if template_stats:
+                stat = dict(template_stats[(i * stations + j) % len(template_stats)])
+            else:
+                stat = {
+                    "tx_bytes": rng.randint(0, 10**9),
+                    "rx_bytes": rng.randint(0, 10**9),
+                    "tx_packets": rng.randint(0, 10**6),
+                    "rx_packets": rng.randint(0, 10**6),
+                    "tx_dropped": rng.randint(0, 100),
+                    "rx_dropped": rng.randint(0, 100),
+                    "tx_retries": rng.randint(0, 1000),
+                    "mem": rng.uniform(0, 100),
+                    "cpu": rng.uniform(0, 100),
+                }
+            stat.update({"o": "ap", "ap": mac, "time": start + (i + j * nodes) * 1000})
+            stats.append(stat)
+    return {
+        "source": "unifi",
+        "collections": {
+            "ace.site": [{"name": name} for name in site_names],
+            "ace.device": devices,
+            "ace.event": events,
+            "ace_stat.stat_hourly": stats,
+        },
+    }
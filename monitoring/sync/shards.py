@@ -0,0 +1,17 @@
+"""Set up the processes that sharded sync stages run in.
+
+This module mustn't import any models, it is imported by new shard processes
+before django has been set up.
+"""
+
+from typing import Any
+
+import django
+from django.conf import settings
+
+
+def init_shard_process(overrides: dict[str, Any]) -> None:
+    """Set up django in a shard process, with the parent's database and sync settings."""
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    django.setup()
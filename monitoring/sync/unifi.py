@@ -1,36 +1,97 @@
 """Sync with a radiusdesk database."""
 
-import time
 from datetime import datetime
 
-from pymongo import MongoClient
-from django.conf import settings
 from django.utils.timezone import make_aware
 import pytz
 
 from monitoring.models import Mesh, Node
 from metrics.models import DataUsageMetric, FailuresMetric, ResourcesMetric
-from .utils import bulk_sync
+from . import orchestrator
+from .connections import unifi_client
+from .orchestrator import Stage
+from .utils import SyncContext, bulk_sync, bulk_sync_many
 
 TZ = pytz.UTC
 
+# Name that each AP was last adopted with, grouped in a single round trip
+ADOPTION_NAMES_PIPELINE = [
+    {"$match": {"key": "EVT_AP_Adopted"}},
+    {"$project": {"_id": 0, "ap": 1, "ap_name": 1, "time": 1}},
+    {"$sort": {"time": -1}},
+    {"$group": {"_id": "$ap", "ap_name": {"$first": "$ap_name"}}},
+]
+DEVICE_PROJECTION = {
+    "_id": 0,
+    "mac": 1,
+    "model": 1,
+    "ip": 1,
+    "adopted_at": 1,
+    "last_connection_network_name": 1,
+}
+# Only the fields used by the metric syncs
+AP_STAT_PROJECTION = {
+    "_id": 0,
+    "ap": 1,
+    "time": 1,
+    "tx_bytes": 1,
+    "rx_bytes": 1,
+    "tx_packets": 1,
+    "rx_packets": 1,
+    "tx_dropped": 1,
+    "rx_dropped": 1,
+    "tx_failed": 1,
+    "rx_failed": 1,
+    "tx_retries": 1,
+    "mem": 1,
+    "cpu": 1,
+}
+
+
+def stat_filter(since: datetime | None) -> dict:
+    """Filter AP stats, optionally only those since a given time."""
+    query = {"o": "ap"}
+    if since is not None:
+        # Inverse of the make_aware(datetime.fromtimestamp(...)) used below
+        naive_since = since.astimezone(TZ).replace(tzinfo=None)
+        query["time"] = {"$gte": int(naive_since.timestamp() * 1e3)}
+    return query
+
+
+def shard_filter(collection, query: dict, ctx: SyncContext) -> dict:
+    """Narrow a query of AP stats down to the APs in the context's shard.
+
+    Mongo can't compute utils.shard_of() itself, so the shard's APs are
+    picked from the distinct APs that match the query.
+    """
+    if ctx.shards == 1:
+        return query
+    macs = [mac for mac in collection.distinct("ap", query) if ctx.in_shard(mac)]
+    return {**query, "ap": {"$in": macs}}
+
+
+def get_adopted_names(client) -> dict[str, str]:
+    """Map AP MAC addresses to the name they were adopted with."""
+    events = client.ace.event.aggregate(ADOPTION_NAMES_PIPELINE)
+    return {event["_id"]: event["ap_name"] for event in events}
+
 
 @bulk_sync(Mesh)
-def sync_meshes(client):
+def sync_meshes(client, ctx):
     """Sync Mesh objects from the unifi database."""
     for site in client.ace.site.find():
         yield {}, {"name": site["name"]}
 
 
 @bulk_sync(Node, delete=False)
-def sync_nodes(client):
+def sync_nodes(client, ctx):
     """Sync Node objects from the unifi database."""
-    for device in client.ace.device.find():
-        adoption_details = client.ace.event.find_one({"key": "EVT_AP_Adopted", "ap": device["mac"]})
-        name = adoption_details["ap_name"] if adoption_details else device["model"]
+    adopted_names = get_adopted_names(client)
+    for device in client.ace.device.find({}, DEVICE_PROJECTION):
+        name = adopted_names.get(device["mac"]) or device["model"]
         adopt_time = make_aware(datetime.fromtimestamp(device["adopted_at"] / 1e3), TZ)
         data = dict(
-            mesh=Mesh.objects.get(name=device["last_connection_network_name"].lower()),
+            mesh=ctx.get_mesh(device["last_connection_network_name"].lower()),
             name=name,
             description="",
             mac=device["mac"],
@@ -41,28 +102,20 @@ def sync_nodes(client):
         yield data, {"mac": device["mac"]}
 
 
-@bulk_sync(DataUsageMetric)
-def sync_node_data_usage_metrics(client):
-    """Sync DataUsageMetric objects from the unifi database."""
-    aps = client.ace_stat.stat_hourly.find({"o": "ap"})
+@bulk_sync_many(DataUsageMetric, FailuresMetric, ResourcesMetric, checkpoint=("unifi", "ap_stats"))
+def sync_node_metrics(client, ctx, since):
+    """Sync DataUsageMetric, FailuresMetric and ResourcesMetric objects from the unifi database."""
+    stats = client.ace_stat.stat_hourly
+    aps = stats.find(shard_filter(stats, stat_filter(since), ctx), AP_STAT_PROJECTION)
     for ap in aps:
         ap_time = make_aware(datetime.fromtimestamp(ap["time"] / 1e3), TZ)
-        data = dict(
-            mac=ap["ap"],
+        lookup = {"mac": ap["ap"], "created": ap_time}
+        data_usage = dict(
             tx_bytes=ap.get("tx_bytes"),
             rx_bytes=ap.get("rx_bytes"),
         )
-        yield data, {"created": ap_time}
-
-
-@bulk_sync(FailuresMetric)
-def sync_node_failures_metrics(client):
-    """Sync FailuresMetric objects from the unifi database."""
-    aps = client.ace_stat.stat_hourly.find({"o": "ap"})
-    for ap in aps:
-        ap_time = make_aware(datetime.fromtimestamp(ap["time"] / 1e3), TZ)
-        data = dict(
-            mac=ap["ap"],
+        yield DataUsageMetric, data_usage, lookup
+        failures = dict(
             tx_packets=ap.get("tx_packets"),
             rx_packets=ap.get("rx_packets"),
             tx_dropped=ap.get("tx_dropped"),
@@ -71,35 +124,25 @@ def sync_node_failures_metrics(client):
             rx_errors=ap.get("rx_failed"),
             tx_retries=ap.get("tx_retries"),
         )
-        yield data, {"created": ap_time}
-
-
-@bulk_sync(ResourcesMetric)
-def sync_node_resources_metrics(client):
-    """Sync NodeLoad objects from the unifi database."""
-    aps = client.ace_stat.stat_hourly.find({"o": "ap"})
-    for ap in aps:
-        ap_time = make_aware(datetime.fromtimestamp(ap["time"] / 1e3), TZ)
-        data = dict(
-            mac=ap["ap"],
+        yield FailuresMetric, failures, lookup
+        resources = dict(
             memory=ap.get("mem"),
             cpu=ap.get("cpu"),
         )
-        yield data, {"created": ap_time}
-
-
-def run():
-    _client = MongoClient(
-        host=settings.UNIFI_DB_HOST,
-        port=int(settings.UNIFI_DB_PORT),
-        username=settings.UNIFI_DB_USER,
-        password=settings.UNIFI_DB_PASSWORD,
-    )
-    start_time = time.time()
-    sync_meshes(_client)
-    sync_nodes(_client)
-    sync_node_data_usage_metrics(_client)
-    sync_node_failures_metrics(_client)
-    sync_node_resources_metrics(_client)
-    elapsed_time = time.time() - start_time
-    print(f"Synced with unifi in {elapsed_time:.2f}s")
+        yield ResourcesMetric, resources, lookup
+
+
+def stages() -> list[Stage]:
+    """Unifi sync stages. Metrics only depend on nodes having been synced.
+
+    The metrics stage can be split into SYNC_METRIC_SHARDS processes.
+    """
+    return [
+        Stage("unifi.meshes", sync_meshes, unifi_client),
+        Stage("unifi.nodes", sync_nodes, unifi_client, ("unifi.meshes",)),
+        Stage("unifi.metrics", sync_node_metrics, unifi_client, ("unifi.nodes",), sharded=True),
+    ]
+
+
+def run(full: bool = False):
+    orchestrator.run(stages(), full=full, name="unifi")
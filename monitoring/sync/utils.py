@@ -1,29 +1,430 @@
-from typing import Type
-from django.db import models
+import hashlib
+import resource
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+from typing import Any, Type
 
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, router, transaction
+from django.db.models.signals import post_save
 
-def bulk_sync(ModelType: Type[models.Model], delete: bool = False):
-    """Log output for sync, with number of added, updated and deleted models."""
+from monitoring.models import Mesh, Node, SyncCheckpoint
 
-    def outer(syncfunc):
-        def inner(cursor):
-            ids_to_delete = set(ModelType.objects.values_list("pk", flat=True))
-            n_added, n_updated = 0, 0
-            for defaults, kwargs in syncfunc(cursor):
-                model, created = ModelType.objects.update_or_create(defaults, **kwargs)
-                if created:
-                    n_added += 1
-                else:
-                    n_updated += 1
-                ids_to_delete.discard(model.pk)
-            n_deleted = 0
-            if delete:
-                n_deleted, _ = ModelType.objects.filter(pk__in=ids_to_delete).delete()
-            print(
-                f"Updated {ModelType.__name__:>12} models "
-                f"({n_added} created, {n_updated} updated, {n_deleted} deleted)"
+
+@dataclass
+class SyncContext:
+    """State shared by all the stages of a single sync run.
+
+    Also caches the models that sync generators look up for every row, so that
+    each lookup doesn't cost a query. Caches are loaded on first use, and
+    invalidated when a stage creates or deletes models of the cached type.
+    Stages run concurrently, so a cache that is invalidated while it is
+    being loaded isn't kept.
+    """
+
+    # Ignore checkpoints and resync the full history of every source
+    full: bool = False
+    # Only sync the metrics of MAC addresses in this shard, see shard_of()
+    shard: int = 0
+    shards: int = 1
+    _meshes: dict[str, Mesh] | None = field(default=None, repr=False)
+    _node_macs: set | None = field(default=None, repr=False)
+    # Number of times each cache was invalidated, a load that started before
+    # the latest invalidation is stale
+    _generations: dict[str, int] = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def _cached(self, name: str, load):
+        """Get a cache, loading it if needed."""
+        with self._lock:
+            cache = getattr(self, name)
+            generation = self._generations.get(name, 0)
+        if cache is None:
+            cache = load()
+            with self._lock:
+                if self._generations.get(name, 0) == generation:
+                    setattr(self, name, cache)
+        return cache
+
+    def get_mesh(self, name: str) -> Mesh:
+        """Get a mesh by name, raising Mesh.DoesNotExist if there isn't one."""
+        meshes = self._cached("_meshes", lambda: {m.name: m for m in Mesh.objects.all()})
+        try:
+            return meshes[name]
+        except KeyError:
+            # The mesh may have been created since the cache was loaded
+            mesh = Mesh.objects.get(name=name)
+        with self._lock:
+            meshes[name] = mesh
+        return mesh
+
+    def node_exists(self, mac: str) -> bool:
+        """Check whether a node with the given MAC address exists."""
+        node_macs = self._cached("_node_macs", lambda: set(Node.objects.values_list("mac", flat=True)))
+        return Node._meta.get_field("mac").to_python(mac) in node_macs
+
+    def in_shard(self, mac: str) -> bool:
+        """Check whether a MAC address (as stored at the source) belongs to this context's shard."""
+        return self.shards == 1 or shard_of(mac, self.shards) == self.shard
+
+    def invalidate(self, ModelType: Type[models.Model]) -> None:
+        """Reload cached models of the given type the next time they're used."""
+        name = {Mesh: "_meshes", Node: "_node_macs"}.get(ModelType)
+        if name is None:
+            return
+        with self._lock:
+            setattr(self, name, None)
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+
+def shard_of(mac: str, shards: int) -> int:
+    """Shard of a MAC address, the same as MySQL's MOD(CRC32(mac), shards)."""
+    return zlib.crc32(mac.encode()) % shards
+
+
+@dataclass
+class SyncStats:
+    """Number of models created, updated and deleted during a sync."""
+
+    created: int = 0
+    updated: int = 0
+    deleted: int = 0
+    # Existing models whose synced values didn't change, so weren't written
+    unchanged: int = 0
+    # Rows yielded by the sync generator
+    rows_read: int = 0
+    # Seconds spent reading rows from the source, shared by all model types
+    # synced from the same pass, and seconds spent writing this model type
+    query_time: float = 0.0
+    write_time: float = 0.0
+    # Latest watermark field value that was synced, if the sync is checkpointed
+    watermark: datetime | None = None
+
+    @classmethod
+    def merge(cls, stats: list["SyncStats"]) -> "SyncStats":
+        """Combine the stats of the model types synced by a single stage."""
+        return cls(
+            created=sum(s.created for s in stats),
+            updated=sum(s.updated for s in stats),
+            deleted=sum(s.deleted for s in stats),
+            unchanged=sum(s.unchanged for s in stats),
+            rows_read=sum(s.rows_read for s in stats),
+            query_time=max((s.query_time for s in stats), default=0.0),
+            write_time=sum(s.write_time for s in stats),
+            watermark=max((s.watermark for s in stats if s.watermark), default=None),
+        )
+
+
+class BulkSyncer:
+    """Buffer synced rows and upsert them in batches.
+
+    Rows are identified by their lookup kwargs, like the kwargs passed to
+    update_or_create. Each batch is diffed against the rows that already exist
+    with a single query, after which new rows are inserted with bulk_create and
+    existing rows are updated with bulk_update. Existing rows are only written
+    if the hash of their synced values changed.
+    """
+
+    def __init__(self, ModelType: Type[models.Model], delete: bool = False, batch_size: int | None = None):
+        self.ModelType = ModelType
+        self.delete = delete
+        self.batch_size = batch_size or settings.SYNC_BATCH_SIZE
+        self.db = router.db_for_write(ModelType) or DEFAULT_DB_ALIAS
+        self.stats = SyncStats()
+        self.lookup_fields: tuple[str, ...] | None = None
+        self._buffer: dict[tuple, tuple[dict, dict]] = {}
+        self._seen: set[tuple] = set()
+
+    def add(self, defaults: dict[str, Any], kwargs: dict[str, Any]) -> None:
+        """Add a row to the buffer, flushing it if it is full."""
+        self.stats.rows_read += 1
+        if self.lookup_fields is None:
+            self.lookup_fields = tuple(sorted(kwargs))
+        key = self._key(kwargs)
+        if key in self._buffer:
+            # Already buffered in this batch, update_or_create would have
+            # updated the model it created/updated the first time around
+            self._buffer[key][0].update(defaults)
+            self.stats.updated += 1
+            return
+        self._buffer[key] = (defaults, kwargs)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all buffered rows to the database."""
+        if not self._buffer:
+            return
+        start_time = time.perf_counter()
+        rows, self._buffer = self._buffer, {}
+        existing = {self._key(obj): obj for obj in self._existing(rows.values())}
+        to_create: list[models.Model] = []
+        to_update: list[models.Model] = []
+        update_fields: set[str] = set()
+        for key, (defaults, kwargs) in rows.items():
+            obj = existing.get(key)
+            if obj is None:
+                to_create.append(self.ModelType(**{**kwargs, **defaults}))
+            elif self.row_hash(defaults) == self.row_hash(obj, defaults):
+                self.stats.unchanged += 1
+            else:
+                for name, value in defaults.items():
+                    setattr(obj, name, value)
+                to_update.append(obj)
+            # Lookup fields (e.g. a primary key) already match, and mustn't be updated
+            update_fields.update(defaults.keys() - set(self.lookup_fields))
+            if self.delete:
+                self._seen.add(key)
+        if to_create or to_update:
+            with transaction.atomic(using=self.db):
+                if to_create:
+                    self._bulk_create(to_create, update_fields)
+                if to_update and update_fields:
+                    self.ModelType.objects.using(self.db).bulk_update(to_update, update_fields, self.batch_size)
+        self.stats.created += len(to_create)
+        self.stats.updated += len(to_update)
+        self._send_post_save(to_create, created=True)
+        self._send_post_save(to_update, created=False)
+        self.stats.write_time += time.perf_counter() - start_time
+
+    def finish(self) -> SyncStats:
+        """Flush the remaining rows and delete models that weren't synced."""
+        self.flush()
+        if self.delete:
+            start_time = time.perf_counter()
+            self.stats.deleted = self._delete_unseen()
+            self.stats.write_time += time.perf_counter() - start_time
+        return self.stats
+
+    def row_hash(self, row: dict[str, Any] | models.Model, fields=None) -> str:
+        """Stable hash of a row's (or model's) normalized field values."""
+        digest = hashlib.blake2b(digest_size=16)
+        for name in sorted(row if fields is None else fields):
+            field = self.ModelType._meta.get_field(name)
+            value = row[name] if isinstance(row, dict) else getattr(row, field.attname)
+            if field.is_relation:
+                # Compare related models by primary key
+                value = value.pk if isinstance(value, models.Model) else value
+                field = field.target_field
+            value = field.to_python(value)
+            if isinstance(value, datetime) and value.tzinfo is not None:
+                value = value.astimezone(dt_timezone.utc)
+            digest.update(f"{name}={value!r};".encode())
+        return digest.hexdigest()
+
+    def _key(self, row: dict[str, Any] | models.Model) -> tuple:
+        """Normalized lookup values, so yielded rows compare equal to models."""
+        key = []
+        for name in self.lookup_fields:
+            value = row[name] if isinstance(row, dict) else getattr(row, name)
+            key.append(self.ModelType._meta.get_field(name).to_python(value))
+        return tuple(key)
+
+    def _existing(self, rows) -> models.QuerySet:
+        """Query the models that match any of the given rows' lookups."""
+        filters = {}
+        for name in self.lookup_fields:
+            filters[f"{name}__in"] = {kwargs[name] for _, kwargs in rows}
+        return self.ModelType.objects.using(self.db).filter(**filters)
+
+    def _bulk_create(self, objs: list[models.Model], update_fields: set[str]) -> None:
+        """Insert new models, upserting them if the lookup is unique."""
+        options = {}
+        if self._lookup_is_unique():
+            # Another sync may have inserted the same rows since they were
+            # diffed, so resolve conflicts rather than crash on them
+            fields = update_fields.difference(self.lookup_fields)
+            if fields:
+                options["update_conflicts"] = True
+                options["update_fields"] = sorted(fields)
+                if connections[self.db].features.supports_update_conflicts_with_target:
+                    options["unique_fields"] = list(self.lookup_fields)
+            else:
+                options["ignore_conflicts"] = True
+        self.ModelType.objects.using(self.db).bulk_create(objs, self.batch_size, **options)
+
+    def _lookup_is_unique(self) -> bool:
+        """Check whether the lookup fields are backed by a unique constraint."""
+        opts = self.ModelType._meta
+        if len(self.lookup_fields) == 1 and opts.get_field(self.lookup_fields[0]).unique:
+            return True
+        unique_sets = [set(fields) for fields in opts.unique_together]
+        unique_sets += [
+            set(c.fields) for c in opts.total_unique_constraints if not c.condition
+        ]
+        return set(self.lookup_fields) in unique_sets
+
+    def _delete_unseen(self) -> int:
+        """Delete models whose lookup wasn't yielded during the sync."""
+        qs = self.ModelType.objects.using(self.db)
+        lookup_fields = self.lookup_fields or ()
+        pks_to_delete = []
+        for pk, *values in qs.values_list("pk", *lookup_fields).iterator(self.batch_size):
+            if self.lookup_fields is None or self._key(dict(zip(lookup_fields, values))) not in self._seen:
+                pks_to_delete.append(pk)
+        n_deleted = 0
+        for i in range(0, len(pks_to_delete), self.batch_size):
+            n, _ = qs.filter(pk__in=pks_to_delete[i:i + self.batch_size]).delete()
+            n_deleted += n
+        return n_deleted
+
+    def _send_post_save(self, objs: list[models.Model], created: bool) -> None:
+        """bulk_create/bulk_update don't send post_save, so send it manually."""
+        if not post_save.has_listeners(self.ModelType):
+            return
+        for obj in objs:
+            post_save.send(
+                sender=self.ModelType,
+                instance=obj,
+                created=created,
+                update_fields=None,
+                raw=False,
+                using=self.db,
             )
 
+
+class Timer:
+    """Measure the time spent producing the items of an iterator."""
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def time_iter(self, iterable):
+        """Yield from iterable, adding the time spent in it to elapsed."""
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.elapsed += time.perf_counter() - start_time
+            yield item
+
+
+def peak_rss() -> float:
+    """Peak resident memory of this process so far, in MB, including its threads."""
+    # ru_maxrss is measured in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_watermark(source: str, stream: str) -> datetime | None:
+    """Get the time from which a stream should be synced, or None to sync everything."""
+    checkpoint = SyncCheckpoint.objects.filter(source=source, stream=stream).first()
+    if checkpoint is None:
+        return None
+    # Rows can be updated or arrive a little late at the source
+    return checkpoint.watermark - settings.SYNC_WATERMARK_OVERLAP
+
+
+def set_watermark(source: str, stream: str, watermark: datetime) -> None:
+    """Advance a stream's checkpoint to the latest time that was synced."""
+    checkpoint, created = SyncCheckpoint.objects.get_or_create(
+        source=source, stream=stream, defaults={"watermark": watermark}
+    )
+    if not created and watermark > checkpoint.watermark:
+        checkpoint.watermark = watermark
+        checkpoint.save(update_fields=["watermark", "updated"])
+
+
+def run_sync(
+    rows,
+    ModelTypes: list[Type[models.Model]],
+    ctx: SyncContext,
+    delete: bool = False,
+    batch_size: int | None = None,
+    checkpoint: tuple[str, str] | None = None,
+    watermark_field: str = "created",
+) -> dict[Type[models.Model], SyncStats]:
+    """Write (ModelType, defaults, kwargs) rows in batches per model type.
+
+    A sharded sync only sees part of the rows, so it doesn't delete models
+    and leaves advancing the checkpoint to whoever merges the shards.
+    """
+    if delete and ctx.shards > 1:
+        raise ValueError("Can't delete models that weren't synced from a sharded sync")
+    syncers = {M: BulkSyncer(M, delete=delete, batch_size=batch_size) for M in ModelTypes}
+    watermark = None
+    read_timer = Timer()
+    for ModelType, defaults, kwargs in read_timer.time_iter(rows):
+        syncers[ModelType].add(defaults, kwargs)
+        if checkpoint and (watermark is None or kwargs[watermark_field] > watermark):
+            watermark = kwargs[watermark_field]
+    results = {}
+    for ModelType, syncer in syncers.items():
+        stats = syncer.finish()
+        if stats.created or stats.deleted:
+            ctx.invalidate(ModelType)
+        stats.query_time = read_timer.elapsed
+        stats.watermark = watermark
+        print(
+            f"Updated {ModelType.__name__:>12} models "
+            f"({stats.created} created, {stats.updated} updated, {stats.unchanged} unchanged, "
+            f"{stats.deleted} deleted)"
+        )
+        results[ModelType] = stats
+    if checkpoint and watermark is not None and ctx.shards == 1:
+        set_watermark(*checkpoint, watermark)
+    return results
+
+
+def bulk_sync_many(*ModelTypes: Type[models.Model], checkpoint: tuple[str, str] | None = None, **options):
+    """Sync several model types from a single pass over a source.
+
+    The decorated generator yields (ModelType, defaults, kwargs) tuples, and is
+    otherwise called like a bulk_sync generator. Each model type is written in
+    its own batches, and the stats for each model type are returned.
+    """
+
+    def outer(syncfunc):
+        @wraps(syncfunc)
+        def inner(cursor, ctx: SyncContext | None = None) -> dict[Type[models.Model], SyncStats]:
+            ctx = ctx or SyncContext()
+            if checkpoint:
+                since = None if ctx.full else get_watermark(*checkpoint)
+                rows = syncfunc(cursor, ctx, since)
+            else:
+                rows = syncfunc(cursor, ctx)
+            return run_sync(rows, list(ModelTypes), ctx, checkpoint=checkpoint, **options)
+
+        inner.checkpoint = checkpoint
+        return inner
+
+    return outer
+
+
+def bulk_sync(ModelType: Type[models.Model], **options):
+    """Log output for sync, with number of added, updated and deleted models.
+
+    The decorated generator yields (defaults, kwargs) pairs, which are upserted
+    in batches of batch_size (settings.SYNC_BATCH_SIZE by default). Models that
+    weren't yielded are deleted afterwards if delete is True.
+
+    The generator is passed the source and the run's SyncContext. If a
+    (source, stream) checkpoint is given, it is also passed the time from which
+    to sync (None for a full sync). The latest watermark_field (created by
+    default) value in the yielded kwargs is stored once all rows have been
+    written.
+    """
+
+    def outer(syncfunc):
+        @wraps(syncfunc)
+        def tagged(*args):
+            for defaults, kwargs in syncfunc(*args):
+                yield ModelType, defaults, kwargs
+
+        many = bulk_sync_many(ModelType, **options)(tagged)
+
+        @wraps(syncfunc)
+        def inner(cursor, ctx: SyncContext | None = None) -> SyncStats:
+            return many(cursor, ctx)[ModelType]
+
+        inner.checkpoint = many.checkpoint
         return inner
 
     return outer
@@ -1,15 +1,24 @@
+from dataclasses import asdict
+
 from celery import shared_task
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.utils.timezone import now
 
+from backend.locks import singleton_task
+from metrics.models import ServiceMetric
+from .sync import orchestrator, radiusdesk, unifi
 from .sync.radiusdesk import run as syncrd
 from .sync.unifi import run as syncunifi
 from .checks import CheckStatus
-from .models import Node, Alert
+from .models import Node, Alert, Service
+from .probes import ServiceProber
 
 logger = get_task_logger(__name__)
 
 
 @shared_task
+@singleton_task(coalesce=True)
 def run_syncrd() -> None:
     """Celery task to sync the Django database with radiusdesk's mysql db."""
     logger.info("Syncing with radiusdesk")
@@ -17,6 +26,7 @@ def run_syncrd() -> None:
 
 
 @shared_task
+@singleton_task(coalesce=True)
 def run_syncunifi() -> None:
     """Celery task to sync the Django database with unifi's mongodb."""
     logger.info("Syncing with unifi")
@@ -24,10 +34,21 @@ def run_syncunifi() -> None:
 
 
 @shared_task
+@singleton_task(coalesce=True)
+def run_syncall() -> None:
+    """Celery task to sync with radiusdesk and unifi concurrently."""
+    logger.info("Syncing with radiusdesk and unifi")
+    orchestrator.run(radiusdesk.stages() + unifi.stages(), name="radiusdesk and unifi")
+
+
+@shared_task
+@singleton_task()
 def generate_alerts() -> None:
     """Celery task to monitor for alerts, generates them if necessary."""
     logger.info("Generating alerts")
-    for n in Node.objects.all():
+    # Nodes behind an unreachable node aren't alerted on, the alert for
+    # the unreachable node covers them
+    for n in Node.objects.filter(unreachable_upstream=False):
         current_status = n.check_results.status()
         current_status_level = current_status.alert_level()
         unresolved_alerts = Alert.objects.filter(node=n, resolved=False)
@@ -48,3 +69,18 @@ def generate_alerts() -> None:
         # is assumed to have been resolved.
         alerts_worse_than_current_status = unresolved_alerts.filter(level__gt=current_status_level)
         alerts_worse_than_current_status.update(resolved=True)
+
+
+@shared_task
+@singleton_task()
+def probe_services() -> None:
+    """Celery task to probe the health of all services."""
+    services = list(Service.objects.all())
+    created = now()
+    results = ServiceProber().probe(service.url for service in services)
+    metrics = [
+        ServiceMetric(created=created, service_id=service.pk, url=service.url, **asdict(results[service.url]))
+        for service in services
+    ]
+    ServiceMetric.objects.bulk_create(metrics, settings.SERVICE_PROBE_BATCH_SIZE)
+    logger.info(f"Probed {len(metrics)} services, {sum(m.up for m in metrics)} up")
@@ -1,3 +1,952 @@
-from django.test import TestCase
+import re
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import mysql.connector
+from django.core.management import call_command
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from pymongo.errors import PyMongoError
+from rest_framework.test import APIRequestFactory
+
+from backend import locks
+from metrics.models import DataUsageMetric, FailuresMetric, ResourcesMetric
+from . import signals, tasks, topology
+from .checks import CheckResults, CheckStatus
+from .models import Alert, Mesh, Node, SyncCheckpoint, SyncRun, SyncStage
+from .probes import ServiceProber
+from .views import SyncRunViewSet, SyncStageViewSet
+from .sync import connections, orchestrator, radiusdesk, replay, unifi
+from .sync.orchestrator import Stage
+from .sync.replay import ReplayClient, ReplayResult
+from .sync.unifi import get_adopted_names
+from .sync.utils import BulkSyncer, SyncContext, SyncStats, get_watermark, set_watermark, shard_of
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers /ok with 200, /error with 500 and /slow with 200 after a delay."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        path = self.path.partition("?")[0]
+        try:
+            if path == "/slow":
+                time.sleep(0.3)
+            status = 500 if path == "/error" else 200
+            body = b"ok"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """Stub HTTP server, counting its connections and concurrent requests."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+
+    def handle_error(self, request, client_address):
+        # e.g. a probe that timed out closed the connection
+        pass
+
+
+class ServiceProberTest(SimpleTestCase):
+    """Tests for the service prober, against a local stub HTTP server."""
+
+    def setUp(self):
+        self.server = StubServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def prober(self, **kwargs):
+        options = {
+            "concurrency": 10,
+            "host_concurrency": 4,
+            "connect_timeout": 1,
+            "tls_timeout": 1,
+            "first_byte_timeout": 1,
+        }
+        return ServiceProber(**{**options, **kwargs})
+
+    def closed_port(self) -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def test_up(self):
+        result = self.prober().probe([f"{self.base}/ok"])[f"{self.base}/ok"]
+        self.assertTrue(result.up)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.error, "")
+        self.assertIsNotNone(result.connect_time)
+        self.assertIsNone(result.tls_time)
+        self.assertIsNotNone(result.first_byte_time)
+        self.assertGreaterEqual(result.total_time, result.connect_time + result.first_byte_time)
+
+    def test_error_status(self):
+        result = self.prober().probe([f"{self.base}/error"])[f"{self.base}/error"]
+        self.assertFalse(result.up)
+        self.assertEqual(result.status_code, 500)
+
+    def test_first_byte_timeout(self):
+        result = self.prober(first_byte_timeout=0.1).probe([f"{self.base}/slow"])[f"{self.base}/slow"]
+        self.assertFalse(result.up)
+        self.assertIsNone(result.status_code)
+        self.assertIn("first_byte timed out", result.error)
+        self.assertIsNotNone(result.connect_time)
+
+    def test_connection_refused(self):
+        url = f"http://127.0.0.1:{self.closed_port()}/"
+        result = self.prober().probe([url])[url]
+        self.assertFalse(result.up)
+        self.assertIn("connect failed", result.error)
+
+    def test_tcp(self):
+        open_url = f"tcp://127.0.0.1:{self.server.server_port}"
+        closed_url = f"tcp://127.0.0.1:{self.closed_port()}"
+        results = self.prober().probe([open_url, closed_url])
+        self.assertTrue(results[open_url].up)
+        self.assertIsNone(results[open_url].status_code)
+        self.assertFalse(results[closed_url].up)
+
+    def test_unsupported(self):
+        results = self.prober().probe(["ftp://127.0.0.1/", "http:///"])
+        self.assertEqual({result.error for result in results.values()}, {"Unsupported URL"})
+
+    def test_connection_reuse(self):
+        urls = [f"{self.base}/ok?{i}" for i in range(5)]
+        results = self.prober(host_concurrency=1).probe(urls)
+        self.assertTrue(all(result.up for result in results.values()))
+        # One request per host at a time, all on the same keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(sum(result.reused for result in results.values()), 4)
+        self.assertEqual(sum(result.connect_time is None for result in results.values()), 4)
+
+    def test_host_concurrency(self):
+        urls = [f"{self.base}/slow?{i}" for i in range(6)]
+        results = self.prober(host_concurrency=2).probe(urls)
+        self.assertTrue(all(result.up for result in results.values()))
+        self.assertEqual(self.server.max_active, 2)
+
+
+class UnifiSyncTest(SimpleTestCase):
+    """Tests for the unifi sync's queries, on replayed unifi data."""
+
+    def test_adopted_names(self):
+        events = [
+            {"key": "EVT_AP_Adopted", "ap": "02:00:00:00:00:01", "ap_name": "first", "time": 1000},
+            {"key": "EVT_AP_Adopted", "ap": "02:00:00:00:00:01", "ap_name": "latest", "time": 3000},
+            {"key": "EVT_AP_Adopted", "ap": "02:00:00:00:00:01", "ap_name": "second", "time": 2000},
+            {"key": "EVT_AP_Adopted", "ap": "02:00:00:00:00:02", "ap_name": "other", "time": 1000},
+        ]
+        client = ReplayClient({"collections": {"ace.event": events}})
+        # Of APs that were adopted more than once, the latest name is used
+        self.assertEqual(
+            get_adopted_names(client),
+            {"02:00:00:00:00:01": "latest", "02:00:00:00:00:02": "other"},
+        )
+
+    def test_shard_filter(self):
+        macs = [f"02:00:00:00:00:{i:02x}" for i in range(20)]
+        stats = [{"o": "ap", "ap": mac, "time": time} for mac in macs for time in (1000, 2000)]
+        collection = ReplayClient({"collections": {"ace_stat.stat_hourly": stats}}).ace_stat.stat_hourly
+        query = unifi.stat_filter(None)
+        # Each AP's stats are in exactly one shard
+        shards = [
+            [stat["ap"] for stat in collection.find(unifi.shard_filter(collection, query, SyncContext(shard=shard, shards=3)))]
+            for shard in range(3)
+        ]
+        self.assertEqual(sorted(mac for shard in shards for mac in shard), sorted(mac for mac in macs for _ in range(2)))
+        for shard, shard_macs in enumerate(shards):
+            self.assertTrue(all(shard_of(mac, 3) == shard for mac in shard_macs))
+        self.assertIs(unifi.shard_filter(collection, query, SyncContext()), query)
+
+
+class SyncContextTest(TestCase):
+    """Tests for the caches shared by the stages of a sync."""
+
+    def setUp(self):
+        Mesh.objects.create(name="a")
+        patcher = mock.patch.object(signals, "_sync_prometheus_data_to_yml")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_mesh(self):
+        ctx = SyncContext()
+        with self.assertNumQueries(1):
+            self.assertEqual(ctx.get_mesh("a").name, "a")
+            self.assertEqual(ctx.get_mesh("a").name, "a")
+        # Meshes created since the cache was loaded are looked up once
+        Mesh.objects.create(name="b")
+        with self.assertNumQueries(1):
+            self.assertEqual(ctx.get_mesh("b").name, "b")
+            self.assertEqual(ctx.get_mesh("b").name, "b")
+        with self.assertRaises(Mesh.DoesNotExist):
+            ctx.get_mesh("c")
+
+    def test_invalidate(self):
+        ctx = SyncContext()
+        ctx.get_mesh("a")
+        ctx.invalidate(Mesh)
+        Mesh.objects.filter(name="a").update(ssid="changed")
+        self.assertEqual(ctx.get_mesh("a").ssid, "changed")
+
+    def test_invalidated_while_loading(self):
+        ctx = SyncContext()
+
+        def load():
+            meshes = list(Mesh.objects.filter())
+            # Another stage creates a mesh before this load is stored
+            Mesh.objects.create(name="b")
+            ctx.invalidate(Mesh)
+            return meshes
+
+        with mock.patch.object(Mesh.objects, "all", side_effect=load):
+            self.assertEqual(ctx.get_mesh("a").name, "a")
+        # The stale load wasn't kept, so the new mesh is found in the next load
+        self.assertIsNone(ctx._meshes)
+        with self.assertNumQueries(1):
+            self.assertEqual(ctx.get_mesh("b").name, "b")
+            self.assertEqual(ctx.get_mesh("a").name, "a")
+
+    def test_node_exists(self):
+        ctx = SyncContext()
+        self.assertFalse(ctx.node_exists("02:00:00:00:00:01"))
+        Node.objects.create(mac="02:00:00:00:00:01", name="n", mesh_id="a")
+        # Cached until nodes are invalidated
+        self.assertFalse(ctx.node_exists("02:00:00:00:00:01"))
+        ctx.invalidate(Node)
+        with self.assertNumQueries(1):
+            self.assertTrue(ctx.node_exists("02-00-00-00-00-01"))
+            self.assertFalse(ctx.node_exists("02:00:00:00:00:02"))
+
+
+class BulkSyncerTest(TestCase):
+    """Tests for the batched upserts of the syncs."""
+
+    def setUp(self):
+        Mesh.objects.create(name="a")
+        patcher = mock.patch.object(signals, "_sync_prometheus_data_to_yml")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.saved = []
+        post_save.connect(self.record_save, sender=Node)
+        self.addCleanup(post_save.disconnect, self.record_save, sender=Node)
+
+    def record_save(self, sender, instance, created, **kwargs):
+        self.saved.append((str(instance.mac), instance.name, created))
+
+    @staticmethod
+    def rows(*names: str, start: int = 1) -> list[tuple[dict, dict]]:
+        """(defaults, kwargs) rows of nodes with consecutive MAC addresses."""
+        return [
+            ({"name": name, "mesh_id": "a"}, {"mac": f"02:00:00:00:00:{i:02x}"})
+            for i, name in enumerate(names, start)
+        ]
+
+    def sync(self, rows, **options):
+        syncer = BulkSyncer(Node, **options)
+        for defaults, kwargs in rows:
+            syncer.add(defaults, kwargs)
+        return syncer.finish()
+
+    def test_counts(self):
+        stats = self.sync(self.rows("n1", "n2", "n3"), batch_size=2)
+        self.assertEqual((stats.created, stats.updated, stats.unchanged, stats.deleted), (3, 0, 0, 0))
+        stats = self.sync(self.rows("changed", "n2") + self.rows("n4", start=4), batch_size=2)
+        self.assertEqual((stats.created, stats.updated, stats.unchanged, stats.deleted), (1, 1, 1, 0))
+        self.assertEqual(stats.rows_read, 3)
+        # Without delete, nodes that weren't synced are kept
+        self.assertEqual(
+            sorted(Node.objects.values_list("name", flat=True)), ["changed", "n2", "n3", "n4"]
+        )
+
+    def test_delete(self):
+        self.sync(self.rows("n1", "n2", "n3", "n4"))
+        stats = self.sync(self.rows("n1", "n2", "n3", "n4")[1::2], delete=True, batch_size=2)
+        self.assertEqual(stats.deleted, 2)
+        self.assertEqual(sorted(Node.objects.values_list("name", flat=True)), ["n2", "n4"])
+
+    def test_delete_unseen(self):
+        self.sync(self.rows("n1", "n2", "n3"))
+        # MAC addresses are compared normalized, whatever their format
+        syncer = BulkSyncer(Node, delete=True, batch_size=2)
+        syncer.add({"name": "n2", "mesh_id": "a"}, {"mac": "02-00-00-00-00-02"})
+        syncer.flush()
+        self.assertEqual(syncer._delete_unseen(), 2)
+        self.assertEqual(list(Node.objects.values_list("name", flat=True)), ["n2"])
+        # A sync that yields nothing deletes everything, in batches
+        self.sync(self.rows("n1", "n2", "n3"))
+        self.assertEqual(BulkSyncer(Node, delete=True, batch_size=2)._delete_unseen(), 3)
+        self.assertFalse(Node.objects.exists())
+
+    def test_batches(self):
+        syncer = BulkSyncer(Node, batch_size=2)
+        rows = self.rows("n1", "n2", "n3")
+        syncer.add(*rows[0])
+        # A row synced twice within a batch is written once, with its latest values
+        syncer.add({"name": "renamed", "mesh_id": "a"}, rows[0][1])
+        self.assertFalse(Node.objects.exists())
+        syncer.add(*rows[1])
+        # The buffer was flushed when it was full
+        self.assertEqual(sorted(Node.objects.values_list("name", flat=True)), ["n2", "renamed"])
+        syncer.add(*rows[2])
+        self.assertEqual(Node.objects.count(), 2)
+        stats = syncer.finish()
+        self.assertEqual(Node.objects.count(), 3)
+        self.assertEqual((stats.created, stats.updated), (3, 1))
+
+    def test_unchanged(self):
+        mesh = Mesh.objects.get(name="a")
+        rows = [
+            ({"name": "n1", "mesh": mesh, "lat": -33.9, "ip": None}, {"mac": "02:00:00:00:00:01"}),
+            ({"name": "n2", "mesh_id": "a", "lat": 18, "ip": "10.0.0.2"}, {"mac": "02-00-00-00-00-02"}),
+        ]
+        self.sync(rows)
+        self.saved = []
+        # Syncing the same rows again only selects them, without any writes
+        with self.assertNumQueries(1):
+            stats = self.sync(rows)
+        self.assertEqual((stats.created, stats.updated, stats.unchanged), (0, 0, 2))
+        self.assertEqual(self.saved, [])
+
+    def test_post_save(self):
+        first = self.rows("n1", "n2")
+        second = self.rows("changed1", "changed2", "n3")
+
+        # The old per-row syncs, with update_or_create
+        for rows in (first, second):
+            for defaults, kwargs in rows:
+                Node.objects.update_or_create(defaults=defaults, **kwargs)
+        expected, self.saved = self.saved, []
+        Node.objects.all().delete()
+
+        for rows in (first, second):
+            self.sync(rows, batch_size=2)
+        self.assertEqual(sorted(self.saved), sorted(expected))
+        self.assertEqual(len(self.saved), 5)
+
+
+class WatermarkTest(TestCase):
+    """Tests for the checkpoints of incremental syncs."""
+
+    @override_settings(SYNC_WATERMARK_OVERLAP=timedelta(minutes=10))
+    def test_watermark(self):
+        self.assertIsNone(get_watermark("source", "stream"))
+        synced = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        set_watermark("source", "stream", synced)
+        # Syncs resume a little before the watermark, to pick up late rows
+        self.assertEqual(get_watermark("source", "stream"), synced - timedelta(minutes=10))
+        # Watermarks never move back
+        set_watermark("source", "stream", synced - timedelta(hours=1))
+        self.assertEqual(SyncCheckpoint.objects.get(source="source", stream="stream").watermark, synced)
+        set_watermark("source", "stream", synced + timedelta(hours=1))
+        self.assertEqual(SyncCheckpoint.objects.get(source="source", stream="stream").watermark, synced + timedelta(hours=1))
+        # Streams are checkpointed separately
+        self.assertIsNone(get_watermark("source", "other"))
+
+
+class TopologyTest(TestCase):
+    """Tests for suppressing nodes behind down nodes."""
+
+    def setUp(self):
+        patcher = mock.patch.object(signals, "_sync_prometheus_data_to_yml")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Mesh.objects.create(name="a")
+        # gateway - n1 - n2 - n3, with n4 also linked to n2 and the gateway
+        for i, name in enumerate(["gateway", "n1", "n2", "n3", "n4", "isolated"], 1):
+            Node.objects.create(mac=f"02:00:00:00:00:{i:02x}", name=name, mesh_id="a", is_gateway=name == "gateway")
+        self.nodes = {node.name: node for node in Node.objects.all()}
+        for a, b in (("gateway", "n1"), ("n1", "n2"), ("n2", "n3"), ("n4", "n2")):
+            # Links are only recorded on one side
+            self.nodes[a].neighbours.add(self.nodes[b])
+
+    def unreachable_upstream(self, *down: str) -> set[str]:
+        macs = {self.nodes[name].mac: name for name in self.nodes}
+        return {macs[mac] for mac in topology.get_unreachable_upstream({self.nodes[name].mac for name in down})}
+
+    def test_unreachable_upstream(self):
+        self.assertEqual(self.unreachable_upstream(), set())
+        self.assertEqual(self.unreachable_upstream("n1"), {"n2", "n3", "n4"})
+        self.assertEqual(self.unreachable_upstream("n2"), {"n3", "n4"})
+        # Nodes with another path to a gateway are still reachable
+        self.nodes["n4"].neighbours.add(self.nodes["gateway"])
+        self.assertEqual(self.unreachable_upstream("n1"), set())
+        self.assertEqual(self.unreachable_upstream("gateway"), {"n1", "n2", "n3", "n4"})
+
+    def test_no_gateways(self):
+        Node.objects.update(is_gateway=False)
+        self.assertEqual(self.unreachable_upstream("n1"), set())
+
+    def test_synced(self):
+        # Syncs keep the configured gateways and neighbours
+        syncer = BulkSyncer(Node)
+        syncer.add({"name": "renamed", "mesh_id": "a"}, {"mac": self.nodes["gateway"].mac})
+        syncer.finish()
+        gateway = Node.objects.get(mac=self.nodes["gateway"].mac)
+        self.assertEqual((gateway.name, gateway.is_gateway), ("renamed", True))
+        self.assertEqual(list(gateway.neighbours.all()), [self.nodes["n1"]])
+
+    def test_alerts(self):
+        Node.objects.filter(name__in=["n2", "n3"]).update(unreachable_upstream=True)
+        results = mock.MagicMock()
+        results.status.return_value = CheckStatus.CRITICAL
+        results.alert_summary.return_value = "Down"
+        with (
+            mock.patch.object(CheckResults, "run_checks", return_value=results),
+            mock.patch.object(locks, "get_client"),
+        ):
+            tasks.generate_alerts()
+        # Nodes behind a down node aren't alerted on
+        self.assertEqual(
+            sorted(Alert.objects.values_list("node__name", flat=True)), ["gateway", "isolated", "n1", "n4"]
+        )
+
+
+class OrchestratorTest(TransactionTestCase):
+    """Tests for running sync stages concurrently, following their dependencies.
+
+    Stages run on other threads, so their telemetry is committed rather than
+    rolled back after each test.
+    """
+
+    def setUp(self):
+        self.started = []
+        self.done = []
+        self.contexts = []
+        self.lock = threading.Lock()
+
+    def stage(self, name: str, *depends_on: str, error: Exception | None = None) -> Stage:
+        """A stage that records when it runs, reporting a created model per stage it depends on."""
+
+        def func(source, ctx):
+            with self.lock:
+                self.started.append(name)
+                self.contexts.append(ctx)
+            # Give stages that don't depend on each other a chance to overlap
+            time.sleep(0.05)
+            if error is not None:
+                raise error
+            with self.lock:
+                self.done.append(name)
+            return SyncStats(created=len(depends_on), rows_read=1)
+
+        return Stage(name, func, lambda: nullcontext(None), depends_on)
+
+    def assertRanAfter(self, name: str, *depends_on: str):
+        for dependency in depends_on:
+            self.assertLess(self.done.index(dependency), self.started.index(name))
+
+    def test_dependencies(self):
+        stages = [self.stage("d", "b", "c"), self.stage("b", "a"), self.stage("c", "a"), self.stage("a")]
+        results = orchestrator.run_stages(stages, SyncContext(), max_workers=4)
+        self.assertEqual(sorted(results), ["a", "b", "c", "d"])
+        self.assertEqual(results["d"].created, 2)
+        self.assertRanAfter("b", "a")
+        self.assertRanAfter("c", "a")
+        self.assertRanAfter("d", "b", "c")
+        # All stages share the run's context
+        self.assertEqual(len({id(ctx) for ctx in self.contexts}), 1)
+
+    def test_failed(self):
+        stages = [
+            self.stage("a"),
+            self.stage("b", "a", error=RuntimeError("b failed")),
+            self.stage("c", "b"),
+            self.stage("d", "c"),
+            self.stage("e", "a"),
+        ]
+        sync_run = SyncRun.objects.create(sources="test")
+        with self.assertRaisesMessage(RuntimeError, "b failed"):
+            orchestrator.run_stages(stages, SyncContext(), sync_run=sync_run)
+        # The stages that depend on b (indirectly) were skipped, the others still ran
+        self.assertEqual(sorted(self.started), ["a", "b", "e"])
+        self.assertEqual(
+            dict(sync_run.stages.values_list("name", "status")),
+            {"a": "succeeded", "b": "failed", "c": "skipped", "d": "skipped", "e": "succeeded"},
+        )
+        self.assertEqual(sync_run.stages.get(name="b").error, repr(RuntimeError("b failed")))
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(ValueError, "unknown stages"):
+            orchestrator.run_stages([self.stage("a", "missing")], SyncContext())
+        with self.assertRaisesMessage(ValueError, "circular dependencies"):
+            orchestrator.run_stages([self.stage("a", "b"), self.stage("b", "a")], SyncContext())
+        self.assertEqual(self.started, [])
+
+    def test_run(self):
+        orchestrator.run([self.stage("a"), self.stage("b", "a")], full=True, name="test")
+        sync_run = SyncRun.objects.get()
+        self.assertEqual((sync_run.sources, sync_run.full, sync_run.status), ("test", True, "succeeded"))
+        self.assertIsNotNone(sync_run.duration)
+        self.assertTrue(all(ctx.full for ctx in self.contexts))
+        stage = SyncStage.objects.get(run=sync_run, name="b")
+        self.assertEqual((stage.source, stage.status, stage.created, stage.rows_read), ("b", "succeeded", 1, 1))
+        self.assertGreater(stage.duration, 0)
+        self.assertGreater(sync_run.worker_peak_rss, 0)
+
+        with self.assertRaises(RuntimeError):
+            orchestrator.run([self.stage("a", error=RuntimeError)])
+        self.assertEqual(SyncRun.objects.latest("started").status, "failed")
+
+
+class SyncTelemetryTest(TestCase):
+    """Tests for listing the telemetry of sync runs."""
+
+    def setUp(self):
+        started = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+        self.runs = [SyncRun.objects.create(sources="radiusdesk", status="succeeded", duration=i + 1) for i in range(2)]
+        for sync_run in self.runs:
+            for i, name in enumerate(["radiusdesk.nodes", "radiusdesk.bytes"]):
+                SyncStage.objects.create(
+                    run=sync_run, name=name, source="radiusdesk", status="succeeded",
+                    started=started + timedelta(seconds=i), rows_read=10, created=2, updated=3, deleted=1,
+                )
+        SyncStage.objects.create(run=self.runs[1], name="unifi.nodes", source="unifi", status="skipped", started=started + timedelta(seconds=2))
+
+    def test_runs(self):
+        view = SyncRunViewSet.as_view({"get": "retrieve"})
+        data = view(APIRequestFactory().get("/monitoring/sync_runs/"), pk=self.runs[1].pk).data
+        self.assertEqual((data["sources"], data["status"], data["duration"]), ("radiusdesk", "succeeded", 2))
+        self.assertEqual(
+            [(stage["name"], stage["status"]) for stage in data["stages"]],
+            [("radiusdesk.nodes", "succeeded"), ("radiusdesk.bytes", "succeeded"), ("unifi.nodes", "skipped")],
+        )
+        self.assertEqual(data["stages"][0]["rows_written"], 6)
+
+    def test_stages(self):
+        view = SyncStageViewSet.as_view({"get": "list"})
+
+        def list_stages(**params):
+            data = view(APIRequestFactory().get("/monitoring/sync_stages/", params)).data
+            return [(stage["run"], stage["name"]) for stage in data]
+
+        self.assertEqual(len(list_stages()), 5)
+        # A stage's telemetry over time
+        self.assertEqual(
+            list_stages(name="radiusdesk.bytes"), [(sync_run.pk, "radiusdesk.bytes") for sync_run in self.runs]
+        )
+        self.assertEqual(list_stages(source="unifi"), [(self.runs[1].pk, "unifi.nodes")])
+        self.assertEqual(list_stages(name="radiusdesk.nodes", source="unifi"), [])
+
+
+@override_settings(SYNC_CONNECT_RETRIES=3, SYNC_CONNECT_BACKOFF=1)
+class ConnectionsTest(SimpleTestCase):
+    """Tests for the per-process source connections, and retrying to connect."""
+
+    def setUp(self):
+        for target, name in ((connections, "_mysql_pools"), (connections, "_mongo_clients")):
+            patcher = mock.patch.dict(getattr(target, name), clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(connections.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sleeps(self) -> list[float]:
+        return [call.args[0] for call in self.sleep.call_args_list]
+
+    def test_backoff(self):
+        connect = mock.Mock(side_effect=[mysql.connector.Error("down"), mysql.connector.Error("down"), "connection"])
+        self.assertEqual(connections.with_backoff(connect, "radiusdesk", (mysql.connector.Error,)), "connection")
+        self.assertEqual(self.sleeps(), [1, 2])
+
+    def test_give_up(self):
+        connect = mock.Mock(side_effect=mysql.connector.Error("down"))
+        with self.assertRaises(mysql.connector.Error):
+            connections.with_backoff(connect, "radiusdesk", (mysql.connector.Error,))
+        self.assertEqual(connect.call_count, 4)
+        self.assertEqual(self.sleeps(), [1, 2, 4])
+        # Other errors aren't retried
+        connect = mock.Mock(side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            connections.with_backoff(connect, "radiusdesk", (mysql.connector.Error,))
+        self.assertEqual(connect.call_count, 1)
+
+    @mock.patch.object(connections, "MySQLConnectionPool")
+    def test_mysql_pool_per_process(self, Pool):
+        Pool.side_effect = lambda **kwargs: mock.Mock()
+        with mock.patch.object(connections.os, "getpid", return_value=100):
+            pool = connections.get_mysql_pool()
+            self.assertIs(connections.get_mysql_pool(), pool)
+        # A forked worker gets its own pool, rather than its parent's sockets
+        with mock.patch.object(connections.os, "getpid", return_value=200):
+            self.assertIsNot(connections.get_mysql_pool(), pool)
+        self.assertEqual(
+            [call.kwargs["pool_name"] for call in Pool.call_args_list], ["radiusdesk-100", "radiusdesk-200"]
+        )
+
+    @mock.patch.object(connections, "MySQLConnectionPool")
+    def test_mysql_unhealthy(self, Pool):
+        stale, healthy = mock.Mock(), mock.Mock()
+        stale.ping.side_effect = mysql.connector.Error("gone away")
+        Pool.return_value.get_connection.side_effect = [stale, healthy]
+        self.assertIs(connections.get_mysql_connection(), healthy)
+        # The stale connection went back to the pool
+        stale.close.assert_called_once()
+        healthy.ping.assert_called_once_with(reconnect=True)
+        self.assertEqual(self.sleeps(), [1])
+
+    @mock.patch.object(connections, "MongoClient")
+    def test_mongo_client_per_process(self, MongoClient):
+        MongoClient.side_effect = lambda **kwargs: mock.Mock()
+        with mock.patch.object(connections.os, "getpid", return_value=100):
+            client = connections.get_mongo_client()
+            self.assertIs(connections.get_mongo_client(), client)
+        with mock.patch.object(connections.os, "getpid", return_value=200):
+            self.assertIsNot(connections.get_mongo_client(), client)
+        self.assertEqual(MongoClient.call_count, 2)
+
+    @mock.patch.object(connections, "MongoClient")
+    def test_mongo_unhealthy(self, MongoClient):
+        stale, healthy = mock.Mock(), mock.Mock()
+        stale.admin.command.side_effect = PyMongoError("not primary")
+        MongoClient.side_effect = [stale, healthy]
+        self.assertIs(connections.get_mongo_client(), healthy)
+        # The unhealthy client was replaced, rather than kept for the next sync
+        stale.close.assert_called_once()
+        self.assertIs(connections.get_mongo_client(), healthy)
+        self.assertEqual(self.sleeps(), [1])
+
+
+class PrometheusSyncTest(SimpleTestCase):
+    """Tests for deferring the writes of the prometheus targets."""
+
+    def test_deferred(self):
+        with mock.patch.object(signals, "_sync_prometheus_data_to_yml") as sync:
+            with signals.deferred_prometheus_sync():
+                threads = [threading.Thread(target=signals.request_prometheus_sync) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                sync.assert_not_called()
+            sync.assert_called_once()
+            signals.request_prometheus_sync()
+            self.assertEqual(sync.call_count, 2)
+
+    def test_deferred_unchanged(self):
+        with mock.patch.object(signals, "_sync_prometheus_data_to_yml") as sync:
+            with signals.deferred_prometheus_sync():
+                pass
+            sync.assert_not_called()
+
+
+class InProcessPool:
+    """Stand-in for a billiard spawn context and its Pool, running the shards one after another."""
+
+    def Pool(self, processes, initializer=None, initargs=()):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def starmap(self, func, iterable):
+        return [func(*args) for args in iterable]
+
+
+class RadiusdeskDatabase:
+    """The radiusdesk tables read by the sync in SQLite, queried like a mysql-connector cursor.
+
+    The MySQL functions used by the station queries are defined in Python.
+    """
+
+    TABLES = [
+        "clouds (id INTEGER PRIMARY KEY, name TEXT, created TEXT)",
+        "meshes (id INTEGER PRIMARY KEY, name TEXT)",
+        "ap_profiles (id INTEGER PRIMARY KEY, cloud_id INTEGER)",
+        "node_loads (node_id INTEGER, mem_total INTEGER, mem_free INTEGER)",
+        "ap_loads (ap_id INTEGER, mem_total INTEGER, mem_free INTEGER)",
+        "unknown_nodes (mac TEXT, vendor TEXT, from_ip TEXT, gateway TEXT, last_contact TEXT, created TEXT, name TEXT)",
+    ]
+    DEVICE_COLUMNS = "name TEXT, description TEXT, hardware TEXT, ip TEXT, last_contact_from_ip TEXT, mesh_id INTEGER, ap_profile_id INTEGER"
+    DATETIME_RE = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+
+    def __init__(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.create_function("CRC32", 1, lambda value: zlib.crc32(value.encode()))
+        self.db.create_function("MOD", 2, lambda a, b: a % b)
+        self.db.create_function("FLOOR", 1, lambda value: int(value // 1))
+        self.db.create_function("UNIX_TIMESTAMP", 1, lambda value: self.parse(value).replace(tzinfo=timezone.utc).timestamp())
+        self.db.create_function("FROM_UNIXTIME", 1, lambda value: self.format(datetime.fromtimestamp(value, timezone.utc)))
+        for table in self.TABLES:
+            self.db.execute(f"CREATE TABLE {table}")
+        for device in ("node", "ap"):
+            self.db.execute(f"CREATE TABLE {device}s (id INTEGER PRIMARY KEY, mac TEXT, {self.DEVICE_COLUMNS})")
+            self.db.execute(
+                f"CREATE TABLE {device}_stations ({device}_id INTEGER, tx_bytes INTEGER, rx_bytes INTEGER, "
+                "tx_packets INTEGER, rx_packets INTEGER, tx_failed INTEGER, tx_retries INTEGER, created TEXT)"
+            )
+        self.queries = []
+
+    @staticmethod
+    def parse(value: str) -> datetime:
+        return datetime.fromisoformat(value)
+
+    @staticmethod
+    def format(value: datetime) -> str:
+        return value.replace(tzinfo=None).isoformat(" ")
+
+    def add_device(self, mac: str, device: str = "node") -> int:
+        """Add a node or AP, unless it exists, returning its id."""
+        row = self.db.execute(f"SELECT id FROM {device}s WHERE mac = ?", (mac,)).fetchone()
+        return row[0] if row else self.db.execute(f"INSERT INTO {device}s (mac) VALUES (?)", (mac,)).lastrowid
+
+    def set_load(self, mac: str, mem_free: int, mem_total: int = 1000, device: str = "node") -> None:
+        """Set the current load of a node or AP."""
+        device_id = self.add_device(mac, device)
+        self.db.execute(f"DELETE FROM {device}_loads WHERE {device}_id = ?", (device_id,))
+        self.db.execute(f"INSERT INTO {device}_loads VALUES (?, ?, ?)", (device_id, mem_total, mem_free))
+
+    def add_station(self, mac: str, created: datetime, value: int, device: str = "node") -> None:
+        """Add a station row whose counters are all value."""
+        device_id = self.add_device(mac, device)
+        self.db.execute(
+            f"INSERT INTO {device}_stations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (device_id, value, value, value, value, value, value, self.format(created)),
+        )
+
+    def execute(self, query: str, params=None, multi: bool = False):
+        self.queries.append((query, params))
+        params = {k: self.format(v) if isinstance(v, datetime) else v for k, v in (params or {}).items()}
+        # Every named parameter must be given, like with mysql-connector
+        sqlite_query = re.sub(r"%\((\w+)\)s", lambda m: f"{params[m[1]]!r}", query)
+        results = [self.fetch(statement) for statement in sqlite_query.split(";") if statement.strip()]
+        return iter(results)
+
+    def fetch(self, statement: str):
+        rows = [
+            tuple(self.parse(v) if isinstance(v, str) and self.DATETIME_RE.fullmatch(v) else v for v in row)
+            for row in self.db.execute(statement)
+        ]
+        return ReplayResult(rows)
+
+
+@override_settings(RD_METRICS_BUCKET=None, SYNC_BATCH_SIZE=100)
+class RadiusdeskStationSyncTest(TestCase):
+    """Tests for the radiusdesk station metric syncs, on radiusdesk tables in SQLite."""
+
+    databases = {"default", "metrics_db"}
+    macs = ["02:00:00:00:00:01", "02:00:00:00:00:02"]
+
+    def setUp(self):
+        self.source = RadiusdeskDatabase()
+        self.created = datetime(2024, 1, 1, 10, 0, 3)
+
+    def test_stations_summed(self):
+        # Two stations per node report at the same time
+        for mac in self.macs:
+            self.source.add_station(mac, self.created, 1)
+            self.source.add_station(mac, self.created, 2)
+        self.source.add_station("02:00:00:00:00:03", self.created, 4, device="ap")
+        radiusdesk.sync_node_bytes_metrics(self.source)
+        radiusdesk.sync_node_failures_metrics(self.source)
+        created = radiusdesk.localize(self.created)
+        self.assertEqual(
+            sorted(DataUsageMetric.objects.values_list("tx_bytes", "rx_bytes", "created")),
+            [(3, 3, created), (3, 3, created), (4, 4, created)],
+        )
+        self.assertEqual(
+            sorted(FailuresMetric.objects.values_list("tx_packets", "tx_dropped", "tx_retries")),
+            [(3, 3, 3), (3, 3, 3), (4, 4, 4)],
+        )
+
+    @override_settings(RD_METRICS_BUCKET=timedelta(minutes=5))
+    def test_buckets(self):
+        # Both nodes report in the same buckets, which are summed per node
+        for minute, value in ((0, 1), (4, 2), (5, 4)):
+            for i, mac in enumerate(self.macs):
+                self.source.add_station(mac, self.created.replace(minute=minute), value * (i + 1))
+        radiusdesk.sync_node_bytes_metrics(self.source)
+        bucket = radiusdesk.localize(datetime(2024, 1, 1, 10))
+        self.assertEqual(
+            sorted(DataUsageMetric.objects.values_list("mac", "created", "tx_bytes")),
+            [
+                (self.macs[0], bucket, 3),
+                (self.macs[0], bucket + timedelta(minutes=5), 4),
+                (self.macs[1], bucket, 6),
+                (self.macs[1], bucket + timedelta(minutes=5), 8),
+            ],
+        )
+
+    @override_settings(SYNC_WATERMARK_OVERLAP=timedelta(hours=1))
+    def test_resume(self):
+        self.source.add_station(self.macs[0], self.created, 1)
+        self.source.add_station(self.macs[0], self.created.replace(hour=12), 2)
+        radiusdesk.sync_node_bytes_metrics(self.source)
+        checkpoint = SyncCheckpoint.objects.get(source="radiusdesk", stream="node_bytes")
+        self.assertEqual(checkpoint.watermark, radiusdesk.localize(self.created.replace(hour=12)))
+        # A row that arrived late, within the overlap, and one older than it
+        self.source.add_station(self.macs[0], self.created.replace(hour=11, minute=30), 4)
+        self.source.add_station(self.macs[0], self.created.replace(hour=9), 8)
+        radiusdesk.sync_node_bytes_metrics(self.source)
+        # The watermark is queried in the same local time that rows are read in
+        self.assertEqual(self.source.queries[-1][1]["since"], self.created.replace(hour=11))
+        self.assertEqual(sorted(DataUsageMetric.objects.values_list("tx_bytes", flat=True)), [1, 2, 4])
+        # A full sync ignores the watermark
+        radiusdesk.sync_node_bytes_metrics(self.source, SyncContext(full=True))
+        self.assertEqual(self.source.queries[-1][1]["since"], radiusdesk.EPOCH)
+        self.assertEqual(sorted(DataUsageMetric.objects.values_list("tx_bytes", flat=True)), [1, 2, 4, 8])
+
+    def test_full_command(self):
+        with mock.patch.object(radiusdesk.orchestrator, "run") as run:
+            call_command("syncrd", "--full")
+        self.assertTrue(run.call_args.kwargs["full"])
+        with mock.patch.object(radiusdesk.orchestrator, "run") as run:
+            call_command("syncrd")
+        self.assertFalse(run.call_args.kwargs["full"])
+
+    @override_settings(SYNC_METRIC_SHARDS=2)
+    def test_sharded(self):
+        macs = [f"02:00:00:00:00:{i:02x}" for i in range(1, 21)]
+        for mac in macs:
+            self.source.add_station(mac, self.created, 1)
+        stage = Stage("radiusdesk.bytes", radiusdesk.sync_node_bytes_metrics, lambda: nullcontext(self.source), sharded=True)
+        with mock.patch.object(orchestrator.billiard, "get_context", return_value=InProcessPool()):
+            stats = orchestrator.run_sharded(stage, SyncContext())
+        self.assertEqual(
+            [(params["shard"], params["shards"]) for _, params in self.source.queries], [(0, 2), (1, 2)]
+        )
+        # Each MAC was synced by exactly one of the shards
+        self.assertEqual((stats.rows_read, stats.created), (20, 20))
+        self.assertEqual(sorted(str(mac) for mac in DataUsageMetric.objects.values_list("mac", flat=True)), sorted(
+            str(DataUsageMetric._meta.get_field("mac").to_python(mac)) for mac in macs
+        ))
+        self.assertEqual({shard_of(mac, 2) for mac in macs}, {0, 1})
+        # The checkpoint was advanced once both shards were done
+        self.assertEqual(
+            SyncCheckpoint.objects.get(source="radiusdesk", stream="node_bytes").watermark, radiusdesk.localize(self.created)
+        )
+
+    def test_shard_of(self):
+        # MySQL's CRC32() is the same CRC-32 as zlib's, e.g. SELECT CRC32('MySQL') is 3259397556
+        self.assertEqual(zlib.crc32(b"MySQL"), 3259397556)
+        self.assertEqual(shard_of("MySQL", 1000), 3259397556 % 1000)
+        # The shard filter of the station queries, with SQLite running zlib's CRC-32 like MySQL
+        for mac in ("02:00:00:00:00:01", "aa:bb:cc:dd:ee:ff"):
+            self.source.add_station(mac, self.created, 1)
+        for shard in range(3):
+            query = f"SELECT n.mac FROM nodes n WHERE {radiusdesk.SHARD.format('n.mac')}"
+            rows, = self.source.execute(query, {"shard": shard, "shards": 3})
+            self.assertEqual(
+                sorted(mac for mac, in rows.fetchall()),
+                sorted(mac for mac in ("02:00:00:00:00:01", "aa:bb:cc:dd:ee:ff") if shard_of(mac, 3) == shard),
+            )
+
+    def test_record(self):
+        for mac in self.macs:
+            self.source.add_station(mac, self.created, 1)
+            self.source.add_station(mac, self.created, 2)
+        with mock.patch.object(replay, "radiusdesk_cursor", return_value=nullcontext(self.source)):
+            snapshot = replay.record_radiusdesk()
+        # The recorded queries are the ones the sync runs
+        self.assertEqual(
+            [query for query, _ in self.source.queries],
+            [getattr(radiusdesk, name) for name in replay.RADIUSDESK_QUERIES],
+        )
+        radiusdesk.sync_node_bytes_metrics(replay.ReplayCursor(snapshot))
+        self.assertEqual(sorted(DataUsageMetric.objects.values_list("tx_bytes", flat=True)), [3, 3])
+
+    @override_settings(RD_METRICS_BUCKET=timedelta(minutes=5))
+    def test_replay_buckets(self):
+        for minute, value in ((0, 1), (0, 2), (4, 4), (5, 8)):
+            for mac in self.macs:
+                self.source.add_station(mac, self.created.replace(minute=minute), value)
+        with mock.patch.object(replay, "radiusdesk_cursor", return_value=nullcontext(self.source)):
+            snapshot = replay.record_radiusdesk()
+        # Replayed bucketed queries sum the recorded rows like MySQL does
+        for source in (self.source, replay.ReplayCursor(snapshot)):
+            radiusdesk.sync_node_failures_metrics(source, radiusdesk.SyncContext(full=True))
+            self.assertEqual(
+                sorted(FailuresMetric.objects.values_list("tx_packets", "tx_dropped")),
+                [(7, 7), (7, 7), (8, 8), (8, 8)],
+            )
+            FailuresMetric.objects.all().delete()
+
+
+class RadiusdeskResourcesSyncTest(TestCase):
+    """Tests for syncing node loads, on radiusdesk tables in SQLite."""
+
+    databases = {"default", "metrics_db"}
+    macs = ["02:00:00:00:00:01", "02:00:00:00:00:02"]
+
+    def setUp(self):
+        self.source = RadiusdeskDatabase()
+        for mac in self.macs:
+            self.source.set_load(mac, 500)
+
+    def sync(self):
+        radiusdesk.sync_node_resources_metrics(self.source)
+        return list(ResourcesMetric.objects.filter(mac=self.macs[0]).order_by("created"))
+
+    def test_extend(self):
+        first, = self.sync()
+        self.assertEqual(first.memory, 50)
+        self.assertEqual(first.valid_until, first.created)
+        # Loads within RD_RESOURCES_TOLERANCE extend the latest sample
+        self.source.set_load(self.macs[0], 505)
+        extended, = self.sync()
+        self.assertEqual((extended.created, extended.memory), (first.created, 50))
+        self.assertGreater(extended.valid_until, first.valid_until)
+        self.assertEqual(ResourcesMetric.objects.count(), 2)
+
+    def test_new_sample(self):
+        self.sync()
+        self.source.set_load(self.macs[0], 800)
+        first, second = self.sync()
+        self.assertEqual((first.memory, second.memory), (50, 80))
+        self.assertGreater(second.created, first.valid_until)
+        self.assertEqual(second.valid_until, second.created)
+        # The other node's unchanged sample was extended instead
+        self.assertEqual(ResourcesMetric.objects.filter(mac=self.macs[1]).count(), 1)
+
+    def test_latest_resources(self):
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        ResourcesMetric.objects.bulk_create([
+            ResourcesMetric(mac=self.macs[0], created=start, memory=10),
+            ResourcesMetric(mac=self.macs[0], created=start + timedelta(hours=1), memory=20),
+            ResourcesMetric(mac=self.macs[1], created=start + timedelta(hours=1), memory=30),
+            ResourcesMetric(mac=self.macs[1], created=start + timedelta(hours=2), memory=40),
+            ResourcesMetric(mac="02:00:00:00:00:03", created=start, memory=50),
+        ])
+        latest = radiusdesk.get_latest_resources(self.macs)
+        self.assertEqual(sorted((metric.mac, metric.memory) for metric in latest.values()), [(self.macs[0], 20), (self.macs[1], 40)])
+        self.assertTrue(all(mac == metric.mac for mac, metric in latest.items()))
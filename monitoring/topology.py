@@ -0,0 +1,44 @@
+"""Mesh topology, as modelled by Node.neighbours and Node.is_gateway."""
+
+from collections import defaultdict, deque
+from typing import Iterable
+
+from .models import Node
+
+
+def get_adjacency() -> dict:
+    """Map each node's MAC address to its neighbours' MAC addresses."""
+    adjacency = defaultdict(set)
+    Neighbours = Node.neighbours.through
+    for from_mac, to_mac in Neighbours.objects.values_list("from_node", "to_node"):
+        # Links are followed both ways, even if only one side reported them
+        adjacency[from_mac].add(to_mac)
+        adjacency[to_mac].add(from_mac)
+    return adjacency
+
+
+def get_connected(start: Iterable, adjacency: dict, blocked: set = frozenset()) -> set:
+    """MAC addresses of the nodes connected to the start nodes, not passing through blocked nodes."""
+    connected = set(start) - blocked
+    queue = deque(connected)
+    while queue:
+        for neighbour in adjacency.get(queue.popleft(), ()):
+            if neighbour not in connected and neighbour not in blocked:
+                connected.add(neighbour)
+                queue.append(neighbour)
+    return connected
+
+
+def get_unreachable_upstream(down: set) -> set:
+    """MAC addresses of the nodes that are only connected to the gateways through down nodes.
+
+    Nodes that aren't connected to any gateway at all (e.g. because their
+    neighbours are unknown) are never included, neither are the down nodes.
+    """
+    gateways = set(Node.objects.filter(is_gateway=True).values_list("mac", flat=True))
+    if not gateways:
+        return set()
+    adjacency = get_adjacency()
+    connected = get_connected(gateways, adjacency)
+    connected_up = get_connected(gateways, adjacency, blocked=down)
+    return connected - connected_up - down
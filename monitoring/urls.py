@@ -9,5 +9,7 @@ router.register("services", views.ServiceViewSet)
 router.register("alerts", views.AlertsViewSet)
 router.register("meshes", views.MeshViewSet)
 router.register("unknown_nodes", views.UnknownNodeViewSet)
+router.register("sync_runs", views.SyncRunViewSet)
+router.register("sync_stages", views.SyncStageViewSet)
 
 urlpatterns = [path("", include(router.urls)), path("overview/", views.overview)]
@@ -1,5 +1,5 @@
 
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from dynamic_fields.mixins import DynamicFieldsViewMixin
@@ -51,4 +51,27 @@ class UnknownNodeViewSet(ModelViewSet):
     """View/Edit/Add/Delete UnknownNode items."""
 
     queryset = models.UnknownNode.objects.all()
-    serializer_class = serializers.UnknownNodeSerializer
\ No newline at end of file
+    serializer_class = serializers.UnknownNodeSerializer
+
+
+class SyncRunViewSet(ReadOnlyModelViewSet):
+    """View SyncRun items, with the telemetry of their stages."""
+
+    queryset = models.SyncRun.objects.prefetch_related("stages")
+    serializer_class = serializers.SyncRunSerializer
+
+
+class SyncStageViewSet(ReadOnlyModelViewSet):
+    """View SyncStage items, optionally filtered by stage name or source."""
+
+    queryset = models.SyncStage.objects.all()
+    serializer_class = serializers.SyncStageSerializer
+
+    def filter_queryset(self, qs):
+        """Filter against 'name' and 'source' parameters in the request query."""
+        qs = super().filter_queryset(qs)
+        for param in ("name", "source"):
+            value = self.request.query_params.get(param)
+            if value is not None:
+                qs = qs.filter(**{param: value})
+        return qs